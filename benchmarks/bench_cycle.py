@@ -0,0 +1,271 @@
+"""Run full ingest and embed cycles of the bot against a fake CNR api and a fake Discord channel.
+
+Starts a local aiohttp stand-in for /cnr/players, /cnr/servers and the FiveM
+info.json endpoints, fills a temporary database with --players players and
+drives fetch_and_store_data, display_online_users and update_leaderboard from
+main.py. No bot token or network access is needed.
+
+Usage: python benchmarks/bench_cycle.py [--players 10000,100000] [--online 2000] [--servers 5]
+                                        [--cycles 10] [--latency 0.05] [--failure-rate 0]
+                                        [--churn 0.05] [--linked 0.05] [--discord-latency 0]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import yaml
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import migrate
+
+SERVER_IDS = ['EU1', 'EU2', 'US1', 'US2', 'SEA', 'EU3', 'US3', 'SEA2']
+
+class FakeCnrApi:
+    """The CNR api and FiveM info.json endpoints, serving players picked from the benchmark database."""
+    def __init__(self, uids, servers, online, churn, latency, failure_rate):
+        self.servers = servers
+        self.online = online
+        self.churn = churn
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.uids = uids
+        self.cycle = 0
+        self.calls = Counter()
+        self.failures = 0
+        self.random = random.Random(1)
+        self._runner = None
+        self.port = None
+
+    def players(self, server):
+        """This cycle's players of a server, `churn` of them rotate out every cycle."""
+        index = self.servers.index(server)
+        offset = index * self.online + int(self.cycle * self.online * self.churn)
+        return [self.uids[(offset + i) % len(self.uids)] for i in range(self.online)]
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/cnr/players', self.handle_players)
+        app.router.add_get('/cnr/servers', self.handle_servers)
+        app.router.add_get('/info/{server}.json', self.handle_info)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    async def _answer(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            return False
+        return True
+
+    async def handle_players(self, request):
+        server = request.query.get('serverId')
+        if not await self._answer('players') or server not in self.servers:
+            return web.Response(status=503)
+        payload = [
+            {'Uid': uid, 'Username': {'Username': f'Player_{uid}', 'Color': '#ffffff'}, 'Level': 1, 'Job': 'Civilian'}
+            for uid in self.players(server)
+        ]
+        return web.json_response(payload)
+
+    async def handle_servers(self, request):
+        if not await self._answer('servers'):
+            return web.Response(status=503)
+        return web.json_response([{'Id': server, 'Players': self.online, 'QueuedPlayers': 0} for server in self.servers])
+
+    async def handle_info(self, request):
+        if not await self._answer('info'):
+            return web.Response(status=503)
+        return web.json_response({'vars': {'Time': 'Monday 12:00'}})
+
+class FakeMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        await self.channel.record('edit')
+        return self
+
+class FakeChannel:
+    """Stands in for every channel the bot posts to and records what it would have sent."""
+    def __init__(self, latency):
+        self.id = 1
+        self.latency = latency
+        self.calls = Counter()
+        self.in_flight = 0
+        self.next_id = 10 ** 17
+
+    async def record(self, call):
+        self.in_flight += 1
+        try:
+            self.calls[call] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+    async def send(self, **kwargs):
+        await self.record('send')
+        self.next_id += 1
+        return FakeMessage(self, self.next_id)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, message_id)
+
+def fill_database(path, players, linked):
+    """Create the schema and players players, `linked` of them linked to a Discord account."""
+    migrate(path)
+    conn = sqlite3.connect(path)
+    rng = random.Random(2)
+    uids = [f'{i:032x}' for i in range(players)]
+    start = time.perf_counter()
+    with conn:
+        conn.executemany(
+            'INSERT INTO players (uid, username, playtime, linked) VALUES (?, ?, ?, ?)',
+            ((uid, f'Player_{uid}', rng.randrange(0, 10 ** 7), 0) for uid in uids)
+        )
+        linked_uids = rng.sample(uids, int(players * linked))
+        # Linked in the guild from write_config
+        conn.executemany('''
+            INSERT INTO discord_users (guild_id, discord_id, uuid, playtime)
+            VALUES (1, ?, ?, (SELECT playtime FROM players WHERE uid = ?))
+        ''', ((str(10 ** 17 + i), uid, uid) for i, uid in enumerate(linked_uids)))
+        conn.executemany('UPDATE players SET linked = 1 WHERE uid = ?', ((uid,) for uid in linked_uids))
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f"database: {players:,} players ({len(linked_uids):,} linked) in {time.perf_counter() - start:.1f}s")
+    return uids
+
+def write_config(tmp, api, servers):
+    base = f'http://127.0.0.1:{api.port}'
+    config = {
+        'bottoken': 'benchmark',
+        'database': {'name': os.path.join(tmp, 'bench.db')},
+        'endpoints': {server.lower(): f'{base}/cnr/players?serverId={server}' for server in servers},
+        'ingest': {'failure_threshold': 10 ** 6, 'poll_interval': 0, 'busy_interval': 0},
+        'server_status_endpoint': f'{base}/cnr/servers',
+        'status_endpoints': {f'server_name {server}': f'{base}/info/{server}.json' for server in servers},
+        'guild_id': 1,
+        'staff_role_id': 1,
+        'crewmember_role_id': 1,
+        'online_users_channel_id': 1,
+        'leaderboard_channel_id': 1,
+        'staff_logs_channel_id': 1,
+    }
+    path = os.path.join(tmp, 'config.yml')
+    with open(path, 'w') as file:
+        yaml.safe_dump(config, file)
+    return path
+
+async def wait_for_discord(main, channel):
+    """Wait until every queued embed update has gone out."""
+    while main.edit_scheduler.queue_depth() or channel.in_flight:
+        await asyncio.sleep(0.001)
+
+async def run_cycles(main, api, channel, cycles):
+    await main.start_services()
+    main.bot.get_channel = lambda channel_id: channel
+    ingest = [endpoint for endpoint in main.poller.endpoints.values() if endpoint.name in main.ENDPOINTS]
+    status = [endpoint for endpoint in main.poller.endpoints.values() if endpoint.name not in main.ENDPOINTS]
+
+    rows = []
+    for cycle in range(cycles):
+        api.cycle = cycle
+        calls_before = sum(api.calls.values())
+        discord_before = sum(channel.calls.values())
+
+        start = time.perf_counter()
+        await asyncio.gather(main.fetch_and_store_data(ingest), main.ingest.fetch_status(status))
+        ingested = time.perf_counter()
+        await main.display_online_users()
+        await main.update_leaderboard()
+        await wait_for_discord(main, channel)
+        end = time.perf_counter()
+
+        rows.append((
+            end - start,
+            ingested - start,
+            sum(len(endpoint.data or ()) for endpoint in ingest),
+            sum(api.calls.values()) - calls_before,
+            sum(channel.calls.values()) - discord_before,
+        ))
+    return rows
+
+async def run(args, players):
+    with tempfile.TemporaryDirectory() as tmp:
+        servers = SERVER_IDS[:args.servers]
+        uids = fill_database(os.path.join(tmp, 'bench.db'), players, args.linked)
+        api = FakeCnrApi(uids, servers, min(args.online, players // args.servers), args.churn, args.latency, args.failure_rate)
+        await api.start()
+        channel = FakeChannel(args.discord_latency)
+        try:
+            # main.py reads its config when it is imported
+            os.environ['CNR_BOT_CONFIG'] = write_config(tmp, api, servers)
+            import main
+            # Discord isn't being called for real, don't pace the fake channel
+            main.edit_scheduler.route_limit = 10 ** 9
+            try:
+                rows = await run_cycles(main, api, channel, args.cycles)
+            finally:
+                await main.http_client.close()
+                await main.edit_scheduler.close()
+                main.db.close()
+        finally:
+            await api.close()
+
+    cycle_times = [row[0] for row in rows]
+    # The first cycle inserts every online player into the roster, report it separately
+    steady = rows[1:] or rows
+    ingest_rows = sum(row[2] for row in steady)
+    ingest_time = sum(row[1] for row in steady)
+    print(f"first cycle: {cycle_times[0] * 1000:.1f} ms")
+    print(f"cycle time:  median {statistics.median(row[0] for row in steady) * 1000:.1f} ms, "
+          f"max {max(row[0] for row in steady) * 1000:.1f} ms")
+    print(f"ingest:      {ingest_rows / ingest_time:,.0f} player rows/sec")
+    print(f"api calls:   {statistics.mean(row[3] for row in steady):.1f} per cycle ({api.failures} failed in total)")
+    print(f"discord:     {statistics.mean(row[4] for row in steady):.1f} sends/edits per cycle ({dict(channel.calls)})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', default='10000,100000', help='players in the database, comma separated runs e.g. 10000,100000,1000000')
+    parser.add_argument('--online', type=int, default=2000, help='players online per server')
+    parser.add_argument('--servers', type=int, default=5, choices=range(1, len(SERVER_IDS) + 1))
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake api takes to answer')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of fake api requests answered with 503')
+    parser.add_argument('--churn', type=float, default=0.05, help='share of each server\'s players replaced every cycle')
+    parser.add_argument('--linked', type=float, default=0.05, help='share of players linked to a Discord account')
+    parser.add_argument('--discord-latency', type=float, default=0.0, help='seconds every fake Discord call takes')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.players.split(',')]
+    if len(sizes) > 1:
+        # main.py keeps its state in module globals, every database size gets a fresh process
+        options = {name: value for name, value in vars(args).items() if name != 'players'}
+        argv = [item for name, value in options.items() for item in (f"--{name.replace('_', '-')}", str(value))]
+        for size in sizes:
+            print(f"--- {size:,} players ---", flush=True)
+            subprocess.run([sys.executable, __file__, *argv, '--players', str(size)], check=True)
+        return
+
+    asyncio.run(run(args, sizes[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Compare decoding a /cnr/players payload in one go with the streaming decode into PlayerRecords.
+
+Usage: python benchmarks/bench_decode.py [--players 2000] [--chunk-size 16384] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from player_stream import JsonArrayParser, player_record
+
+def make_payload(players):
+    """A /cnr/players response body shaped like the real one, with the fields the bot ignores."""
+    rng = random.Random(1)
+    entries = []
+    for i in range(players):
+        entries.append({
+            'Uid': f'{rng.getrandbits(64):016x}',
+            'Username': {
+                'Username': f'Player{i}',
+                'Color': rng.choice(['#ffffff', '#ff0000', '#00ff00']),
+                'Prefix': None,
+            },
+            'Level': rng.randrange(1, 500),
+            'Job': rng.choice(['Police', 'Criminal', 'Medic', 'Civilian']),
+            'Crew': {'Id': rng.randrange(1, 1000), 'Tag': 'CREW', 'Name': 'Some Crew'},
+            'Wanted': rng.randrange(0, 6),
+            'Badges': [rng.randrange(1, 50) for _ in range(4)],
+        })
+    return json.dumps(entries).encode()
+
+def chunks(body, chunk_size):
+    for start in range(0, len(body), chunk_size):
+        yield body[start:start + chunk_size]
+
+def buffered_decode(body, chunk_size):
+    """What response.json() did: buffer the whole body, decode it, then pick the fields."""
+    buffered = b''.join(chunks(body, chunk_size))
+    data = json.loads(buffered.decode())
+    players = []
+    for player in data:
+        uid = player.get('Uid')
+        username = player.get('Username', {}).get('Username')
+        if uid and username:
+            players.append((uid, username))
+    return players
+
+def streaming_decode(body, chunk_size):
+    """What stream_players does with the chunks of a response."""
+    parser = JsonArrayParser()
+    players = []
+    for chunk in chunks(body, chunk_size):
+        for player in parser.feed(chunk):
+            record = player_record(player)
+            if record is not None:
+                players.append(record)
+    for player in parser.close():
+        record = player_record(player)
+        if record is not None:
+            players.append(record)
+    return players
+
+def measure(decode, body, chunk_size, repeat):
+    """(seconds per decode, peak traced bytes, bytes still held by the result)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decode(body, chunk_size)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    result = decode(body, chunk_size)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, held, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=2000, help='players in the payload')
+    parser.add_argument('--chunk-size', type=int, default=16384, help='bytes per network read')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    body = make_payload(args.players)
+    print(f"payload: {args.players} players, {len(body) / 1024:,.0f} KiB")
+
+    results = {}
+    for name, decode in (('buffered', buffered_decode), ('stream', streaming_decode)):
+        elapsed, peak, held, players = measure(decode, body, args.chunk_size, args.repeat)
+        results[name] = [(player[0], player[1]) if isinstance(player, tuple) else (player.uid, player.username) for player in players]
+        print(f"{name:>8}: {elapsed * 1000:.2f} ms, peak {peak / 1024:,.0f} KiB, result holds {held / 1024:,.0f} KiB")
+
+    if results['buffered'] != results['stream']:
+        print("Result mismatch between the buffered and streaming decode")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
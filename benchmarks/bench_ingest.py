@@ -0,0 +1,168 @@
+"""Compare the old per-row player ingest with the batched upsert and the roster delta writes.
+
+The roster path is what the bot runs. On top of the players rows it keeps
+sessions, and for the --linked share of players their links and rollup
+buckets. Each path runs --repeat times on a fresh database and the fastest
+run is reported, the machine's noise only ever makes a run slower.
+
+Usage: python benchmarks/bench_ingest.py [--players 2000] [--servers 5] [--polls 20] [--linked 0.05] [--repeat 3]
+"""
+import argparse
+import contextlib
+import functools
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import migrate, store_roster_delta
+from roster import Roster
+
+def make_poll(poll, players_per_server, servers):
+    """Build a poll where roughly 5% of each server's players rotate out every poll."""
+    players = []
+    for s in range(servers):
+        server = f'srv{s}'
+        offset = poll * players_per_server // 20
+        for i in range(offset, offset + players_per_server):
+            players.append((f'{server}-{i}', f'Player{server}{i}', server))
+    return players
+
+def legacy_store_players(conn, players, elapsed_seconds, seen_at):
+    """The per-row SELECT then UPDATE/INSERT path that fetch_and_store_data used to run."""
+    c = conn.cursor()
+    fetched_uids = set()
+    for uid, username, server in players:
+        fetched_uids.add(uid)
+        c.execute('SELECT playtime, last_seen FROM players WHERE uid = ?', (uid,))
+        result = c.fetchone()
+        if result:
+            playtime, last_seen_str = result
+            playtime += int(elapsed_seconds)
+            c.execute('''
+                UPDATE players
+                SET username = ?, last_seen = ?, is_online = 1, server = ?, playtime = ?
+                WHERE uid = ?
+            ''', (username, seen_at, server, playtime, uid))
+        else:
+            c.execute('''
+                INSERT INTO players (uid, username, last_seen, server, is_online, playtime)
+                VALUES (?, ?, ?, ?, 1, 0)
+            ''', (uid, username, seen_at, server))
+
+    if fetched_uids:
+        placeholders = ','.join(['?'] * len(fetched_uids))
+        c.execute(f'SELECT uid FROM players WHERE uid NOT IN ({placeholders}) AND is_online = 1', tuple(fetched_uids))
+    else:
+        c.execute('SELECT uid FROM players WHERE is_online = 1')
+    for (uid,) in c.fetchall():
+        c.execute('UPDATE players SET is_online = 0 WHERE uid = ?', (uid,))
+    conn.commit()
+
+def batched_store_players(conn, players, elapsed_seconds, seen_at):
+    """The single batched upsert that replaced the per-row path, before the roster only wrote what changed."""
+    c = conn.cursor()
+    elapsed = int(elapsed_seconds)
+    rows = [(uid, username, seen_at, server, elapsed) for uid, username, server in players]
+
+    c.executemany('''
+        INSERT INTO players (uid, username, last_seen, server, is_online, playtime)
+        VALUES (?, ?, ?, ?, 1, 0)
+        ON CONFLICT(uid) DO UPDATE SET
+            username = excluded.username,
+            last_seen = excluded.last_seen,
+            server = excluded.server,
+            is_online = 1,
+            playtime = players.playtime + ?
+    ''', rows)
+
+    # Everyone online that wasn't part of this poll went offline
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS fetched_uids (uid TEXT PRIMARY KEY)')
+    c.execute('DELETE FROM fetched_uids')
+    c.executemany('INSERT OR IGNORE INTO fetched_uids (uid) VALUES (?)', ((row[0],) for row in rows))
+    c.execute('''
+        UPDATE players SET is_online = 0
+        WHERE is_online = 1 AND uid NOT IN (SELECT uid FROM fetched_uids)
+    ''')
+    conn.commit()
+
+def roster_store_players(conn, players, elapsed_seconds, seen_at, roster=None, linked=frozenset()):
+    """Diff the poll against an in-memory Roster and write only the delta, like Ingest.fetch_players."""
+    fetched = {uid: (username, server) for uid, username, server in players}
+    delta = roster.apply(fetched, {server for uid, username, server in players}, datetime.fromisoformat(seen_at))
+    tracked_uids = [uid for uid, seconds in delta.stayed if seconds > 0 and uid in linked]
+    store_roster_delta(conn, delta, seen_at, tracked_uids)
+    conn.commit()
+
+def linked_uids(polls, players_per_server, servers, share):
+    """Every 1/share-th player that shows up in the benchmark, they are linked in one guild."""
+    if share <= 0:
+        return frozenset()
+    step = max(1, round(1 / share))
+    last = (polls - 1) * players_per_server // 20 + players_per_server
+    return frozenset(f'srv{s}-{i}' for s in range(servers) for i in range(0, last, step))
+
+def run(store, polls, players_per_server, servers, linked=frozenset()):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(path)
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.executemany('INSERT INTO discord_users (guild_id, discord_id, uuid) VALUES (1, ?, ?)',
+                             [(uid, uid) for uid in linked])
+        total_rows = 0
+        # Simulated clock, one poll a minute
+        first_poll = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        for poll in range(polls):
+            players = make_poll(poll, players_per_server, servers)
+            store(conn, players, 60, (first_poll + timedelta(minutes=poll)).isoformat())
+            total_rows += len(players)
+        elapsed = time.perf_counter() - start
+        online = conn.execute('SELECT COUNT(*) FROM players WHERE is_online = 1').fetchone()[0]
+        playtime = conn.execute('SELECT SUM(playtime) FROM players').fetchone()[0]
+        conn.close()
+    return total_rows, elapsed, online, playtime
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=2000, help='players per server per poll')
+    parser.add_argument('--servers', type=int, default=5)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--linked', type=float, default=0.05, help='share of players that are linked')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per path, the fastest is reported')
+    args = parser.parse_args()
+
+    # The legacy sweep binds one variable per online player, keep it under SQLite's limit
+    if args.players * args.servers > 32766:
+        parser.error('legacy path cannot bind more than 32766 uids, lower --players or --servers')
+
+    linked = linked_uids(args.polls, args.players, args.servers, args.linked)
+    results = {}
+    rates = {}
+    # Each run needs its own roster, like the database it is diffed against
+    variants = (
+        ('legacy', lambda: legacy_store_players),
+        ('batched', lambda: batched_store_players),
+        ('roster', lambda: functools.partial(roster_store_players, roster=Roster(), linked=linked)),
+    )
+    for name, make_store in variants:
+        runs = [run(make_store(), args.polls, args.players, args.servers, linked) for _ in range(args.repeat)]
+        rows, elapsed, online, playtime = min(runs, key=lambda result: result[1])
+        results[name] = (online, playtime)
+        rates[name] = rows / elapsed
+        print(f"{name:>8}: {rows} rows in {elapsed:.3f}s -> {rows / elapsed:,.0f} rows/sec")
+    print(', '.join(f"{name} {rate / rates['legacy']:.2f}x" for name, rate in rates.items() if name != 'legacy') + " of legacy")
+
+    if len(set(results.values())) != 1:
+        print(f"Result mismatch: {results}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import io
+import random
+import string
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+def random_string():
+    """Generate a random 5-character string for the captcha."""
+    N = 5
+    s = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    return ''.join(random.choices(s, k=N))
+
+def getit():
+    """Get a random coordinate for drawing lines/points in the captcha."""
+    return (random.randrange(5, 85), random.randrange(5, 55))
+
+# Colors for captcha text and noise
+colors = ["black", "red", "blue", "green", (64,107,76), (0,87,128), (0,3,82)]
+fill_color = [(64,107,76), (0,87,128), (0,3,82), (191,0,255), (72,189,0), (189,107,0), (189,41,0)]
+
+# Each render worker loads the font once
+_worker = threading.local()
+
+def _font():
+    font = getattr(_worker, 'font', None)
+    if font is None:
+        try:
+            font = ImageFont.truetype("arial.ttf", 18)  # Ensure this font is available
+        except IOError:
+            font = ImageFont.load_default()
+        _worker.font = font
+    return font
+
+def render_captcha():
+    """Draw a captcha, returns (png bytes, answer). Runs on a render worker, not the event loop."""
+    img = Image.new('RGB', (90, 60), color="white")
+    draw = ImageDraw.Draw(img)
+    captcha_str = random_string()
+    draw.text((20, 20), captcha_str, fill=random.choice(colors), font=_font())
+
+    # Add random lines for noise
+    for i in range(5, random.randrange(6, 10)):
+        draw.line((getit(), getit()), fill=random.choice(fill_color), width=random.randrange(1, 3))
+
+    # Add random points for noise
+    for i in range(10, random.randrange(11, 20)):
+        draw.point((getit(), getit()), fill=random.choice(colors))
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue(), captcha_str
+
+class CaptchaPool:
+    """Captchas rendered ahead of time on worker threads.
+
+    Background tasks keep up to `size` (png bytes, answer) pairs ready, so a
+    wave of people pressing Verify is served from memory. If the pool runs dry
+    a captcha is rendered on demand, still off the event loop.
+    """
+    def __init__(self, size=20, workers=2):
+        self.size = size
+        self.workers = workers
+        self._ready = None
+        self._executor = None
+        self._tasks = []
+
+    def start(self):
+        """Start the render workers, must be called from the running event loop."""
+        if self._executor is not None:
+            return
+        self._ready = asyncio.Queue(maxsize=self.size)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='captcha')
+        self._tasks = [asyncio.create_task(self._fill()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def get(self):
+        """A (png bytes, answer) pair that hasn't been handed out before."""
+        try:
+            return self._ready.get_nowait()
+        except asyncio.QueueEmpty:
+            return await self._render()
+
+    def available(self):
+        return self._ready.qsize() if self._ready is not None else 0
+
+    async def _render(self):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, render_captcha)
+
+    async def _fill(self):
+        while True:
+            try:
+                captcha = await self._render()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print("Error rendering captcha:")
+                traceback.print_exc()
+                await asyncio.sleep(5)
+                continue
+            # Waits here while the pool is full
+            await self._ready.put(captcha)
@@ -3,39 +3,56 @@ from discord.ext import commands
 from discord import app_commands
 from datetime import timedelta 
 import traceback
+import time
+
+from guilds import GuildSettings, is_staff, staff_only
+from leaderboard import LeaderboardCache
 
 class Moderation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    def log_channel(self, guild_id):
+        """Staff logs channel of a guild, None if it has none."""
+        settings = self.bot.guild_settings.get(guild_id)
+        if settings and settings.staff_logs_channel_id:
+            return self.bot.get_channel(settings.staff_logs_channel_id)
+        return None
+
     @commands.command(name='sync')
     async def sync_commands(self, ctx):
-        if not ctx.author.guild_permissions.manage_guild:
+        # Changes every slash command of the guild, staff also need Manage Server
+        if (ctx.guild is None or not ctx.author.guild_permissions.manage_guild
+                or not is_staff(ctx.author, self.bot.guild_settings.get(ctx.guild.id))):
             await ctx.send("❌ You don't have the required role to use this command.")
             return
 
-        """Synchronise all slash commands to the specified guild."""
+        """Synchronise all slash commands to the guild the command is used in."""
         try:
-            if not self.bot.GUILD_ID:
+            guild_id = ctx.guild.id if ctx.guild else self.bot.GUILD_ID
+            if not guild_id:
                 await ctx.send("Guild ID is not configured.")
                 return
 
-            self.bot.tree.copy_global_to(guild=discord.Object(id=self.bot.GUILD_ID))
-            await self.bot.tree.sync(guild=discord.Object(id=self.bot.GUILD_ID))
+            self.bot.tree.copy_global_to(guild=discord.Object(id=guild_id))
+            await self.bot.tree.sync(guild=discord.Object(id=guild_id))
             await ctx.send("🔄 Synchronized successfully.")
         except Exception as e:
             await ctx.send(f"❌ Synchronization failed: {e}")
 
     @commands.command(name='clearslash')
     async def clear_slash_commands(self, ctx):
-        """Clear all slash commands from the configured guild."""
-        if not ctx.author.guild_permissions.manage_guild:
-            await ctx.send("❌ You don't have the required permissions to use this command.")
+        """Clear all slash commands from the guild the command is used in."""
+        # Changes every slash command of the guild, staff also need Manage Server
+        if (ctx.guild is None or not ctx.author.guild_permissions.manage_guild
+                or not is_staff(ctx.author, self.bot.guild_settings.get(ctx.guild.id))):
+            await ctx.send("❌ You don't have the required role to use this command.")
             return
 
         try:
-            self.bot.tree.clear_commands(guild=discord.Object(id=self.bot.GUILD_ID))
-            await self.bot.tree.sync(guild=discord.Object(id=self.bot.GUILD_ID))
+            guild = discord.Object(id=ctx.guild.id if ctx.guild else self.bot.GUILD_ID)
+            self.bot.tree.clear_commands(guild=guild)
+            await self.bot.tree.sync(guild=guild)
             await ctx.send("🔄 All slash commands have been cleared from the server.")
         except Exception as e:
             await ctx.send(f"❌ Failed to clear slash commands: {e}")
@@ -61,7 +78,7 @@ class Moderation(commands.Cog):
                 timestamp=interaction.created_at
             )
             embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
-            log_channel = self.bot.get_channel(self.bot.LOG_CHANNEL_ID)
+            log_channel = self.log_channel(interaction.guild_id)
             if log_channel:
                 await log_channel.send(embed=embed)
             await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -90,7 +107,7 @@ class Moderation(commands.Cog):
                 timestamp=interaction.created_at
             )
             embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
-            log_channel = self.bot.get_channel(self.bot.LOG_CHANNEL_ID)
+            log_channel = self.log_channel(interaction.guild_id)
             if log_channel:
                 await log_channel.send(embed=embed)
             await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -147,7 +164,7 @@ class Moderation(commands.Cog):
                     timestamp=interaction.created_at
                 )
                 embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
-                log_channel = self.bot.get_channel(self.bot.LOG_CHANNEL_ID)
+                log_channel = self.log_channel(interaction.guild_id)
                 if log_channel:
                     await log_channel.send(embed=embed)
                 await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -157,6 +174,151 @@ class Moderation(commands.Cog):
         else:
             await interaction.response.send_message("❌ Invalid mute duration.", ephemeral=True)
 
+    @app_commands.command(name='pollstatus', description='Show the polling state of every CNR endpoint (Staff only).')
+    @app_commands.check(staff_only)
+    async def poll_status(self, interaction: discord.Interaction):
+        """Show the poll state machine of every endpoint the bot polls."""
+        try:
+            now = time.monotonic()
+            embed = discord.Embed(
+                title="📡 Endpoint Polling",
+                color=0x00BFFF,
+                timestamp=interaction.created_at
+            )
+            for endpoint in self.bot.poller.endpoints.values():
+                last_success = f"{int(now - endpoint.last_success)}s ago" if endpoint.last_success else "never"
+                lines = [
+                    f"**State:** {endpoint.state}{' (busy)' if endpoint.busy and endpoint.state == 'healthy' else ''}",
+                    f"**Next poll:** in {max(0, int(endpoint.next_poll - now))}s",
+                    f"**Last success:** {last_success}",
+                    f"**Last status:** {endpoint.last_status or 'N/A'}",
+                    f"**Polls:** {endpoint.polls} ({endpoint.not_modified} not modified)",
+                ]
+                if endpoint.failures:
+                    lines.append(f"**Failures in a row:** {endpoint.failures}, {endpoint.last_error}")
+                embed.add_field(name=endpoint.name.upper(), value='\n'.join(lines), inline=True)
+            embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("❌ An error occurred while reading the polling state.", ephemeral=True)
+
+    @app_commands.command(name='guildsetup', description='Set the channels and roles the bot uses in this server (Staff only).')
+    @app_commands.describe(
+        online_users_channel='Channel for the online players embeds',
+        leaderboard_channel='Channel for the leaderboard embeds',
+        staff_logs_channel='Channel for moderation logs',
+        staff_role='Staff role',
+        crewmember_role='Crew member role',
+        verification_channel='Channel for the verification message',
+        verified_role='Role given to members who pass verification'
+    )
+    @app_commands.check(staff_only)
+    async def guild_setup(self, interaction: discord.Interaction,
+                          online_users_channel: discord.TextChannel = None,
+                          leaderboard_channel: discord.TextChannel = None,
+                          staff_logs_channel: discord.TextChannel = None,
+                          staff_role: discord.Role = None,
+                          crewmember_role: discord.Role = None,
+                          verification_channel: discord.TextChannel = None,
+                          verified_role: discord.Role = None):
+        """Configure this server, every server shares the same player tracking."""
+        try:
+            guild_id = interaction.guild_id
+            settings = self.bot.guild_settings.get(guild_id) or GuildSettings(guild_id)
+            # Options that are left out keep their current value
+            changes = {
+                'online_users_channel_id': online_users_channel,
+                'leaderboard_channel_id': leaderboard_channel,
+                'staff_logs_channel_id': staff_logs_channel,
+                'staff_role_id': staff_role,
+                'crewmember_role_id': crewmember_role,
+                'verification_channel_id': verification_channel,
+                'verified_role_id': verified_role,
+            }
+            for field, value in changes.items():
+                if value is not None:
+                    setattr(settings, field, value.id)
+            await self.bot.guild_settings.save(self.bot.db, settings)
+            if guild_id not in self.bot.leaderboards:
+                board = self.bot.leaderboards[guild_id] = LeaderboardCache(guild_id)
+                await board.rebuild(self.bot.db)
+
+            def channel(channel_id):
+                return f"<#{channel_id}>" if channel_id else "Not set"
+
+            def role(role_id):
+                return f"<@&{role_id}>" if role_id else "Not set"
+
+            embed = discord.Embed(
+                title="⚙️ Server Settings",
+                description=(
+                    f"**Online players:** {channel(settings.online_users_channel_id)}\n"
+                    f"**Leaderboard:** {channel(settings.leaderboard_channel_id)}\n"
+                    f"**Staff logs:** {channel(settings.staff_logs_channel_id)}\n"
+                    f"**Staff role:** {role(settings.staff_role_id)}\n"
+                    f"**Crew member role:** {role(settings.crewmember_role_id)}\n"
+                    f"**Verification:** {channel(settings.verification_channel_id)}\n"
+                    f"**Verified role:** {role(settings.verified_role_id)}"
+                ),
+                color=0x00BFFF,
+                timestamp=interaction.created_at
+            )
+            embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+
+            # Post the verification message in the new channel right away
+            verification = self.bot.get_cog('VerificationCog')
+            if verification and verification_channel is not None:
+                await verification.post_verification_message(settings)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("❌ An error occurred while saving the server settings.", ephemeral=True)
+
+    @app_commands.command(name='perf', description='Show what has been blocking the bot (Staff only).')
+    @app_commands.describe(reset='Clear the collected data after showing it')
+    @app_commands.check(staff_only)
+    async def perf(self, interaction: discord.Interaction, reset: bool = False):
+        """Show event loop lag and the slowest blocking calls the loop watchdog caught."""
+        try:
+            watchdog = self.bot.loop_watchdog
+            if watchdog is None:
+                await interaction.response.send_message(
+                    "❌ Profiling is disabled, set `profiling.enabled` in the config and restart the bot.", ephemeral=True)
+                return
+
+            beats, mean_lag, max_lag, stalls = watchdog.report(limit=5)
+            embed = discord.Embed(
+                title="⏱️ Event Loop Performance",
+                description=(
+                    f"**Since:** <t:{int(watchdog.started)}:R>\n"
+                    f"**Heartbeats:** {beats}\n"
+                    f"**Lag:** {mean_lag * 1000:.1f} ms mean, {max_lag * 1000:.0f} ms max\n"
+                    f"**Stalls over {watchdog.threshold * 1000:.0f} ms:** {sum(stall.count for stall in watchdog.stalls.values())}"
+                ),
+                color=0x00BFFF,
+                timestamp=interaction.created_at
+            )
+            for stall in stalls:
+                embed.add_field(
+                    name=stall.coroutine[:256],
+                    value=(
+                        f"`{stall.location}`\n"
+                        f"**Count:** {stall.count}, **total** {stall.total:.2f}s, **worst** {stall.worst * 1000:.0f} ms"
+                    )[:1024],
+                    inline=False
+                )
+            if stalls and stalls[0].stack:
+                # Keep the innermost frames, an embed field holds 1024 characters
+                embed.add_field(name="Worst stack", value=f"```{stalls[0].stack[-1000:]}```", inline=False)
+            embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
+            if reset:
+                watchdog.reset()
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("❌ An error occurred while reading the profiling data.", ephemeral=True)
+
     @sync_commands.error
     async def sync_commands_error(self, ctx, error):
         if isinstance(error, commands.MissingRole):
@@ -185,6 +347,27 @@ class Moderation(commands.Cog):
         else:
             await interaction.response.send_message("❌ An error occurred while muting the user.", ephemeral=True)
 
+    @poll_status.error
+    async def poll_status_error(self, interaction: discord.Interaction, error):
+        if isinstance(error, app_commands.CheckFailure):
+            await interaction.response.send_message("❌ You don't have permission to view the polling state.", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ An error occurred while reading the polling state.", ephemeral=True)
+
+    @guild_setup.error
+    async def guild_setup_error(self, interaction: discord.Interaction, error):
+        if isinstance(error, app_commands.CheckFailure):
+            await interaction.response.send_message("❌ You don't have permission to change the server settings.", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ An error occurred while saving the server settings.", ephemeral=True)
+
+    @perf.error
+    async def perf_error(self, interaction: discord.Interaction, error):
+        if isinstance(error, app_commands.CheckFailure):
+            await interaction.response.send_message("❌ You don't have permission to view the profiling data.", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ An error occurred while reading the profiling data.", ephemeral=True)
+
 
 async def setup(bot):
     await bot.add_cog(Moderation(bot))
\ No newline at end of file
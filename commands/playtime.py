@@ -3,10 +3,113 @@ from discord.ext import commands, tasks
 from discord import app_commands
 from datetime import datetime, timezone
 import traceback
+import asyncio
+
+from collections import OrderedDict
+
+from database import link_player, reset_guild_playtime
+from guilds import staff_only
+from usernames import search_usernames
+from leaderboard import (
+    PERIODS, LeaderboardCache, build_leaderboard_embed, fetch_leaderboard_page, fetch_leaderboard_rank,
+    fetch_period_leaderboard
+)
+
+PAGE_SIZE = 10
+
+class LeaderboardView(discord.ui.View):
+    """Previous/Next/My rank buttons of the /leaderboard browser."""
+    def __init__(self, bot):
+        super().__init__(timeout=None)
+        self.bot = bot
+        # message id -> (rank of the first row, rows shown), only the most recent messages are kept
+        self.pages = OrderedDict()
+        self.max_pages = 500
+
+    def build_embed(self, start_rank, rows):
+        shown = [(username, playtime) for uid, username, playtime in rows]
+        return build_leaderboard_embed("🏆 Leaderboard - All Time", shown, self.bot.LOGS_THUMBNAIL, start_rank=start_rank)
+
+    def remember(self, message_id, start_rank, rows):
+        self.pages[message_id] = (start_rank, rows)
+        self.pages.move_to_end(message_id)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    async def show(self, interaction, start_rank, rows):
+        await interaction.response.edit_message(embed=self.build_embed(start_rank, rows), view=self)
+        self.remember(interaction.message.id, start_rank, rows)
+
+    async def first_page(self, interaction):
+        await self.show(interaction, 1, await fetch_leaderboard_page(self.bot.db, interaction.guild_id, limit=PAGE_SIZE))
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, custom_id="leaderboard_prev")
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        try:
+            page = self.pages.get(interaction.message.id)
+            # Pages are forgotten on restart, start over from the top
+            if page is None or page[0] <= 1 or not page[1]:
+                await self.first_page(interaction)
+                return
+
+            start_rank, rows = page
+            first = rows[0]
+            previous_rows = await fetch_leaderboard_page(self.bot.db, interaction.guild_id, before=(first[2], first[0]), limit=PAGE_SIZE)
+            if not previous_rows:
+                await self.first_page(interaction)
+                return
+            await self.show(interaction, max(1, start_rank - len(previous_rows)), previous_rows)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("An error occurred while loading the leaderboard.", ephemeral=True)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, custom_id="leaderboard_next")
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        try:
+            page = self.pages.get(interaction.message.id)
+            if page is None or not page[1]:
+                await self.first_page(interaction)
+                return
+
+            start_rank, rows = page
+            last = rows[-1]
+            next_rows = await fetch_leaderboard_page(self.bot.db, interaction.guild_id, after=(last[2], last[0]), limit=PAGE_SIZE)
+            if not next_rows:
+                await interaction.response.send_message("This is the last page.", ephemeral=True)
+                return
+            await self.show(interaction, start_rank + len(rows), next_rows)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("An error occurred while loading the leaderboard.", ephemeral=True)
+
+    @discord.ui.button(label="My rank", style=discord.ButtonStyle.primary, custom_id="leaderboard_me")
+    async def my_rank(self, interaction: discord.Interaction, button: discord.ui.Button):
+        try:
+            guild_id = interaction.guild_id
+            link = await self.bot.links.resolve(self.bot.db, guild_id, interaction.user.id)
+            ranked = await fetch_leaderboard_rank(self.bot.db, guild_id, link.uuid) if link else None
+            if not ranked:
+                await interaction.response.send_message("You have not linked your account yet. Use `/link` to link.", ephemeral=True)
+                return
+
+            rank, row = ranked
+            # Show the page the player is on, same page boundaries as paging from the top
+            start_rank = (rank - 1) // PAGE_SIZE * PAGE_SIZE + 1
+            before = await fetch_leaderboard_page(self.bot.db, guild_id, before=(row[2], row[0]), limit=rank - start_rank) if rank > start_rank else []
+            after = await fetch_leaderboard_page(self.bot.db, guild_id, after=(row[2], row[0]), limit=PAGE_SIZE - len(before) - 1)
+            await self.show(interaction, rank - len(before), list(before) + [row] + list(after))
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.response.send_message("An error occurred while finding your rank.", ephemeral=True)
 
 class Playtime(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.leaderboard_view = LeaderboardView(bot)
+
+    async def cog_load(self):
+        # Keeps the buttons of earlier /leaderboard messages working after a restart
+        self.bot.add_view(self.leaderboard_view)
 
     @app_commands.command(name='playtime', description='Displays the total playtime of a user.')
     @app_commands.describe(member='The member to get playtime for.')
@@ -14,21 +117,17 @@ class Playtime(commands.Cog):
         """Displays the total playtime of the mentioned user."""
         try:
             await interaction.response.defer()
-            c = self.bot.conn.cursor()
-            c.execute('SELECT uuid FROM discord_users WHERE discord_id = ?', (str(member.id),))
-            link = c.fetchone()
+            link = await self.bot.links.resolve(self.bot.db, interaction.guild_id, member.id)
             
             if not link:
                 await interaction.followup.send(f"{member.display_name} has not linked their UUID. Use `/linkuuid` to link.")
                 return
             
-            uuid = link[0]
-            
-            c.execute('SELECT playtime FROM players WHERE uid = ?', (uuid,))
-            result = c.fetchone()
+            result = await self.bot.db.fetchone('SELECT playtime FROM players WHERE uid = ?', (link.uuid,))
         
             if result:
-                playtime_seconds = result[0]
+                # Counted from the guild's last leaderboard reset
+                playtime_seconds = max(0, result[0] - link.playtime_offset)
                 playtime_formatted = self.convert_seconds_to_hms(playtime_seconds)
                 embed = discord.Embed(
                     title=f"📊 {member.display_name}'s Playtime",
@@ -36,6 +135,8 @@ class Playtime(commands.Cog):
                     timestamp=datetime.now(timezone.utc)
                 )
                 embed.set_author(name=interaction.user.display_name, icon_url=interaction.user.display_avatar.url if interaction.user.display_avatar else None)
+                if link.username:
+                    embed.add_field(name='Username', value=link.username, inline=False)
                 embed.add_field(name='Total Playtime', value=playtime_formatted, inline=False)
                 embed.set_footer(
                     text="CNR Crew Bot by penk", 
@@ -70,31 +171,38 @@ class Playtime(commands.Cog):
     async def link(self, interaction: discord.Interaction, username: str):
         try:
             await interaction.response.defer()
-            c = self.bot.conn.cursor()
-            c.execute('SELECT uid FROM players WHERE username = ?', (username,))
-            result = c.fetchone()
+            # Case-insensitive, an exact match wins if several players only differ in case.
+            # Archived players are found too, link_player moves them back.
+            result = await self.bot.db.fetchone('''
+                SELECT uid, username FROM (
+                    SELECT uid, username FROM players WHERE username = ? COLLATE NOCASE
+                    UNION ALL
+                    SELECT uid, username FROM players_archive WHERE username = ? COLLATE NOCASE
+                )
+                ORDER BY username = ? DESC
+                LIMIT 1
+            ''', (username, username, username))
 
             if not result:
                 await interaction.followup.send(f"No UUID found for username '{username}'.", ephemeral=True)
                 return
 
-            uuid = result[0]
+            uuid, username = result
+            guild_id = interaction.guild_id
             discord_id = str(interaction.user.id)
 
-            # Check if UUID is already linked
-            c.execute('SELECT discord_id FROM discord_users WHERE uuid = ?', (uuid,))
-            existing = c.fetchone()
-            if existing and existing[0] != discord_id:
+            # Check if UUID is already linked in this server
+            owner = self.bot.links.owner(guild_id, uuid)
+            if owner is not None and owner != discord_id:
                 await interaction.followup.send("That username is already linked to another Discord account.", ephemeral=True)
                 return
 
             # Link the UUID to this Discord ID
-            c.execute('''
-                INSERT INTO discord_users (discord_id, uuid)
-                VALUES (?, ?)
-                ON CONFLICT(discord_id) DO UPDATE SET uuid=excluded.uuid
-            ''', (discord_id, uuid))
-            self.bot.conn.commit()
+            previous, offset = await self.bot.db.write(link_player, guild_id, discord_id, uuid)
+            self.bot.links.link(guild_id, discord_id, uuid, username, previous, offset)
+            board = self.bot.leaderboards.get(guild_id)
+            if board:
+                await board.rebuild(self.bot.db)
 
             embed = discord.Embed(
                 title="✅ Successfully Linked",
@@ -108,6 +216,19 @@ class Playtime(commands.Cog):
             traceback.print_exc()
             await interaction.followup.send("❌ An error occurred while linking the username.", ephemeral=True)
 
+    @link.autocomplete('username')
+    async def link_username_autocomplete(self, interaction: discord.Interaction, current: str):
+        """Known usernames starting with what was typed, then usernames containing it."""
+        names = self.bot.usernames.complete(current, limit=25)
+        if len(names) < 25:
+            try:
+                # Discord drops autocomplete answers after 3 seconds
+                found = await asyncio.wait_for(search_usernames(self.bot.db, current, limit=25), timeout=2.0)
+            except asyncio.TimeoutError:
+                found = []
+            names += [name for name in found if name not in names]
+        return [app_commands.Choice(name=name, value=name) for name in names[:25]]
+
     @link.error
     async def link_error(self, interaction: discord.Interaction, error):
         if isinstance(error, app_commands.CheckFailure):
@@ -115,14 +236,56 @@ class Playtime(commands.Cog):
         else:
             await interaction.response.send_message("An error occurred while linking your UUID.", ephemeral=True)
 
+    @app_commands.command(name='leaderboard', description='Browse the playtime leaderboard or show the top players of a period.')
+    @app_commands.describe(period='The period to show the leaderboard for, all time if left empty.')
+    @app_commands.choices(period=[
+        app_commands.Choice(name="Last 24 hours", value="day"),
+        app_commands.Choice(name="Last 7 days", value="week"),
+        app_commands.Choice(name="Last 30 days", value="month"),
+        app_commands.Choice(name="All time", value="all")
+    ])
+    async def leaderboard(self, interaction: discord.Interaction, period: app_commands.Choice[str] = None):
+        """Pages through all linked players, or displays the top 10 linked players of a period."""
+        try:
+            await interaction.response.defer()
+            if period is None or period.value == 'all':
+                rows = await fetch_leaderboard_page(self.bot.db, interaction.guild_id, limit=PAGE_SIZE)
+                view = self.leaderboard_view
+                message = await interaction.followup.send(embed=view.build_embed(1, rows), view=view, wait=True)
+                view.remember(message.id, 1, rows)
+                return
+
+            settings = self.bot.guild_settings.get(interaction.guild_id)
+            rows = await fetch_period_leaderboard(
+                self.bot.db, interaction.guild_id, period.value, datetime.now(timezone.utc),
+                reset_at=settings.reset_at if settings else None
+            )
+            title = PERIODS[period.value][0]
+            embed = build_leaderboard_embed(f"🏆 Top 10 Players - {title}", rows, self.bot.LOGS_THUMBNAIL)
+            await interaction.followup.send(embed=embed)
+        except Exception as e:
+            traceback.print_exc()
+            await interaction.followup.send("An error occurred while retrieving the leaderboard.")
+
+    @leaderboard.error
+    async def leaderboard_error(self, interaction: discord.Interaction, error):
+        await interaction.response.send_message("An error occurred while processing the leaderboard command.", ephemeral=True)
+
     @app_commands.command(name='resetleaderboard', description='Reset all players\' playtime to 0 (Staff only).')
     @app_commands.default_permissions(administrator=True)
+    @app_commands.check(staff_only)
     async def reset_leaderboard(self, interaction: discord.Interaction):
-        """Reset all players' playtime to 0."""
+        """Reset the playtime of this server's players to 0, other servers keep theirs."""
         try:
-            c = self.bot.conn.cursor()
-            c.execute('UPDATE players SET playtime = 0')
-            self.bot.conn.commit()
+            guild_id = interaction.guild_id
+            now = datetime.now(timezone.utc).timestamp()
+            await self.bot.db.write(reset_guild_playtime, guild_id, now)
+            settings = self.bot.guild_settings.get(guild_id)
+            if settings:
+                settings.reset_at = now
+            await self.bot.links.load(self.bot.db)
+            board = self.bot.leaderboards.setdefault(guild_id, LeaderboardCache(guild_id))
+            await board.rebuild(self.bot.db)
             await interaction.response.send_message("✅ All player playtimes have been reset to 0.", ephemeral=True)
         except Exception as e:
             traceback.print_exc()
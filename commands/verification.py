@@ -1,55 +1,12 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import ButtonStyle, Embed
-import random
-import string
-from PIL import Image, ImageDraw, ImageFont
 import io
-import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import functools
 import traceback
-import sqlite3
+import time
 
-def random_string():
-    """Generate a random 5-character string for the captcha."""
-    N = 5
-    s = string.ascii_uppercase + string.ascii_lowercase + string.digits
-    return ''.join(random.choices(s, k=N))
-
-def getit():
-    """Get a random coordinate for drawing lines/points in the captcha."""
-    return (random.randrange(5, 85), random.randrange(5, 55))
-
-# Colors for captcha text and noise
-colors = ["black", "red", "blue", "green", (64,107,76), (0,87,128), (0,3,82)]
-fill_color = [(64,107,76), (0,87,128), (0,3,82), (191,0,255), (72,189,0), (189,107,0), (189,41,0)]
-
-def gen_captcha_img():
-    """Generate a captcha image and the corresponding string."""
-    img = Image.new('RGB', (90, 60), color="white")
-    draw = ImageDraw.Draw(img)
-    captcha_str = random_string()
-    text_colors = random.choice(colors)
-    font_name = "arial.ttf"  # Ensure this font is available
-    try:
-        font = ImageFont.truetype(font_name, 18)
-    except IOError:
-        font = ImageFont.load_default()
-    draw.text((20, 20), captcha_str, fill=text_colors, font=font)
-
-    # Add random lines for noise
-    for i in range(5, random.randrange(6, 10)):
-        draw.line((getit(), getit()), fill=random.choice(fill_color), width=random.randrange(1, 3))
-
-    # Add random points for noise
-    for i in range(10, random.randrange(11, 20)):
-        draw.point((getit(), getit()), fill=random.choice(colors))
-
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-
-    return buffer, captcha_str
+from verification_sessions import VerificationSessions
 
 class VerificationView(discord.ui.View):
     """View containing the verification button."""
@@ -60,6 +17,21 @@ class VerificationView(discord.ui.View):
     @discord.ui.button(label="Verify", style=discord.ButtonStyle.green, custom_id="verify_button")
     async def verify_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         user = interaction.user
+        cog = self.bot.get_cog("VerificationCog")
+
+        # One session per member, repeated clicks don't send new captchas
+        blocked = cog.sessions.reserve(user.id, time.time())
+        if blocked:
+            if blocked == 'active':
+                description = "You already have a captcha waiting in your DMs."
+            else:
+                description = "Please wait a moment before trying again."
+            await interaction.response.send_message(
+                embed=discord.Embed(title="Verification Pending", description=description, color=discord.Color.orange()),
+                ephemeral=True
+            )
+            return
+
         embed = discord.Embed(
             title="Verification Started",
             description="The verification process has started. Check your DMs.",
@@ -70,8 +42,12 @@ class VerificationView(discord.ui.View):
         if 'verification' in self.bot.config and 'logo_url' in self.bot.config['verification']:
             embed.set_thumbnail(url=self.bot.config['verification']['logo_url'])
             
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        await self.bot.get_cog("VerificationCog").verify_user(user)
+        try:
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+        except Exception:
+            cog.sessions.release(user.id)
+            raise
+        await cog.verify_user(user)
 
 class VerificationCog(commands.Cog):
     """Cog for handling user verification with captchas."""
@@ -85,27 +61,33 @@ class VerificationCog(commands.Cog):
             
         self.enabled = True
         self.config = bot.config['verification']
-        self.channel_id = int(self.config['verification_channel_id'])
-        self.verified_role_id = int(self.config['verified_role_id'])
+        # The verification channel and verified role are guild settings, see /guildsetup
         self.logo_url = self.config['logo_url']
-        self.scheduler = AsyncIOScheduler()
-        self.verification_message = None
-        
-        # Set up verification_message table if it doesn't exist
-        conn = self.bot.conn
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS verification_message (
-                    id INTEGER PRIMARY KEY CHECK (id = 1),
-                    message_id INTEGER,
-                    channel_id INTEGER
-                )
-            ''')
-            conn.commit()
-        except sqlite3.OperationalError as e:
-            print(f"Error setting up verification table: {e}")
-            traceback.print_exc()
+        # Pillow is only imported when verification is enabled
+        from captcha import CaptchaPool
+        self.captchas = CaptchaPool(
+            size=int(self.config.get('captcha_pool_size', 20)),
+            workers=int(self.config.get('captcha_workers', 2))
+        )
+        self.sessions = VerificationSessions(
+            bot.db,
+            timeout=300,
+            cooldown=int(self.config.get('cooldown', 30))
+        )
+
+    async def cog_load(self):
+        if self.enabled:
+            self.captchas.start()
+            # Captchas sent before a restart can still be answered
+            restored = await self.sessions.load(time.time())
+            if restored:
+                print(f"Restored {restored} pending verification sessions")
+            self.expire_sessions.start()
+
+    async def cog_unload(self):
+        if self.enabled:
+            self.expire_sessions.cancel()
+            await self.captchas.close()
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -114,19 +96,23 @@ class VerificationCog(commands.Cog):
             return
             
         await self.check_and_send_verification_message()
-        self.scheduler.start()
 
     async def check_and_send_verification_message(self):
-        """Check if verification message exists, if not create one."""
+        """Post or update the verification message of every guild that has a verification channel."""
+        for settings in self.bot.guild_settings:
+            if settings.verification_channel_id:
+                await self.post_verification_message(settings)
+
+    async def post_verification_message(self, settings):
+        """Check if the verification message of a guild exists, if not create one."""
         try:
-            channel = self.bot.get_channel(self.channel_id)
+            channel = self.bot.get_channel(settings.verification_channel_id)
             if not channel:
-                print(f"Verification channel {self.channel_id} not found")
+                print(f"Verification channel {settings.verification_channel_id} of guild {settings.guild_id} not found")
                 return
                 
-            cursor = self.bot.conn.cursor()
-            cursor.execute('SELECT message_id FROM verification_message WHERE id = 1')
-            result = cursor.fetchone()
+            result = await self.bot.db.fetchone('SELECT message_id FROM verification_message WHERE guild_id = ?',
+                                                (settings.guild_id,))
             
             view = VerificationView(self.bot)
             embed = discord.Embed(
@@ -142,43 +128,46 @@ class VerificationCog(commands.Cog):
             embed.set_footer(text="Verification may take a moment.")
             embed.set_thumbnail(url=self.logo_url)
             
-            if result:
-                message_id = result[0]
-                try:
-                    # Try to get the existing message
-                    message = await channel.fetch_message(message_id)
-                    # Update the existing message
-                    await message.edit(embed=embed, view=view)
-                    self.verification_message = message
-                    return
-                except discord.NotFound:
-                    # Message not found, will create a new one
-                    pass
-            
-            # Create a new verification message
-            new_message = await channel.send(embed=embed, view=view)
-            self.verification_message = new_message
-            
-            # Save the message ID
-            if result:
-                cursor.execute('UPDATE verification_message SET message_id = ? WHERE id = 1', (new_message.id,))
-            else:
-                cursor.execute('INSERT INTO verification_message (id, message_id, channel_id) VALUES (1, ?, ?)',
-                              (new_message.id, self.channel_id))
-            self.bot.conn.commit()
+            # Goes through the edit scheduler like every other message the bot keeps up to date
+            await self.bot.edit_scheduler.submit(
+                ('verification', settings.guild_id), channel.id,
+                functools.partial(self.send_verification_message, channel, settings.guild_id, result, embed, view)
+            )
             
         except Exception as e:
             print(f"Error setting up verification message: {e}")
             traceback.print_exc()
 
+    async def send_verification_message(self, channel, guild_id, result, embed, view):
+        """Edit the stored verification message of a guild or post a new one."""
+        if result:
+            message_id = result[0]
+            try:
+                # Update the existing message without fetching it first
+                message = await channel.get_partial_message(message_id).edit(embed=embed, view=view)
+                return message.id
+            except discord.NotFound:
+                # Message not found or in the guild's previous channel, will create a new one
+                pass
+        
+        # Create a new verification message
+        new_message = await channel.send(embed=embed, view=view)
+        
+        # Save the message ID
+        await self.bot.db.execute('''
+            INSERT INTO verification_message (guild_id, message_id, channel_id) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id) DO UPDATE SET message_id = excluded.message_id, channel_id = excluded.channel_id
+        ''', (guild_id, new_message.id, channel.id))
+        return new_message.id
+
     async def verify_user(self, user: discord.Member):
-        """Process verification for a user with captcha."""
+        """Send a member a captcha and register their verification session."""
         if not self.enabled:
             return
             
         try:
-            # Generate captcha
-            buffer, captcha_str = gen_captcha_img()
+            # Pre-rendered off the event loop
+            png, captcha_str = await self.captchas.get()
             
             # Send captcha to user
             embed = discord.Embed(
@@ -194,14 +183,8 @@ class VerificationCog(commands.Cog):
             )
             embed.set_footer(text="You have 5 minutes to complete this verification.")
             
-            # Create a copy of the buffer for the file
-            file_buffer = io.BytesIO()
-            buffer.seek(0) 
-            file_buffer.write(buffer.read())
-            file_buffer.seek(0) 
-            
-            # Send the captcha image as a file with the embed
-            captcha_file = discord.File(fp=file_buffer, filename='captcha.png')
+            # Send the captcha image as a file with the embed, BytesIO shares the bytes instead of copying them
+            captcha_file = discord.File(fp=io.BytesIO(png), filename='captcha.png')
             
             try:
                 await user.send(embed=embed, file=captcha_file)
@@ -213,85 +196,135 @@ class VerificationCog(commands.Cog):
                     color=discord.Color.red()
                 )
                 error_embed.set_thumbnail(url=self.logo_url)
-                guild_channel = self.bot.get_channel(self.channel_id)
-                await guild_channel.send(content=user.mention, embed=error_embed, delete_after=10)
+                settings = self.bot.guild_settings.get(user.guild.id)
+                guild_channel = self.bot.get_channel(settings.verification_channel_id) if settings else None
+                if guild_channel:
+                    await guild_channel.send(content=user.mention, embed=error_embed, delete_after=10)
                 return
 
-            def check(m):
-                return m.author == user and isinstance(m.channel, discord.DMChannel)
-
-            try:
-                msg = await self.bot.wait_for('message', check=check, timeout=300)
+            # The answer arrives through on_message
+            await self.sessions.start(user.id, user.guild.id, captcha_str, time.time())
                 
-                # Check if captcha is correct
-                if msg.content.strip() != captcha_str:
-                    embed = discord.Embed(
-                        title="Incorrect Captcha",
-                        description="Verification failed. Please try again.",
-                        color=discord.Color.red()
-                    )
-                    embed.set_thumbnail(url=self.logo_url)
-                    await user.send(embed=embed)
-                    return
-                    
-            except asyncio.TimeoutError:
+        except Exception as e:
+            print(f"Error in verification process: {e}")
+            traceback.print_exc()
+            await self.send_error(user)
+        finally:
+            self.sessions.release(user.id)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        """Route DM answers to the sender's verification session."""
+        if not self.enabled or message.guild is not None or message.author.bot:
+            return
+        session = self.sessions.get(message.author.id)
+        if session is None:
+            return
+
+        user = message.author
+        try:
+            if message.content.strip() != session.answer:
+                await self.sessions.end(user.id, time.time(), failed=True)
                 embed = discord.Embed(
-                    title="Timeout",
-                    description="Verification failed due to timeout.",
+                    title="Incorrect Captcha",
+                    description="Verification failed. Please try again.",
                     color=discord.Color.red()
                 )
                 embed.set_thumbnail(url=self.logo_url)
                 await user.send(embed=embed)
                 return
 
-            # Verification successful, add role
-            verified_role = user.guild.get_role(self.verified_role_id)
-            if verified_role:
-                await user.add_roles(verified_role)
-                
-                # Log verification to staff logs if configured
-                if hasattr(self.bot, 'LOG_CHANNEL_ID'):
-                    log_channel = self.bot.get_channel(self.bot.LOG_CHANNEL_ID)
-                    if log_channel:
-                        log_embed = discord.Embed(
-                            title="User Verified",
-                            description=f"{user.mention} ({user.name}) has been verified.",
-                            color=discord.Color.green(),
-                            timestamp=discord.utils.utcnow()
-                        )
-                        log_embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
-                        await log_channel.send(embed=log_embed)
-                
-                embed = discord.Embed(
-                    title="Verification Successful",
-                    description="You have been verified!",
-                    color=discord.Color.green()
-                )
-                embed.set_thumbnail(url=self.logo_url)
-                await user.send(embed=embed)
-            else:
+            await self.sessions.end(user.id, time.time())
+            guild = self.bot.get_guild(session.guild_id)
+            member = guild.get_member(user.id) if guild else None
+            if member is None and guild is not None:
+                try:
+                    member = await guild.fetch_member(user.id)
+                except discord.NotFound:
+                    pass
+            if member is None:
+                # The bot left the server or the member did since the captcha was sent
                 embed = discord.Embed(
-                    title="Role Not Found",
-                    description="Please contact an admin to set up the verified role.",
+                    title="Verification Expired",
+                    description="You are no longer in the server you started verifying in. Join it again and click Verify.",
                     color=discord.Color.red()
                 )
                 embed.set_thumbnail(url=self.logo_url)
                 await user.send(embed=embed)
-                
+                return
+            await self.complete_verification(member)
         except Exception as e:
             print(f"Error in verification process: {e}")
             traceback.print_exc()
-            
+            await self.send_error(user)
+
+    @tasks.loop(seconds=1)
+    async def expire_sessions(self):
+        """Tell members whose captcha ran out."""
+        for session in await self.sessions.expire(time.time()):
             try:
+                user = self.bot.get_user(session.user_id) or await self.bot.fetch_user(session.user_id)
                 embed = discord.Embed(
-                    title="Error",
-                    description="An error occurred during verification. Contact an admin.",
+                    title="Timeout",
+                    description="Verification failed due to timeout.",
                     color=discord.Color.red()
                 )
                 embed.set_thumbnail(url=self.logo_url)
                 await user.send(embed=embed)
-            except:
+            except discord.HTTPException:
                 pass
+            except Exception as e:
+                print(f"Error expiring verification session: {e}")
+                traceback.print_exc()
+
+    async def complete_verification(self, user: discord.Member):
+        """Give a member who solved their captcha the verified role."""
+        # Verification successful, add the verified role of the member's guild
+        settings = self.bot.guild_settings.get(user.guild.id)
+        verified_role = user.guild.get_role(settings.verified_role_id) if settings and settings.verified_role_id else None
+        if verified_role:
+            await user.add_roles(verified_role)
+            
+            # Log verification to the staff logs of the member's guild if it has them
+            moderation = self.bot.get_cog('Moderation')
+            log_channel = moderation.log_channel(user.guild.id) if moderation else None
+            if log_channel:
+                log_embed = discord.Embed(
+                    title="User Verified",
+                    description=f"{user.mention} ({user.name}) has been verified.",
+                    color=discord.Color.green(),
+                    timestamp=discord.utils.utcnow()
+                )
+                log_embed.set_footer(text="CNR Crew Bot by penk", icon_url=self.bot.LOGS_THUMBNAIL)
+                await log_channel.send(embed=log_embed)
+            
+            embed = discord.Embed(
+                title="Verification Successful",
+                description="You have been verified!",
+                color=discord.Color.green()
+            )
+            embed.set_thumbnail(url=self.logo_url)
+            await user.send(embed=embed)
+        else:
+            embed = discord.Embed(
+                title="Role Not Found",
+                description="Please contact an admin to set up the verified role.",
+                color=discord.Color.red()
+            )
+            embed.set_thumbnail(url=self.logo_url)
+            await user.send(embed=embed)
+
+    async def send_error(self, user):
+        try:
+            embed = discord.Embed(
+                title="Error",
+                description="An error occurred during verification. Contact an admin.",
+                color=discord.Color.red()
+            )
+            embed.set_thumbnail(url=self.logo_url)
+            await user.send(embed=embed)
+        except:
+            pass
 
 async def setup(bot):
     """Add the verification cog to the bot if enabled."""
@@ -0,0 +1,799 @@
+import asyncio
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Migrations
+def _migration_1(conn):
+    """Base schema, matches what setup_database created before migrations existed."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            uid TEXT PRIMARY KEY,
+            username TEXT,
+            playtime INTEGER DEFAULT 0,
+            last_seen TEXT,
+            server TEXT,
+            is_online INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS discord_users (
+            discord_id TEXT PRIMARY KEY,
+            uuid TEXT UNIQUE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS online_users_embed (
+            server TEXT PRIMARY KEY,
+            message_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard_embed (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            message_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS verification_message (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            message_id INTEGER,
+            channel_id INTEGER
+        )
+    ''')
+
+def _migration_2(conn):
+    """Index for /link, which looks usernames up case-insensitively.
+
+    Who is online comes from the roster and the leaderboards are read from
+    discord_users, so players has no other index that every poll would have
+    to keep up to date.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_players_username_nocase ON players (username COLLATE NOCASE)')
+    conn.execute('ANALYZE')
+
+def _migration_3(conn):
+    """Append-only session log, one row per continuous stay of a player on a server."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            uid TEXT NOT NULL,
+            server TEXT,
+            start TEXT NOT NULL,
+            end TEXT,
+            seconds INTEGER DEFAULT 0,
+            playtime_start INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_uid ON sessions (uid, start)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions (uid) WHERE end IS NULL')
+
+def _migration_4(conn):
+    """Pre-summed playtime per player per hour and per day for the period leaderboards."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS playtime_hourly (
+            uid TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            seconds INTEGER DEFAULT 0,
+            PRIMARY KEY (uid, hour)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS playtime_daily (
+            uid TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            seconds INTEGER DEFAULT 0,
+            PRIMARY KEY (uid, day)
+        ) WITHOUT ROWID
+    ''')
+    # Only used to prune old buckets
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_playtime_hourly_hour ON playtime_hourly (hour)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_playtime_daily_day ON playtime_daily (day)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS period_leaderboard_embed (
+            period TEXT PRIMARY KEY,
+            message_id INTEGER
+        )
+    ''')
+
+def _migration_5(conn):
+    """Linked flag on players, set while the player is linked in any guild, retention never archives them."""
+    conn.execute('ALTER TABLE players ADD COLUMN linked INTEGER DEFAULT 0')
+    conn.execute('UPDATE players SET linked = 1 WHERE uid IN (SELECT uuid FROM discord_users)')
+
+def _migration_6(conn):
+    """Trigram index for username search."""
+    # External content table, the usernames are only stored once in players
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS players_fts
+        USING fts5(username, content='players', content_rowid='rowid', tokenize='trigram')
+    ''')
+    # The ingest's player writes keep the index current, renames are the only updates that touch it
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS players_fts_insert AFTER INSERT ON players BEGIN
+            INSERT INTO players_fts (rowid, username) VALUES (new.rowid, new.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS players_fts_update AFTER UPDATE OF username ON players
+        WHEN old.username IS NOT new.username BEGIN
+            INSERT INTO players_fts (players_fts, rowid, username) VALUES ('delete', old.rowid, old.username);
+            INSERT INTO players_fts (rowid, username) VALUES (new.rowid, new.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS players_fts_delete AFTER DELETE ON players BEGIN
+            INSERT INTO players_fts (players_fts, rowid, username) VALUES ('delete', old.rowid, old.username);
+        END
+    ''')
+    conn.execute("INSERT INTO players_fts (players_fts) VALUES ('rebuild')")
+
+def _migration_7(conn):
+    """Pending verification captchas, so they survive a restart."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS verification_sessions (
+            user_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            answer TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_8(conn):
+    """Several Discord servers: per guild settings, links and embed messages.
+
+    Existing rows get guild_id 0 and are taken over by the guild in config.yml
+    on startup (adopt_legacy_rows), migrations can't read the config.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id INTEGER PRIMARY KEY,
+            online_users_channel_id INTEGER,
+            leaderboard_channel_id INTEGER,
+            staff_logs_channel_id INTEGER,
+            staff_role_id INTEGER,
+            crewmember_role_id INTEGER,
+            reset_at REAL
+        )
+    ''')
+
+    # A link belongs to one guild. playtime_offset is the player's playtime when the guild last reset its leaderboard.
+    conn.execute('ALTER TABLE discord_users RENAME TO discord_users_old')
+    conn.execute('''
+        CREATE TABLE discord_users (
+            guild_id INTEGER NOT NULL,
+            discord_id TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            playtime_offset INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, discord_id),
+            UNIQUE (guild_id, uuid)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO discord_users (guild_id, discord_id, uuid)
+        SELECT 0, discord_id, uuid FROM discord_users_old WHERE uuid IS NOT NULL
+    ''')
+    conn.execute('DROP TABLE discord_users_old')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_discord_users_uuid ON discord_users (uuid)')
+
+    conn.execute('ALTER TABLE online_users_embed RENAME TO online_users_embed_old')
+    conn.execute('''
+        CREATE TABLE online_users_embed (
+            guild_id INTEGER NOT NULL,
+            server TEXT NOT NULL,
+            message_id INTEGER,
+            PRIMARY KEY (guild_id, server)
+        )
+    ''')
+    conn.execute('INSERT INTO online_users_embed SELECT 0, server, message_id FROM online_users_embed_old')
+    conn.execute('DROP TABLE online_users_embed_old')
+
+    conn.execute('ALTER TABLE leaderboard_embed RENAME TO leaderboard_embed_old')
+    conn.execute('''
+        CREATE TABLE leaderboard_embed (
+            guild_id INTEGER PRIMARY KEY,
+            message_id INTEGER
+        )
+    ''')
+    conn.execute('INSERT INTO leaderboard_embed SELECT 0, message_id FROM leaderboard_embed_old')
+    conn.execute('DROP TABLE leaderboard_embed_old')
+
+    conn.execute('ALTER TABLE period_leaderboard_embed RENAME TO period_leaderboard_embed_old')
+    conn.execute('''
+        CREATE TABLE period_leaderboard_embed (
+            guild_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            message_id INTEGER,
+            PRIMARY KEY (guild_id, period)
+        )
+    ''')
+    conn.execute('INSERT INTO period_leaderboard_embed SELECT 0, period, message_id FROM period_leaderboard_embed_old')
+    conn.execute('DROP TABLE period_leaderboard_embed_old')
+
+def _migration_9(conn):
+    """Archive for players that never linked and haven't been seen for a long time, see retention.py."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS players_archive (
+            uid TEXT PRIMARY KEY,
+            username TEXT,
+            playtime INTEGER DEFAULT 0,
+            last_seen TEXT,
+            server TEXT,
+            archived_at TEXT
+        )
+    ''')
+    # /link finds archived players by their exact username
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_players_archive_username_nocase ON players_archive (username COLLATE NOCASE)')
+
+def _migration_10(conn):
+    """Keep each link's playtime as its guild counts it, so guild leaderboards are read in index order.
+
+    playtime - playtime_offset differs per link, ordering by it sorted every
+    linked member of the guild on each page and rank lookup.
+    """
+    conn.execute('ALTER TABLE discord_users ADD COLUMN playtime INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        UPDATE discord_users
+        SET playtime = COALESCE((SELECT playtime FROM players WHERE uid = discord_users.uuid), 0) - playtime_offset
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_discord_users_guild_playtime ON discord_users (guild_id, playtime DESC, uuid DESC)')
+
+def _migration_11(conn):
+    """Verification channel and verified role per guild, with one verification message per guild.
+
+    The existing verification message gets guild_id 0 and is taken over by the
+    guild in config.yml on startup (adopt_legacy_rows), like the rows of migration 8.
+    """
+    conn.execute('ALTER TABLE guild_settings ADD COLUMN verification_channel_id INTEGER')
+    conn.execute('ALTER TABLE guild_settings ADD COLUMN verified_role_id INTEGER')
+
+    conn.execute('ALTER TABLE verification_message RENAME TO verification_message_old')
+    conn.execute('''
+        CREATE TABLE verification_message (
+            guild_id INTEGER PRIMARY KEY,
+            message_id INTEGER,
+            channel_id INTEGER
+        )
+    ''')
+    conn.execute('INSERT INTO verification_message SELECT 0, message_id, channel_id FROM verification_message_old')
+    conn.execute('DROP TABLE verification_message_old')
+
+def _migration_12(conn):
+    """Seconds each link had in the hour and day bucket its guild reset in, see reset_guild_playtime."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS period_reset_offsets (
+            guild_id INTEGER NOT NULL,
+            uid TEXT NOT NULL,
+            hour_seconds INTEGER NOT NULL DEFAULT 0,
+            day_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, uid)
+        ) WITHOUT ROWID
+    ''')
+
+# Index in this list + 1 is the PRAGMA user_version a migration upgrades to, only ever append
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+    _migration_12,
+]
+
+def migrate(path):
+    """Create or upgrade the database file at path to the latest schema version."""
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            # Free pages can be given back to the file system later (Retention), only settable before the first table
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            print(f"Database migrated to version {number}")
+
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Files from before incremental vacuum need one full VACUUM to switch, this can take a while once
+            print("Converting the database to incremental vacuum...")
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+def count_guilds(path):
+    """Number of guilds in guild_settings, read before the bot is created to decide whether it is sharded."""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM guild_settings').fetchone()[0]
+    finally:
+        conn.close()
+
+class Database:
+    """Async access to the bot database.
+
+    Writes are queued to a single writer thread which runs them in batches and
+    commits each batch once (group commit). Reads run on a small pool of
+    read-only WAL connections so they never wait for a commit to finish.
+    Job and commit times are recorded in metrics (a metrics.Metrics) if given.
+    """
+    def __init__(self, path, read_connections=3, max_batch=64, cache_size_kb=16384, mmap_size_mb=128, synchronous='NORMAL', metrics=None):
+        self.path = path
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.pragmas = {
+            # Negative cache_size is in KiB instead of pages
+            'cache_size': -int(cache_size_kb),
+            'mmap_size': int(mmap_size_mb) * 1024 * 1024,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 5000,
+        }
+        self.synchronous = synchronous
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._read_connections = queue.Queue()
+        self._read_connection_count = read_connections
+        self._read_executor = ThreadPoolExecutor(max_workers=read_connections, thread_name_prefix='db-read')
+        self._closed = False
+
+    def start(self):
+        """Open the writer connection and read pool. The database schema must already exist."""
+        writer_conn = self._connect()
+        writer_conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last commits on power loss, never corruption
+        writer_conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        writer_conn.isolation_level = None
+
+        for _ in range(self._read_connection_count):
+            self._read_connections.put(self._connect(read_only=True))
+
+        self._writer = threading.Thread(target=self._writer_loop, args=(writer_conn,), name='db-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self, read_only=False):
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma}={value}')
+        return conn
+
+    # Writes
+    def _writer_loop(self, conn):
+        while True:
+            job = self._write_queue.get()
+            if job is None:
+                break
+
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._write_queue.put(None)
+                    break
+                batch.append(job)
+
+            results = []
+            try:
+                # IMMEDIATE takes the write lock up front, waiting on busy_timeout. A deferred transaction that read
+                # first fails with "database is locked" if the other process (bot or ingest worker) wrote meanwhile.
+                conn.execute('BEGIN IMMEDIATE')
+                for fn, args, loop, future in batch:
+                    # Each job gets its own savepoint so one failing job doesn't undo the rest of the batch
+                    conn.execute('SAVEPOINT job')
+                    start = time.perf_counter()
+                    try:
+                        results.append((loop, future, fn(conn, *args), None))
+                        conn.execute('RELEASE job')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO job')
+                        conn.execute('RELEASE job')
+                        results.append((loop, future, None, e))
+                    if self.metrics:
+                        self.metrics.db_seconds.observe(time.perf_counter() - start, 'write', _job_name(fn, args))
+                start = time.perf_counter()
+                conn.execute('COMMIT')
+                if self.metrics:
+                    self.metrics.db_commit_seconds.observe(time.perf_counter() - start)
+            except Exception as e:
+                traceback.print_exc()
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                results = [(loop, future, None, e) for fn, args, loop, future in batch]
+
+            for loop, future, result, error in results:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+
+        conn.close()
+
+    async def write(self, fn, *args):
+        """Run fn(conn, *args) on the writer thread and wait until its batch is committed."""
+        if self._closed:
+            raise RuntimeError('Database is closed')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._write_queue.put((fn, args, loop, future))
+        return await future
+
+    async def execute(self, sql, params=()):
+        """Run a single write statement, returns the number of changed rows."""
+        return await self.write(_execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        """Run a write statement for every parameter set, returns the number of changed rows."""
+        return await self.write(_executemany, sql, list(seq_of_params))
+
+    # Reads
+    def _run_read(self, fn, args):
+        conn = self._read_connections.get()
+        start = time.perf_counter()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._read_connections.put(conn)
+            if self.metrics:
+                self.metrics.db_seconds.observe(time.perf_counter() - start, 'read', _job_name(fn, args))
+
+    async def read(self, fn, *args):
+        """Run fn(conn, *args) on a pooled read-only connection."""
+        if self._closed:
+            raise RuntimeError('Database is closed')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(_fetchall, sql, params)
+
+    def queue_depth(self):
+        """Write jobs waiting for the writer thread."""
+        return self._write_queue.qsize()
+
+    def close(self):
+        """Flush queued writes and close every connection."""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        if self._writer:
+            self._writer.join()
+        self._read_executor.shutdown(wait=True)
+        while not self._read_connections.empty():
+            self._read_connections.get_nowait().close()
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+# sql -> metrics label, the statements are constants so this stays small
+_statement_names = {}
+
+def _job_name(fn, args):
+    """Metrics label of a job, e.g. "SELECT players" for the plain execute/fetch helpers."""
+    if fn not in (_execute, _executemany, _fetchone, _fetchall) or not args:
+        return getattr(fn, '__name__', 'job')
+    sql = args[0]
+    name = _statement_names.get(sql)
+    if name is None:
+        words = sql.split(None, 1)
+        table = _STATEMENT_TABLE.search(sql)
+        name = _statement_names[sql] = ' '.join(filter(None, (
+            words[0].upper() if words else fn.__name__, table.group(1) if table else None
+        )))
+    return name
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+def _executemany(conn, sql, seq_of_params):
+    return conn.executemany(sql, seq_of_params).rowcount
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+def store_roster_delta(conn, delta, seen_at, tracked_uids=()):
+    """Persist one poll from a RosterDelta, only touching rows that changed or earned playtime.
+
+    Runs as a Database.write job. Every player that stayed online gets the
+    playtime the roster credited them added to players.playtime, which is kept
+    as the running total of their sessions. tracked_uids are the linked players
+    that earned playtime this poll, only their links and rollup buckets are
+    updated, the period leaderboards only ever show linked players. Returns
+    {uid: playtime} with their new totals, which is how the leaderboard cache
+    learns about them.
+    """
+    c = conn.cursor()
+
+    if delta.joined:
+        # Archived players come back with their playtime before they are updated like everyone else
+        restore_archived_players(conn, [uid for uid, username, server in delta.joined])
+        c.executemany('''
+            INSERT INTO players (uid, username, last_seen, server, is_online, playtime)
+            VALUES (?, ?, ?, ?, 1, 0)
+            ON CONFLICT(uid) DO UPDATE SET
+                username = excluded.username,
+                last_seen = excluded.last_seen,
+                server = excluded.server,
+                is_online = 1
+        ''', [(uid, username, seen_at, server) for uid, username, server in delta.joined])
+
+    changed = [(username, new_server, uid) for uid, username, old_server, new_server in delta.switched]
+    changed += [(username, server, uid) for uid, username, server in delta.renamed]
+    if changed:
+        c.executemany('UPDATE players SET username = ?, server = ? WHERE uid = ?', changed)
+
+    if delta.stayed:
+        c.executemany('''
+            UPDATE players SET playtime = playtime + ?, last_seen = ?, is_online = 1
+            WHERE uid = ?
+        ''', [(seconds, seen_at, uid) for uid, seconds in delta.stayed])
+
+    tracked = set(tracked_uids)
+    linked = [(seconds, uid) for uid, seconds in delta.stayed if seconds > 0 and uid in tracked]
+    if linked:
+        # Links keep the playtime their guild counts next to the leaderboard index, it moves with players.playtime
+        c.executemany('UPDATE discord_users SET playtime = playtime + ? WHERE uuid = ?', linked)
+        hour, day = rollup_buckets(datetime.fromisoformat(seen_at))
+        c.executemany('''
+            INSERT INTO playtime_hourly (uid, hour, seconds) VALUES (?, ?, ?)
+            ON CONFLICT(uid, hour) DO UPDATE SET seconds = seconds + excluded.seconds
+        ''', [(uid, hour, seconds) for seconds, uid in linked])
+        c.executemany('''
+            INSERT INTO playtime_daily (uid, day, seconds) VALUES (?, ?, ?)
+            ON CONFLICT(uid, day) DO UPDATE SET seconds = seconds + excluded.seconds
+        ''', [(uid, day, seconds) for seconds, uid in linked])
+
+    if delta.left:
+        c.executemany('UPDATE players SET is_online = 0 WHERE uid = ?', [(uid,) for uid, server in delta.left])
+
+    # Close before opening, a player switching server has both
+    if delta.closed:
+        c.executemany('''
+            UPDATE sessions SET end = ?, seconds = ?
+            WHERE uid = ? AND end IS NULL
+        ''', [(end.isoformat(), seconds, uid) for uid, server, end, seconds in delta.closed])
+    if delta.opened:
+        # playtime_start lets a session left open by a crash be closed with its exact playtime
+        c.executemany('''
+            INSERT INTO sessions (uid, server, start, playtime_start)
+            VALUES (?, ?, ?, (SELECT playtime FROM players WHERE uid = ?))
+        ''', [(uid, server, start.isoformat(), uid) for uid, server, start in delta.opened])
+
+    totals = {}
+    for seconds, uid in linked:
+        row = c.execute('SELECT playtime FROM players WHERE uid = ?', (uid,)).fetchone()
+        if row:
+            totals[uid] = row[0]
+    return totals
+
+def close_open_sessions(conn):
+    """Close sessions left open by a crash at the player's last_seen time.
+
+    Runs as a Database.write job on startup. The playtime of those sessions was
+    already added to players.playtime poll by poll, so the session's seconds are
+    whatever the total grew by since it started.
+    """
+    return conn.execute('''
+        UPDATE sessions SET
+            end = (SELECT last_seen FROM players WHERE players.uid = sessions.uid),
+            seconds = MAX(0, (SELECT playtime FROM players WHERE players.uid = sessions.uid) - playtime_start)
+        WHERE end IS NULL
+    ''').rowcount
+
+def resume_sessions(conn, uids):
+    """Keep the open sessions of the players in uids and close every other one like close_open_sessions.
+
+    Runs as a Database.write job when the roster is restored from a snapshot on
+    startup. The players whose session is still open are marked online again,
+    returns the set of their uids.
+    """
+    open_uids = {row[0] for row in conn.execute('SELECT uid FROM sessions WHERE end IS NULL')}
+    kept = open_uids.intersection(uids)
+    conn.executemany('''
+        UPDATE sessions SET
+            end = (SELECT last_seen FROM players WHERE players.uid = sessions.uid),
+            seconds = MAX(0, (SELECT playtime FROM players WHERE players.uid = sessions.uid) - playtime_start)
+        WHERE uid = ? AND end IS NULL
+    ''', [(uid,) for uid in open_uids - kept])
+    conn.execute('UPDATE players SET is_online = 0 WHERE is_online = 1')
+    conn.executemany('UPDATE players SET is_online = 1 WHERE uid = ?', [(uid,) for uid in kept])
+    return kept
+
+def save_state(conn, key, value):
+    """Store a JSON serialisable value in bot_metadata. Runs as a Database.write job."""
+    conn.execute('''
+        INSERT INTO bot_metadata (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    ''', (key, json.dumps(value)))
+
+def load_state(conn, key):
+    """Value stored with save_state, None if there is none. Runs as a Database.read job."""
+    row = conn.execute('SELECT value FROM bot_metadata WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+def rollup_buckets(when):
+    """(hour, day) bucket numbers of a timezone aware datetime, counted from the unix epoch."""
+    timestamp = int(when.timestamp())
+    return timestamp // 3600, timestamp // 86400
+
+def prune_rollups(conn, now, keep_hours=48, keep_days=400):
+    """Drop rollup buckets no period leaderboard reads anymore. Runs as a Database.write job."""
+    hour, day = rollup_buckets(now)
+    removed = conn.execute('DELETE FROM playtime_hourly WHERE hour < ?', (hour - keep_hours,)).rowcount
+    removed += conn.execute('DELETE FROM playtime_daily WHERE day < ?', (day - keep_days,)).rowcount
+    return removed
+
+def link_player(conn, guild_id, discord_id, uuid):
+    """Link a Discord account to a player in a guild, returns (previous uuid or None, playtime_offset).
+
+    Runs as a Database.write job so discord_users and players.linked (linked in
+    any guild) always change together. In a guild that has reset its leaderboard
+    the player's playtime counts from when they link.
+    """
+    restore_archived_players(conn, [uuid])
+    previous = conn.execute(
+        'SELECT uuid, playtime_offset FROM discord_users WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id)
+    ).fetchone()
+    if previous and previous[0] == uuid:
+        return uuid, previous[1]
+
+    row = conn.execute('SELECT playtime FROM players WHERE uid = ?', (uuid,)).fetchone()
+    playtime = row[0] if row else 0
+    reset = conn.execute('SELECT reset_at FROM guild_settings WHERE guild_id = ?', (guild_id,)).fetchone()
+    offset = playtime if reset and reset[0] is not None else 0
+
+    conn.execute('''
+        INSERT INTO discord_users (guild_id, discord_id, uuid, playtime_offset, playtime)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(guild_id, discord_id) DO UPDATE SET
+            uuid = excluded.uuid,
+            playtime_offset = excluded.playtime_offset,
+            playtime = excluded.playtime
+    ''', (guild_id, discord_id, uuid, offset, playtime - offset))
+    if previous:
+        conn.execute('''
+            UPDATE players SET linked = EXISTS (SELECT 1 FROM discord_users WHERE uuid = ?) WHERE uid = ?
+        ''', (previous[0], previous[0]))
+    conn.execute('UPDATE players SET linked = 1 WHERE uid = ?', (uuid,))
+    return (previous[0] if previous else None), offset
+
+def reset_guild_playtime(conn, guild_id, now):
+    """Start a guild's leaderboards over without touching the playtime other guilds see.
+
+    Runs as a Database.write job. Every link of the guild gets the player's
+    current playtime as its offset. The period leaderboards count the rollup
+    buckets from the one reset_at falls in, the seconds already in that hour
+    and day are kept in period_reset_offsets and subtracted.
+    """
+    conn.execute('''
+        UPDATE discord_users
+        SET playtime_offset = COALESCE((SELECT playtime FROM players WHERE uid = discord_users.uuid), 0), playtime = 0
+        WHERE guild_id = ?
+    ''', (guild_id,))
+    hour, day = rollup_buckets(datetime.fromtimestamp(now, timezone.utc))
+    conn.execute('DELETE FROM period_reset_offsets WHERE guild_id = ?', (guild_id,))
+    conn.execute('''
+        INSERT INTO period_reset_offsets (guild_id, uid, hour_seconds, day_seconds)
+        SELECT guild_id, uid, hour_seconds, day_seconds FROM (
+            SELECT d.guild_id, d.uuid AS uid,
+                   COALESCE((SELECT seconds FROM playtime_hourly WHERE uid = d.uuid AND hour = ?), 0) AS hour_seconds,
+                   COALESCE((SELECT seconds FROM playtime_daily WHERE uid = d.uuid AND day = ?), 0) AS day_seconds
+            FROM discord_users d WHERE d.guild_id = ?
+        ) WHERE hour_seconds > 0 OR day_seconds > 0
+    ''', (hour, day, guild_id))
+    conn.execute('''
+        INSERT INTO guild_settings (guild_id, reset_at) VALUES (?, ?)
+        ON CONFLICT(guild_id) DO UPDATE SET reset_at = excluded.reset_at
+    ''', (guild_id, now))
+
+def adopt_legacy_rows(conn, guild_id):
+    """Give the links and embed messages from before multi-guild support (guild_id 0) to guild_id.
+
+    Runs as a Database.write job on startup, returns the number of rows taken over.
+    """
+    adopted = 0
+    for table in ('discord_users', 'online_users_embed', 'leaderboard_embed', 'period_leaderboard_embed',
+                  'verification_message'):
+        adopted += conn.execute(f'UPDATE OR IGNORE {table} SET guild_id = ? WHERE guild_id = 0', (guild_id,)).rowcount
+    return adopted
+
+def archive_players(conn, cutoff, archived_at, after_rowid=0, batch=1000):
+    """Move players that aren't linked anywhere and weren't seen since cutoff into players_archive.
+
+    Runs as a Database.write job and only looks at the batch players after
+    after_rowid, so a sweep of a big table never holds the writer for long.
+    Returns (players moved, rowid to continue after or None once the sweep is done).
+    """
+    rows = conn.execute('''
+        SELECT rowid, uid,
+               linked = 0 AND is_online = 0 AND (last_seen IS NULL OR last_seen < ?)
+               AND NOT EXISTS (SELECT 1 FROM discord_users WHERE uuid = players.uid)
+        FROM players WHERE rowid > ? ORDER BY rowid LIMIT ?
+    ''', (cutoff, after_rowid, batch)).fetchall()
+    if not rows:
+        return 0, None
+
+    inactive = [(uid,) for rowid, uid, archive in rows if archive]
+    if inactive:
+        conn.executemany('''
+            INSERT OR REPLACE INTO players_archive (uid, username, playtime, last_seen, server, archived_at)
+            SELECT uid, username, playtime, last_seen, server, ? FROM players WHERE uid = ?
+        ''', [(archived_at, uid) for uid, in inactive])
+        conn.executemany('DELETE FROM players WHERE uid = ?', inactive)
+    return len(inactive), (rows[-1][0] if len(rows) == batch else None)
+
+def restore_archived_players(conn, uids):
+    """Move the players in uids that were archived back into players, returns how many came back.
+
+    Called from the write jobs that need the players row, store_roster_delta
+    when they are seen again and link_player. A player that got a new players
+    row while archived keeps it, with the archived playtime added.
+    """
+    rows = [(uid,) for uid in uids]
+    if not rows:
+        return 0
+    restored = conn.executemany('''
+        INSERT INTO players (uid, username, playtime, last_seen, server, is_online, linked)
+        SELECT uid, username, playtime, last_seen, server, 0, 0 FROM players_archive WHERE uid = ?
+        ON CONFLICT(uid) DO UPDATE SET playtime = players.playtime + excluded.playtime
+    ''', rows).rowcount
+    if restored:
+        conn.executemany('DELETE FROM players_archive WHERE uid = ?', rows)
+    return restored
+
+def incremental_vacuum(conn, pages):
+    """Give up to pages free pages back to the file system. Runs as a Database.write job.
+
+    Returns (pages freed, free pages left).
+    """
+    before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # Python's sqlite3 only steps a pragma once, and incremental_vacuum frees one page per step
+    for _ in range(min(pages, before)):
+        conn.execute('PRAGMA incremental_vacuum(1)')
+    after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return before - after, after
+
+def analyze(conn, analysis_limit=1000):
+    """Refresh the query planner statistics from a sample of each index. Runs as a Database.write job."""
+    conn.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+    conn.execute('ANALYZE')
@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import traceback
+from collections import deque
+
+import aiohttp
+import discord
+
+# Headers of the Discord responses the current request got, filled in by rate_limit_trace()
+_response_headers = contextvars.ContextVar('discord_response_headers', default=None)
+
+def rate_limit_trace():
+    """aiohttp TraceConfig that hands every Discord response's headers to the request that made it.
+
+    Passed to the bot as http_trace, EditScheduler.watch reads them back.
+    """
+    async def on_request_end(session, context, params):
+        headers = _response_headers.get()
+        if headers is not None:
+            headers.append(params.response.headers)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+class RouteBucket:
+    """Rate limits of one route (a channel), from the X-RateLimit-* headers Discord answers with.
+
+    A channel's requests can fall into several Discord buckets (editing and
+    sending messages), each is tracked by its X-RateLimit-Bucket hash. Until
+    the route has answered at all it is paced with a guess of `limit` requests
+    per `window` seconds.
+    """
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.sent = deque()
+        self.blocked_until = 0.0
+        # Bucket hash -> (requests remaining, loop time the bucket resets)
+        self.buckets = {}
+
+    def ready_at(self, now):
+        """Loop time at which the next request on this route may be sent."""
+        ready = self.blocked_until
+        if self.buckets:
+            for remaining, reset_at in self.buckets.values():
+                if remaining <= 0 and reset_at > now:
+                    ready = max(ready, reset_at)
+            return ready
+
+        while self.sent and now - self.sent[0] >= self.window:
+            self.sent.popleft()
+        if len(self.sent) >= self.limit:
+            ready = max(ready, self.sent[0] + self.window)
+        return ready
+
+    def record(self, now):
+        self.sent.append(now)
+
+    def update(self, bucket, remaining, reset_at):
+        """Discord reported how many requests are left in a bucket of this route and when it resets."""
+        self.buckets[bucket] = (remaining, reset_at)
+
+    def block(self, now, retry_after):
+        """Discord answered 429, nothing goes out on this route until retry_after has passed."""
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+
+class _Job:
+    __slots__ = ('route', 'send', 'future')
+
+    def __init__(self, route, send, future):
+        self.route = route
+        self.send = send
+        self.future = future
+
+class EditScheduler:
+    """Single outbound queue for every message the bot keeps up to date.
+
+    Updates are keyed by the message they target. If a key still has an update
+    waiting, a newer one replaces it and only the newest is sent (latest wins).
+    Requests are paced per channel so callers never have to sleep. With watch()
+    the pacing follows the X-RateLimit-Bucket, -Remaining and -Reset-After
+    headers of every response in the channel, route_limit requests per
+    route_window seconds is only used for a channel that hasn't answered yet.
+    discord.py still waits out and retries 429s itself, the 429 handling below
+    only runs if it gives up.
+    """
+    def __init__(self, route_limit=5, route_window=5.0):
+        self.route_limit = route_limit
+        self.route_window = route_window
+        self._pending = {}
+        self._order = deque()
+        self._buckets = {}
+        self._wakeup = None
+        self._task = None
+        # Job whose send is awaited right now
+        self._sending = None
+
+    def start(self):
+        """Start the sender task, must be called from the running event loop."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for job in self._pending.values():
+            if not job.future.done():
+                job.future.cancel()
+        self._pending.clear()
+        self._order.clear()
+
+    def submit(self, key, route, send):
+        """Queue the coroutine function send for the message identified by key.
+
+        Returns a future that resolves with send's result once it (or a newer
+        update for the same key) has gone out. Errors other than rate limits are
+        printed and resolve the future with None, send should handle the errors it
+        cares about (e.g. a deleted message) itself.
+        """
+        job = self._pending.get(key)
+        if job is not None:
+            # Latest wins, whoever waited on the old update now waits on this one
+            job.route = route
+            job.send = send
+            return job.future
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = _Job(route, send, future)
+        self._order.append(key)
+        self._wakeup.set()
+        return future
+
+    def watch(self, http):
+        """Feed the rate limit headers of every request made through the bot's HTTPClient into the routes.
+
+        The bot has to be created with http_trace=rate_limit_trace(), otherwise
+        no headers arrive and every route stays on the guess.
+        """
+        request = http.request
+
+        async def request_with_rate_limits(route, **kwargs):
+            headers = []
+            token = _response_headers.set(headers)
+            try:
+                return await request(route, **kwargs)
+            finally:
+                _response_headers.reset(token)
+                # discord.py retries after a 429, the last response is the current state of the bucket
+                if headers and route.channel_id is not None:
+                    self.observe(int(route.channel_id), headers[-1])
+
+        http.request = request_with_rate_limits
+
+    def observe(self, route, headers):
+        """Update a route from one response's headers, routes nothing was queued for are ignored."""
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            return
+        try:
+            name = headers['X-RateLimit-Bucket']
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_after = float(headers['X-RateLimit-Reset-After'])
+        except (KeyError, ValueError):
+            return
+        bucket.update(name, remaining, asyncio.get_running_loop().time() + reset_after)
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    async def join(self):
+        """Wait until every update queued so far has gone out (or failed)."""
+        futures = [job.future for job in self._pending.values()]
+        if self._sending is not None:
+            futures.append(self._sending.future)
+        if futures:
+            await asyncio.wait(futures)
+
+    def _bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = RouteBucket(self.route_limit, self.route_window)
+        return bucket
+
+    def _next_ready(self, now):
+        """Return (key, None) for the oldest job that may be sent now, or (None, seconds until one can)."""
+        wait = None
+        for key in self._order:
+            ready_at = self._bucket(self._pending[key].route).ready_at(now)
+            if ready_at <= now:
+                return key, None
+            if wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return None, wait
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._order:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            key, wait = self._next_ready(now)
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._order.remove(key)
+            job = self._pending.pop(key)
+            bucket = self._bucket(job.route)
+            bucket.record(now)
+
+            self._sending = job
+            try:
+                result = await job.send()
+            except (discord.RateLimited, discord.HTTPException) as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is None and getattr(e, 'status', None) == 429:
+                    retry_after = float(e.response.headers.get('Retry-After', self.route_window))
+                if retry_after is None:
+                    print(f"Discord request for {key} failed: {e}")
+                    _resolve(job.future, None)
+                    continue
+
+                bucket.block(loop.time(), retry_after)
+                if key in self._pending:
+                    # A newer update arrived while this one was in flight, it takes over
+                    _chain(job.future, self._pending[key].future)
+                else:
+                    self._pending[key] = job
+                    self._order.appendleft(key)
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"Discord request for {key} failed:")
+                traceback.print_exc()
+                result = None
+            finally:
+                self._sending = None
+
+            _resolve(job.future, result)
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _chain(source, target):
+    """Resolve source with whatever target ends up resolving with."""
+    def copy(done):
+        if not source.done():
+            if done.cancelled():
+                source.cancel()
+            else:
+                source.set_result(done.result())
+    target.add_done_callback(copy)
@@ -0,0 +1,92 @@
+from discord import app_commands
+
+class GuildSettings:
+    """Channels and roles the bot uses in one Discord server."""
+    __slots__ = (
+        'guild_id', 'online_users_channel_id', 'leaderboard_channel_id', 'staff_logs_channel_id',
+        'staff_role_id', 'crewmember_role_id', 'verification_channel_id', 'verified_role_id', 'reset_at'
+    )
+    # Columns /guildsetup can change
+    FIELDS = (
+        'online_users_channel_id', 'leaderboard_channel_id', 'staff_logs_channel_id', 'staff_role_id', 'crewmember_role_id',
+        'verification_channel_id', 'verified_role_id'
+    )
+
+    def __init__(self, guild_id, online_users_channel_id=None, leaderboard_channel_id=None, staff_logs_channel_id=None,
+                 staff_role_id=None, crewmember_role_id=None, verification_channel_id=None, verified_role_id=None,
+                 reset_at=None):
+        self.guild_id = guild_id
+        self.online_users_channel_id = online_users_channel_id
+        self.leaderboard_channel_id = leaderboard_channel_id
+        self.staff_logs_channel_id = staff_logs_channel_id
+        self.staff_role_id = staff_role_id
+        self.crewmember_role_id = crewmember_role_id
+        self.verification_channel_id = verification_channel_id
+        self.verified_role_id = verified_role_id
+        # Unix time the guild last reset its leaderboard, None if it never did
+        self.reset_at = reset_at
+
+class GuildRegistry:
+    """Settings of every guild the bot serves, loaded from guild_settings and kept in memory.
+
+    Every guild shares the same ingest, only what is shown where differs.
+    """
+    def __init__(self):
+        self.guilds = {}
+
+    async def load(self, db):
+        rows = await db.fetchall(f'''
+            SELECT guild_id, {', '.join(GuildSettings.FIELDS)}, reset_at FROM guild_settings
+        ''')
+        self.guilds = {row[0]: GuildSettings(*row) for row in rows}
+
+    def __iter__(self):
+        return iter(list(self.guilds.values()))
+
+    def __len__(self):
+        return len(self.guilds)
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    async def save(self, db, settings):
+        """Write the settings of a guild and start serving it."""
+        values = [getattr(settings, field) for field in GuildSettings.FIELDS]
+        await db.execute(f'''
+            INSERT INTO guild_settings (guild_id, {', '.join(GuildSettings.FIELDS)}) VALUES ({', '.join('?' * (len(values) + 1))})
+            ON CONFLICT(guild_id) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in GuildSettings.FIELDS)}
+        ''', (settings.guild_id, *values))
+        self.guilds[settings.guild_id] = settings
+
+    async def seed(self, db, settings):
+        """Add a guild with these settings, e.g. the guild from config.yml.
+
+        A guild that is already configured only takes the settings it doesn't
+        have yet, so settings added in a later version are filled in from the config.
+        """
+        current = self.guilds.get(settings.guild_id)
+        if current is None:
+            await self.save(db, settings)
+            return
+        missing = [field for field in GuildSettings.FIELDS
+                   if getattr(current, field) is None and getattr(settings, field) is not None]
+        if missing:
+            for field in missing:
+                setattr(current, field, getattr(settings, field))
+            await self.save(db, current)
+
+def is_staff(member, settings):
+    """Whether a member may use the staff commands in the guild settings belongs to.
+
+    Members with the guild's staff role are, and so are administrators, so a
+    new server can run /guildsetup before it has a staff role.
+    """
+    if member.guild_permissions.administrator:
+        return True
+    return bool(settings and settings.staff_role_id and any(role.id == settings.staff_role_id for role in member.roles))
+
+async def staff_only(interaction):
+    """app_commands check for the staff commands, uses the staff role of the guild the command is used in."""
+    if interaction.guild is not None and is_staff(interaction.user, interaction.client.guild_settings.get(interaction.guild_id)):
+        return True
+    raise app_commands.CheckFailure("You do not have the required role to use this command.")
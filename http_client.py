@@ -0,0 +1,39 @@
+import aiohttp
+
+class HttpClient:
+    """Long-lived HTTP sessions shared by every outbound request the bot makes.
+
+    The CNR api (api.gtacnr.net) is reached over verified TLS, while the FiveM
+    info.json endpoints are raw IPs whose certificates can't be verified, so
+    each gets its own connection pool and TLS settings.
+    """
+    def __init__(self, config=None):
+        config = config or {}
+        self.limit_per_host = int(config.get('limit_per_host', 10))
+        self.keepalive_timeout = float(config.get('keepalive_timeout', 75))
+        self.dns_cache_ttl = int(config.get('dns_cache_ttl', 300))
+        self.api = None
+        self.status = None
+
+    def _connector(self, **kwargs):
+        return aiohttp.TCPConnector(
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+            **kwargs
+        )
+
+    async def start(self):
+        """Create the sessions, must be called from the running event loop."""
+        if self.api is None:
+            self.api = aiohttp.ClientSession(connector=self._connector())
+        if self.status is None:
+            self.status = aiohttp.ClientSession(connector=self._connector(ssl=False))
+
+    async def close(self):
+        for session in (self.api, self.status):
+            if session is not None and not session.closed:
+                await session.close()
+        self.api = None
+        self.status = None
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+from datetime import datetime, timezone
+
+import aiohttp
+import yaml
+
+from database import Database, close_open_sessions, load_state, migrate, resume_sessions, save_state, store_roster_delta
+from http_client import HttpClient
+from metrics import Metrics, MetricsServer
+from player_stream import stream_players
+from poller import PollScheduler
+from retention import Retention
+from roster import Roster
+
+# bot_metadata key of the state the worker saves for a warm restart
+SNAPSHOT_KEY = 'ingest_snapshot'
+SNAPSHOT_INTERVAL = 120
+
+def load_config(path=None):
+    # CNR_BOT_CONFIG points at another config file, e.g. for the benchmarks
+    path = path or os.environ.get('CNR_BOT_CONFIG') or os.path.join(os.path.dirname(__file__), 'config.yml')
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
+def open_database(config, metrics=None):
+    """Migrate and open the database in config.yml, used by the bot and the worker."""
+    database_config = config['database']
+    migrate(database_config['name'])
+    db = Database(
+        database_config['name'],
+        read_connections=int(database_config.get('read_connections', 3)),
+        cache_size_kb=int(database_config.get('cache_size_kb', 16384)),
+        mmap_size_mb=int(database_config.get('mmap_size_mb', 128)),
+        synchronous=database_config.get('synchronous', 'NORMAL'),
+        metrics=metrics
+    )
+    db.start()
+    return db
+
+def build_poller(config, metrics=None):
+    """PollScheduler with the player list and status endpoints of every server in config.yml."""
+    poller = PollScheduler(config.get('ingest', {}), metrics=metrics)
+    for server, url in config['endpoints'].items():
+        poller.add(server, url)
+    poller.add('status', config.get('server_status_endpoint'))
+    for server in config['endpoints'].keys():
+        status_endpoint = config.get('status_endpoints', {}).get(f'server_name {server.upper()}')
+        if status_endpoint:
+            poller.add(f'status:{server}', status_endpoint, session='status')
+    return poller
+
+def socket_path(config):
+    return config.get('worker', {}).get('socket', 'cnr-ingest.sock')
+
+class Ingest:
+    """Polls the CNR endpoints that are due and persists what changed.
+
+    The same pipeline runs inside the bot, or in the worker process when
+    worker.enabled is set. It owns the roster and the open sessions, whoever
+    runs it is the only one that may write them.
+    """
+    def __init__(self, config, db, poller, roster, http_client):
+        ingest_config = config.get('ingest', {})
+        self.servers = list(config['endpoints'].keys())
+        self.db = db
+        self.poller = poller
+        self.roster = roster
+        self.http_client = http_client
+        self.max_concurrency = int(ingest_config.get('max_concurrency', 5))
+        self.connect_timeout = float(ingest_config.get('connect_timeout', 5))
+        self.read_timeout = float(ingest_config.get('read_timeout', 10))
+        self.endpoint_timeouts = ingest_config.get('endpoint_timeouts', {})
+        self.busy_players = int(ingest_config.get('busy_players', 100))
+
+    def split(self, endpoints):
+        """(player list endpoints, status endpoints) of the given endpoints."""
+        return ([endpoint for endpoint in endpoints if endpoint.name in self.servers],
+                [endpoint for endpoint in endpoints if endpoint.name not in self.servers])
+
+    async def fetch_server_players(self, semaphore, endpoint):
+        """Poll the player list of a single server, returns a list of PlayerRecord or None on failure."""
+        timeout_config = self.endpoint_timeouts.get(endpoint.name, {})
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=float(timeout_config.get('connect', self.connect_timeout)),
+            sock_read=float(timeout_config.get('read', self.read_timeout))
+        )
+        async with semaphore:
+            # Decoded while it downloads, straight into compact records
+            return await self.poller.fetch(
+                endpoint, self.http_client.api, timeout,
+                busy=lambda players: len(players) >= self.busy_players,
+                decode=stream_players
+            )
+
+    async def fetch_players(self, endpoints, linked):
+        """Poll the player lists of the servers that are due and write what changed.
+
+        linked is anything that supports `uid in linked`. Returns the RosterDelta
+        and {uid: playtime} of the linked players that earned playtime, or None
+        if nothing was polled.
+        """
+        if not endpoints:
+            return None
+
+        current_time = datetime.now(timezone.utc)
+        try:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            results = await asyncio.gather(*(
+                self.fetch_server_players(semaphore, endpoint)
+                for endpoint in endpoints
+            ))
+
+            # All due servers have been fetched, diff against the roster and only write what changed.
+            # Servers that weren't due keep their players until the next time they are polled.
+            fetched = {}
+            polled_servers = set()
+            for endpoint, players in zip(endpoints, results):
+                if players is None:
+                    continue
+                polled_servers.add(endpoint.name)
+                for player in players:
+                    fetched[player.uid] = (player.username, endpoint.name)
+
+            delta = self.roster.diff(fetched, polled_servers, current_time)
+            tracked_uids = [uid for uid, seconds in delta.stayed if seconds > 0 and uid in linked]
+            totals = await self.db.write(store_roster_delta, delta, current_time.isoformat(), tracked_uids)
+            # Only once it is stored, if the write failed the next poll diffs against the same roster again
+            self.roster.commit(delta, current_time)
+            return delta, totals
+        except Exception as e:
+            print(f"Global error in the player ingest: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    async def fetch_status(self, endpoints):
+        """Poll the player count/queue endpoint and the server info.json endpoints that are due."""
+        timeout = aiohttp.ClientTimeout(total=10)
+        await asyncio.gather(*(
+            self.poller.fetch(endpoint, getattr(self.http_client, endpoint.session), timeout)
+            for endpoint in endpoints
+        ))
+
+    def snapshot(self):
+        """The roster and the last status payloads, for a warm restart."""
+        return {
+            'roster': self.roster.snapshot(),
+            'status': {name: endpoint.data for name, endpoint in self.poller.endpoints.items()
+                       if name not in self.servers and endpoint.current() is not None},
+        }
+
+    def state_message(self):
+        """'state' message a new subscriber starts from, the whole roster and every endpoint."""
+        now = time.monotonic()
+        return {
+            'type': 'state',
+            'roster': self.roster.snapshot(),
+            'endpoints': {name: export_endpoint(endpoint, now, with_data=name not in self.servers)
+                          for name, endpoint in self.poller.endpoints.items()},
+        }
+
+    def poll_message(self, result, endpoints):
+        """'poll' message of one cycle, result is what fetch_players returned and endpoints were polled."""
+        now = time.monotonic()
+        message = {
+            'type': 'poll',
+            # Player lists stay in the worker, the bot only needs the roster changes
+            'endpoints': {endpoint.name: export_endpoint(endpoint, now, with_data=endpoint.name not in self.servers)
+                          for endpoint in endpoints},
+        }
+        if result is not None:
+            delta, totals = result
+            message.update(joined=delta.joined, switched=delta.switched, renamed=delta.renamed, left=delta.left,
+                           totals=list(totals.items()))
+        return message
+
+    def is_fresh(self, saved):
+        # Whoever was online longer ago than stale_after can't be assumed to still be
+        return bool(saved) and time.time() - saved['saved_at'] <= self.roster.stale_after
+
+    async def restore(self, saved):
+        """Carry on from a snapshot() saved less than stale_after ago, or start cold if saved is None.
+
+        Returns the number of players restored.
+        """
+        if not saved:
+            # The roster starts empty, make the database agree with it. Nobody gets credited for the downtime.
+            await self.db.write(close_open_sessions)
+            await self.db.execute('UPDATE players SET is_online = 0 WHERE is_online = 1')
+            return 0
+
+        # Like a few missed polls, playtime over the restart is credited up to max_playtime_gap
+        kept = await self.db.write(resume_sessions, [row[0] for row in saved['roster']])
+        restored = self.roster.restore(saved['roster'], kept)
+        for name, data in saved['status'].items():
+            endpoint = self.poller.get(name)
+            if endpoint and endpoint.data is None:
+                endpoint.data = data
+        return restored
+
+def export_endpoint(endpoint, now, with_data=False):
+    """Poll state of an endpoint as JSON, times relative to now since the monotonic clocks of two processes differ."""
+    state = {
+        'state': endpoint.state,
+        'failures': endpoint.failures,
+        'busy': endpoint.busy,
+        'next_poll': endpoint.next_poll - now,
+        'last_status': endpoint.last_status,
+        'last_error': endpoint.last_error,
+        'last_success': now - endpoint.last_success if endpoint.last_success else None,
+        'polls': endpoint.polls,
+        'not_modified': endpoint.not_modified,
+    }
+    if with_data:
+        state['data'] = endpoint.data
+    return state
+
+def import_endpoint(endpoint, state, now):
+    """Copy the poll state export_endpoint made into an endpoint of this process."""
+    endpoint.state = state['state']
+    endpoint.failures = state['failures']
+    endpoint.busy = state['busy']
+    endpoint.next_poll = now + state['next_poll']
+    endpoint.last_status = state['last_status']
+    endpoint.last_error = state['last_error']
+    endpoint.last_success = now - state['last_success'] if state['last_success'] is not None else None
+    endpoint.polls = state['polls']
+    endpoint.not_modified = state['not_modified']
+    if 'data' in state:
+        endpoint.data = state['data']
+
+class IngestPublisher:
+    """Unix socket the worker publishes its changes on, one JSON object per line.
+
+    A bot that connects first gets a 'state' message with the whole roster and
+    every endpoint, then a 'poll' message after every cycle with what changed.
+    A subscriber that stops reading is dropped instead of holding up the
+    ingest, it reconnects and starts over from a fresh 'state'.
+    """
+    def __init__(self, path, state, max_buffer=4 * 1024 * 1024):
+        self.path = path
+        # Called for the 'state' message of every new subscriber
+        self.state = state
+        self.max_buffer = max_buffer
+        self.writers = set()
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a worker that didn't shut down cleanly
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._connected, path=self.path)
+
+    async def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+        await self.server.wait_closed()
+        self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, message):
+        line = _encode(message)
+        for writer in list(self.writers):
+            self._send(writer, line)
+
+    async def _connected(self, reader, writer):
+        self.writers.add(writer)
+        self._send(writer, _encode(self.state()))
+        try:
+            # Subscribers never send anything, this returns once they disconnect
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def _send(self, writer, line):
+        if writer.is_closing():
+            self.writers.discard(writer)
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            print("Dropping an ingest subscriber that stopped reading")
+            self.writers.discard(writer)
+            writer.close()
+            return
+        writer.write(line)
+
+class IngestSubscriber:
+    """The bot's end of the worker's socket.
+
+    handler is awaited with every message, in order. The connection is retried
+    every retry seconds, so the worker and the bot can be started and restarted
+    in any order.
+    """
+    def __init__(self, path, handler, retry=2.0):
+        self.path = path
+        self.handler = handler
+        self.retry = retry
+        self.connected = False
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        warned = False
+        while True:
+            try:
+                # The first message holds the whole roster
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=64 * 1024 * 1024)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if not warned:
+                    print(f"Waiting for the ingest worker on {self.path}: {e}")
+                    warned = True
+                await asyncio.sleep(self.retry)
+                continue
+
+            print(f"Connected to the ingest worker on {self.path}")
+            warned = False
+            self.connected = True
+            try:
+                while line := await reader.readline():
+                    try:
+                        await self.handler(json.loads(line))
+                    except Exception:
+                        traceback.print_exc()
+            except (ConnectionError, ValueError) as e:
+                print(f"Ingest worker connection failed: {e}")
+            finally:
+                self.connected = False
+                writer.close()
+            print("Lost the connection to the ingest worker, reconnecting")
+            await asyncio.sleep(self.retry)
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+async def run_worker(config):
+    """Poll and write in this process and publish every cycle to the bot, until SIGINT or SIGTERM."""
+    ingest_config = config.get('ingest', {})
+    worker_config = config.get('worker', {})
+    metrics_config = config.get('metrics', {})
+    poll_tick = float(ingest_config.get('poll_tick', 5))
+
+    metrics = Metrics()
+    db = open_database(config, metrics)
+    http_client = HttpClient(config.get('http', {}))
+    poller = build_poller(config, metrics)
+    roster = Roster(
+        stale_after=int(ingest_config.get('stale_after', 300)),
+        max_gap=int(ingest_config.get('max_playtime_gap', 180))
+    )
+    ingest = Ingest(config, db, poller, roster, http_client)
+    publisher = IngestPublisher(socket_path(config), state=ingest.state_message)
+    retention = Retention(db, config.get('retention', {}), metrics)
+    retention_run = None
+    metrics.gauge('cnr_db_write_queue', 'Database write jobs waiting for the writer thread.', db.queue_depth)
+    metrics.gauge('cnr_players_online', 'Players online per server.',
+                  lambda: {(server,): len(roster.online(server)) for server in ingest.servers}, ('server',))
+    metrics.gauge('cnr_ingest_subscribers', 'Bot processes connected to the worker.', lambda: len(publisher.writers))
+    metrics_server = MetricsServer(
+        metrics,
+        host=metrics_config.get('host', '127.0.0.1'),
+        port=int(worker_config.get('metrics_port', 9465))
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async def save_snapshot():
+        try:
+            await db.write(save_state, SNAPSHOT_KEY, {'saved_at': time.time(), **ingest.snapshot()})
+        except Exception:
+            traceback.print_exc()
+
+    try:
+        await http_client.start()
+        saved = await db.read(load_state, SNAPSHOT_KEY)
+        try:
+            restored = await ingest.restore(saved if ingest.is_fresh(saved) else None)
+        except Exception:
+            # e.g. a snapshot saved by an older version, start cold
+            traceback.print_exc()
+            restored = await ingest.restore(None)
+        if restored:
+            print(f"Restored {restored} online players from the snapshot of {int(time.time() - saved['saved_at'])}s ago")
+        await retention.load()
+        await publisher.start()
+        if metrics_config.get('enabled', False):
+            await metrics_server.start()
+        print(f"Ingest worker publishing on {publisher.path}")
+
+        last_snapshot = time.monotonic()
+        while not stop.is_set():
+            due = poller.due()
+            if due:
+                start = time.perf_counter()
+                # The bot adds links, so who is linked is read again every cycle
+                linked = {uid for (uid,) in await db.fetchall('SELECT DISTINCT uuid FROM discord_users')}
+                players, status = ingest.split(due)
+                result, _ = await asyncio.gather(ingest.fetch_players(players, linked), ingest.fetch_status(status))
+                publisher.publish(ingest.poll_message(result, due))
+                metrics.record_task('ingest_cycle', time.perf_counter() - start, poll_tick)
+
+            if retention.due() and (retention_run is None or retention_run.done()):
+                # Many small write jobs, the polls keep going while it runs
+                retention_run = asyncio.create_task(retention.run())
+            if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                await save_snapshot()
+                last_snapshot = time.monotonic()
+            try:
+                await asyncio.wait_for(stop.wait(), poll_tick)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if retention_run is not None and not retention_run.done():
+            retention_run.cancel()
+        await save_snapshot()
+        await db.execute('UPDATE players SET is_online = 0 WHERE is_online = 1')
+        await publisher.close()
+        await metrics_server.close()
+        await http_client.close()
+        db.close()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run_worker(load_config()))
+    except Exception as e:
+        print(f"Ingest worker failed: {e}")
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,166 @@
+from datetime import datetime, timezone
+
+import discord
+
+from database import rollup_buckets
+
+# period -> (title, rollup table, bucket column, number of buckets)
+PERIODS = {
+    'day': ("Last 24 Hours", 'playtime_hourly', 'hour', 24),
+    'week': ("Last 7 Days", 'playtime_daily', 'day', 7),
+    'month': ("Last 30 Days", 'playtime_daily', 'day', 30),
+}
+
+class LeaderboardCache:
+    """Top players linked in a guild by playtime, kept up to date by the ingest instead of re-querying.
+
+    Only the top `size` players are held. A player outside of it only gets in
+    once their playtime beats the threshold, the playtime of the last place.
+    Playtimes are the guild's, i.e. minus the link's playtime_offset.
+    """
+    def __init__(self, guild_id, size=10):
+        self.guild_id = guild_id
+        self.size = size
+        # [uid, username, playtime], in leaderboard order (playtime then uid, both descending)
+        self.top = []
+
+    async def rebuild(self, db):
+        """Reload the top players from the database, e.g. on startup or after a reset."""
+        rows = await fetch_leaderboard_page(db, self.guild_id, limit=self.size)
+        self.top = [list(row) for row in rows]
+
+    def threshold(self):
+        """Playtime needed to enter the leaderboard, None while it isn't full yet."""
+        if len(self.top) < self.size:
+            return None
+        return self.top[-1][2]
+
+    def update(self, uid, username, playtime):
+        """Apply the new playtime total of a linked player, returns False if the leaderboard is unaffected."""
+        for row in self.top:
+            if row[0] == uid:
+                if row[1] == username and row[2] == playtime:
+                    return False
+                row[1] = username
+                row[2] = playtime
+                break
+        else:
+            threshold = self.threshold()
+            if threshold is not None and playtime < threshold:
+                return False
+            self.top.append([uid, username, playtime])
+
+        self.top.sort(key=lambda row: (row[2], row[0]), reverse=True)
+        del self.top[self.size:]
+        return True
+
+    def rows(self):
+        """(username, playtime) of every player on the leaderboard, best first."""
+        return [(username, playtime) for uid, username, playtime in self.top]
+
+# The players linked in one guild with the playtime that guild counts, in the order of idx_discord_users_guild_playtime
+_GUILD_PLAYERS = '''
+    SELECT d.uuid, p.username, d.playtime
+    FROM discord_users d JOIN players p ON p.uid = d.uuid
+    WHERE d.guild_id = ?
+'''
+
+async def fetch_leaderboard_page(db, guild_id, after=None, before=None, limit=10):
+    """A page of (uid, username, playtime) of the players linked in a guild, in leaderboard order.
+
+    Pages are found from a (playtime, uid) key instead of using OFFSET, after is
+    the key of the last row of the previous page, before the key of the first
+    row of the next one. Pages are read straight from the guild's leaderboard
+    index, the cost grows with the page size only.
+    """
+    if before is not None:
+        rows = await db.fetchall(f'''
+            {_GUILD_PLAYERS} AND (d.playtime, d.uuid) > (?, ?)
+            ORDER BY d.playtime, d.uuid
+            LIMIT ?
+        ''', (guild_id, before[0], before[1], limit))
+        return rows[::-1]
+    if after is not None:
+        return await db.fetchall(f'''
+            {_GUILD_PLAYERS} AND (d.playtime, d.uuid) < (?, ?)
+            ORDER BY d.playtime DESC, d.uuid DESC
+            LIMIT ?
+        ''', (guild_id, after[0], after[1], limit))
+    return await db.fetchall(f'''
+        {_GUILD_PLAYERS}
+        ORDER BY d.playtime DESC, d.uuid DESC
+        LIMIT ?
+    ''', (guild_id, limit))
+
+async def fetch_leaderboard_rank(db, guild_id, uid):
+    """(rank, (uid, username, playtime)) of a player in a guild, or None if they aren't linked there."""
+    row = await db.fetchone(f'{_GUILD_PLAYERS} AND d.uuid = ?', (guild_id, uid))
+    if not row:
+        return None
+    # Counted on the index alone, players is only needed for the username
+    ahead = await db.fetchone('''
+        SELECT COUNT(*) FROM discord_users
+        WHERE guild_id = ? AND (playtime, uuid) > (?, ?)
+    ''', (guild_id, row[2], row[0]))
+    return ahead[0] + 1, row
+
+async def fetch_period_leaderboard(db, guild_id, period, now, reset_at=None, limit=10):
+    """(username, seconds) of the players linked in a guild with the most playtime in a period, best first.
+
+    Sums at most `buckets` pre-aggregated rows per linked player, so the cost
+    doesn't grow with how much history is stored. CROSS JOIN keeps SQLite
+    starting from the guild's links instead of scanning the whole bucket range.
+    If the guild reset its leaderboard at reset_at (unix time) during the period,
+    only the buckets from the one reset_at falls in count, minus the seconds
+    that bucket already had at the reset (period_reset_offsets). A day
+    leaderboard reset at 00:30 shows the playtime since 00:30, not nothing
+    until the next bucket starts.
+    """
+    title, table, column, buckets = PERIODS[period]
+    hour, day = rollup_buckets(now)
+    first_bucket = (hour if column == 'hour' else day) - buckets + 1
+    offset_column = 'hour_seconds' if column == 'hour' else 'day_seconds'
+    subtract = 0
+    if reset_at is not None:
+        reset_hour, reset_day = rollup_buckets(datetime.fromtimestamp(reset_at, timezone.utc))
+        reset_bucket = reset_hour if column == 'hour' else reset_day
+        if reset_bucket >= first_bucket:
+            first_bucket = reset_bucket
+            subtract = 1
+    return await db.fetchall(f'''
+        SELECT p.username, SUM(r.seconds) - COALESCE(MAX(o.{offset_column}), 0) AS seconds
+        FROM discord_users d
+        CROSS JOIN players p ON p.uid = d.uuid
+        CROSS JOIN {table} r ON r.uid = d.uuid AND r.{column} >= ?
+        LEFT JOIN period_reset_offsets o ON ? AND o.guild_id = d.guild_id AND o.uid = d.uuid
+        WHERE d.guild_id = ?
+        GROUP BY d.uuid
+        HAVING SUM(r.seconds) > COALESCE(MAX(o.{offset_column}), 0)
+        ORDER BY seconds DESC, d.uuid
+        LIMIT ?
+    ''', (first_bucket, subtract, guild_id, limit))
+
+def convert_seconds_to_hms(seconds):
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    secs = seconds % 60
+    return f"{int(hours)}h {int(minutes)}m {int(secs)}s"
+
+def build_leaderboard_embed(title, rows, footer_icon, start_rank=1):
+    """Leaderboard embed for (username, playtime) rows, best first."""
+    embed = discord.Embed(
+        title=title,
+        color=0xFFD700,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    if rows:
+        lines = ""
+        for rank, (username, playtime) in enumerate(rows, start=start_rank):
+            lines += f"**{rank}. {username}** - {convert_seconds_to_hms(playtime)}\n"
+        embed.add_field(name="Leaderboard", value=lines, inline=False)
+    else:
+        embed.add_field(name="Leaderboard", value="No players to display.", inline=False)
+
+    embed.set_footer(text="CNR Crew Bot by penk", icon_url=footer_icon)
+    return embed
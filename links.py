@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+class LinkEntry:
+    """The player a Discord account is linked to in a guild."""
+    __slots__ = ('uuid', 'username', 'playtime_offset')
+
+    def __init__(self, uuid, username, playtime_offset=0):
+        self.uuid = uuid
+        self.username = username
+        # Playtime the player had when the guild last reset its leaderboard
+        self.playtime_offset = playtime_offset
+
+class LinkCache:
+    """Read-through cache of Discord account <-> player links shared by every cog.
+
+    Links are per guild. Which uuid belongs to which Discord account is held in
+    full, it is one small row per linked member and the ingest and embeds check
+    it on every poll. Lookups by (guild, Discord ID), including "not linked",
+    are cached with the player's current username in a bounded LRU, so commands
+    only hit the database on a miss. Everything is updated in place by /link and
+    by renames seen in the ingest.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        # guild_id -> {uuid -> discord_id} of every link
+        self.owners = {}
+        # uuid -> {guild_id -> playtime_offset} of every guild the player is linked in
+        self.guild_offsets = {}
+        # (guild_id, discord_id) -> LinkEntry, or None if the account isn't linked
+        self.entries = OrderedDict()
+
+    async def load(self, db):
+        """Load every link, e.g. on startup."""
+        rows = await db.fetchall('SELECT guild_id, discord_id, uuid, playtime_offset FROM discord_users')
+        self.owners = {}
+        self.guild_offsets = {}
+        for guild_id, discord_id, uuid, offset in rows:
+            self.owners.setdefault(guild_id, {})[uuid] = discord_id
+            self.guild_offsets.setdefault(uuid, {})[guild_id] = offset
+        self.entries.clear()
+
+    def __contains__(self, uuid):
+        """Whether the player is linked in any guild."""
+        return uuid in self.guild_offsets
+
+    def guilds(self, uuid):
+        """{guild_id: playtime_offset} of every guild the player is linked in."""
+        return self.guild_offsets.get(uuid, {})
+
+    def owner(self, guild_id, uuid):
+        """Discord ID the player is linked to in a guild, or None."""
+        return self.owners.get(guild_id, {}).get(uuid)
+
+    async def resolve(self, db, guild_id, discord_id):
+        """LinkEntry of a Discord account in a guild, or None if it isn't linked there."""
+        key = (guild_id, str(discord_id))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        row = await db.fetchone('''
+            SELECT d.uuid, p.username, d.playtime_offset FROM discord_users d
+            LEFT JOIN players p ON p.uid = d.uuid
+            WHERE d.guild_id = ? AND d.discord_id = ?
+        ''', key)
+        entry = LinkEntry(*row) if row else None
+        self._remember(key, entry)
+        return entry
+
+    def link(self, guild_id, discord_id, uuid, username, previous=None, playtime_offset=0):
+        """Record a link /link just wrote, previous is the uuid the account was linked to before."""
+        discord_id = str(discord_id)
+        owners = self.owners.setdefault(guild_id, {})
+        if previous is not None and owners.get(previous) == discord_id:
+            del owners[previous]
+            offsets = self.guild_offsets.get(previous, {})
+            offsets.pop(guild_id, None)
+            if not offsets:
+                self.guild_offsets.pop(previous, None)
+        owners[uuid] = discord_id
+        self.guild_offsets.setdefault(uuid, {})[guild_id] = playtime_offset
+        self._remember((guild_id, discord_id), LinkEntry(uuid, username, playtime_offset))
+
+    def rename(self, uuid, username):
+        """Keep the cached username of a linked player current."""
+        for guild_id in self.guilds(uuid):
+            entry = self.entries.get((guild_id, self.owner(guild_id, uuid)))
+            if entry is not None:
+                entry.username = username
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
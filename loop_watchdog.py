@@ -0,0 +1,153 @@
+import asyncio
+import inspect
+import os
+import sys
+import threading
+import time
+import traceback
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+class Stall:
+    """Stalls of the event loop that were caught in the same place."""
+    __slots__ = ('coroutine', 'location', 'count', 'total', 'worst', 'stack')
+
+    def __init__(self, coroutine, location):
+        self.coroutine = coroutine
+        self.location = location
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.stack = ''
+
+class LoopWatchdog:
+    """Measures event loop lag and catches whatever blocks the loop.
+
+    A heartbeat task sleeps `interval` seconds at a time, the lag is how much
+    later than that it wakes up. A thread watches the heartbeat and once it is
+    `threshold` seconds overdue, samples the loop thread's stack with
+    sys._current_frames(), which shows the callback or coroutine step that is
+    holding the loop. Stalls are aggregated by coroutine and location.
+    """
+    def __init__(self, threshold=0.25, interval=0.05, metrics=None, max_entries=200):
+        self.threshold = threshold
+        self.interval = interval
+        self.metrics = metrics
+        self.max_entries = max_entries
+        self.stalls = {}
+        self.beats = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.started = None
+        self._last_beat = 0.0
+        self._sample = None
+        self._sampled_beat = None
+        self._lock = threading.Lock()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the heartbeat and the watcher thread, must be called from the running event loop."""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self.started = time.time()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def close(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - before - self.interval)
+            with self._lock:
+                self._last_beat = now
+                sample, self._sample = self._sample, None
+            self.beats += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            if self.metrics:
+                self.metrics.loop_lag_seconds.observe(lag)
+            if lag >= self.threshold:
+                self._record(lag, sample)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                last_beat = self._last_beat
+                if time.monotonic() - last_beat < self.threshold or self._sampled_beat == last_beat:
+                    continue
+                # One sample per stall, taken while the loop is still blocked
+                self._sampled_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            sample = _describe(frame)
+            del frame
+            with self._lock:
+                if self._last_beat == last_beat:
+                    self._sample = sample
+
+    def _record(self, lag, sample):
+        coroutine, location, stack = sample or ('unknown', 'not sampled, the stall ended before the watchdog looked', '')
+        key = (coroutine, location)
+        stall = self.stalls.get(key)
+        if stall is None:
+            if len(self.stalls) >= self.max_entries:
+                return
+            stall = self.stalls[key] = Stall(coroutine, location)
+        stall.count += 1
+        stall.total += lag
+        if lag >= stall.worst:
+            stall.worst = lag
+            stall.stack = stack
+
+    def report(self, limit=5):
+        """(heartbeats, mean lag, max lag, the `limit` stalls that blocked the loop longest in total)."""
+        mean = self.lag_total / self.beats if self.beats else 0.0
+        worst = sorted(self.stalls.values(), key=lambda stall: stall.total, reverse=True)[:limit]
+        return self.beats, mean, self.lag_max, worst
+
+    def reset(self):
+        self.stalls.clear()
+        self.beats = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.started = time.time()
+
+def _describe(frame):
+    """(coroutine name, innermost location in the bot's own code, formatted stack) of a loop thread frame."""
+    stack = traceback.extract_stack(frame)
+    coroutine = 'callback'
+    current = frame
+    while current is not None:
+        # The outermost coroutine frame is the task's coroutine
+        if current.f_code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE):
+            coroutine = getattr(current.f_code, 'co_qualname', current.f_code.co_name)
+        current = current.f_back
+
+    location = None
+    for entry in reversed(stack):
+        if entry.filename.startswith(_ROOT) and os.sep + 'site-packages' + os.sep not in entry.filename:
+            location = f"{os.path.relpath(entry.filename, _ROOT)}:{entry.lineno} in {entry.name}"
+            break
+    if location is None:
+        entry = stack[-1]
+        location = f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+    return coroutine, location, ''.join(traceback.format_list(stack[-12:]))
@@ -1,24 +1,36 @@
+import time
+# Startup is timed from here, see mark_startup
+START_TIME = time.perf_counter()
+
 import discord
 from discord.ext import commands, tasks
-import sqlite3
-import aiohttp
 import asyncio
 import traceback
-import yaml
 from discord import app_commands
 import sys
 import os
 from datetime import datetime, timedelta, timezone 
 import urllib3
 import signal
+import hashlib
+import functools
+import json
+
+from database import adopt_legacy_rows, count_guilds, load_state, prune_rollups, save_state
+from guilds import GuildRegistry, GuildSettings
+from roster import Roster
+from links import LinkCache
+from usernames import UsernameIndex
+from leaderboard import PERIODS, LeaderboardCache, build_leaderboard_embed, fetch_period_leaderboard
+from http_client import HttpClient
+from edit_scheduler import EditScheduler, rate_limit_trace
+from ingest import Ingest, IngestSubscriber, build_poller, import_endpoint, load_config, open_database, socket_path
+from metrics import Metrics, MetricsServer, instrument_discord
+from loop_watchdog import LoopWatchdog
+from retention import Retention
 
 # Configuration 
-def load_config(path):
-    with open(path, 'r') as file:
-        return yaml.safe_load(file)
-
-config_path = os.path.join(os.path.dirname(__file__), 'config.yml')
-config = load_config(config_path)
+config = load_config()
 
 server_status_endpoint = config.get('server_status_endpoint')
 if not server_status_endpoint:
@@ -28,6 +40,7 @@ BOTTOKEN = config['bottoken']
 DATABASE = config['database']['name']
 ENDPOINTS = config['endpoints']
 
+# The guild in config.yml, more guilds are added with /guildsetup and stored in the database
 GUILD_ID = int(config.get('guild_id'))  
 STAFF_ROLE_ID = int(config.get('staff_role_id'))
 CREWMEMBER_ROLE_ID = int(config.get('crewmember_role_id'))
@@ -41,242 +54,287 @@ LOGS_THUMBNAIL = EMBED_IMAGES.get('logs_thumbnail', "https://i.pinimg.com/origin
 ONLINE_USERS_CHANNEL_ID = config.get('online_users_channel_id') 
 LEADERBOARD_CHANNEL_ID = config.get('leaderboard_channel_id')
 LOG_CHANNEL_ID = config.get('staff_logs_channel_id')
+# Verification channel and role of the guild in config.yml, other guilds set theirs with /guildsetup
+VERIFICATION_CONFIG = config.get('verification', {})
 
-# Database Setup 
-def setup_database(db_path):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS players (
-            uid TEXT PRIMARY KEY,
-            username TEXT,
-            playtime INTEGER DEFAULT 0,
-            last_seen TEXT,
-            server TEXT,
-            is_online INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS discord_users (
-            discord_id TEXT PRIMARY KEY,
-            uuid TEXT UNIQUE
-        )
-    ''')
-    conn.commit()
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS bot_metadata (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-    conn.commit()
+LEADERBOARD_CONFIG = config.get('leaderboard', {})
+# Extra leaderboard embeds, any of day, week and month
+LEADERBOARD_PERIODS = [period for period in LEADERBOARD_CONFIG.get('periods', []) if period in PERIODS]
 
-    try:
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS online_users_embed (
-                server TEXT PRIMARY KEY,
-                message_id INTEGER
-            )
-        ''')
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
+INGEST_CONFIG = config.get('ingest', {})
+# How often the poll loop checks which endpoints are due, each endpoint has its own cadence
+INGEST_POLL_TICK = float(INGEST_CONFIG.get('poll_tick', 5))
+# With worker.enabled, ingest.py polls and writes in its own process and this one only renders and serves commands
+INGEST_WORKER = config.get('worker', {}).get('enabled', False)
 
-    try:
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS leaderboard_embed (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                message_id INTEGER
-            )
-        ''')
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
+METRICS_CONFIG = config.get('metrics', {})
+PROFILING_CONFIG = config.get('profiling', {})
+LEADERBOARD_TASK_INTERVAL = 120
+# How often retention_task checks whether a retention pass is due, the passes themselves run every retention.interval_hours
+RETENTION_TASK_INTERVAL = 600
+# From this many configured guilds on, the gateway connection is sharded
+SHARD_THRESHOLD = int(config.get('shard_threshold', 1000))
+# bot_metadata key of the state saved for a warm restart
+SNAPSHOT_KEY = 'snapshot'
+
+# phase -> seconds from START_TIME until the phase was reached
+startup_times = {}
+
+def mark_startup(phase):
+    startup_times.setdefault(phase, time.perf_counter() - START_TIME)
+
+mark_startup('imports')
+
+# Always recorded, only served when metrics.enabled is set
+metrics = Metrics()
 
-    return conn, c
+# Database Setup 
+db = open_database(config, metrics)
 
 # Bot Initialization
 intents = discord.Intents.all()
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-conn, c = setup_database(DATABASE)
-bot.conn = conn
+# Every guild is served by the same process and the same polls, only the gateway is split up once there are many
+if count_guilds(DATABASE) >= SHARD_THRESHOLD:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, http_trace=rate_limit_trace())
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, http_trace=rate_limit_trace())
+
+bot.metrics = metrics
+metrics_server = MetricsServer(
+    metrics,
+    host=METRICS_CONFIG.get('host', '127.0.0.1'),
+    port=int(METRICS_CONFIG.get('port', 9464))
+)
+
+# Opt-in, /perf reports what blocked the event loop
+loop_watchdog = None
+if PROFILING_CONFIG.get('enabled', False):
+    loop_watchdog = LoopWatchdog(
+        threshold=float(PROFILING_CONFIG.get('threshold_ms', 250)) / 1000,
+        interval=float(PROFILING_CONFIG.get('heartbeat_ms', 50)) / 1000,
+        metrics=metrics
+    )
+bot.loop_watchdog = loop_watchdog
+
+bot.db = db
+
+http_client = HttpClient(config.get('http', {}))
+bot.http_client = http_client
+
+edit_scheduler = EditScheduler()
+bot.edit_scheduler = edit_scheduler
+
+# In worker mode the endpoints and the roster are copies of the worker's, kept up to date by ingest_subscriber
+poller = build_poller(config, metrics)
+bot.poller = poller
+
+roster = Roster(
+    stale_after=int(INGEST_CONFIG.get('stale_after', 300)),
+    max_gap=int(INGEST_CONFIG.get('max_playtime_gap', 180))
+)
+bot.roster = roster
+
+ingest = Ingest(config, db, poller, roster, http_client)
+ingest_subscriber = IngestSubscriber(socket_path(config), lambda message: on_ingest_message(message))
+
+# Archives inactive players and compacts the database, run by whoever runs the ingest
+retention = Retention(db, config.get('retention', {}), metrics)
+
+links = LinkCache(size=1024)
+bot.links = links
+
+usernames = UsernameIndex()
+bot.usernames = usernames
+
+guild_settings = GuildRegistry()
+bot.guild_settings = guild_settings
+
+# guild_id -> LeaderboardCache of every configured guild
+leaderboards = {}
+bot.leaderboards = leaderboards
+
+metrics.gauge('cnr_db_write_queue', 'Database write jobs waiting for the writer thread.', db.queue_depth)
+metrics.gauge('cnr_edit_queue', 'Discord message updates waiting to be sent.', edit_scheduler.queue_depth)
+metrics.gauge('cnr_players_online', 'Players online per server.',
+              lambda: {(server,): len(roster.online(server)) for server in ENDPOINTS}, ('server',))
+metrics.gauge('cnr_startup_seconds', 'Seconds from process start until each startup phase was reached.',
+              lambda: {(phase,): round(seconds, 3) for phase, seconds in startup_times.items()}, ('phase',))
+metrics.gauge('cnr_verification_sessions', 'Captchas waiting for an answer.',
+              lambda: len(bot.get_cog('VerificationCog').sessions) if bot.get_cog('VerificationCog') else 0)
 
 bot.config = config
 bot.GUILD_ID = GUILD_ID
 bot.LOGS_THUMBNAIL = LOGS_THUMBNAIL
-bot.LOG_CHANNEL_ID = LOG_CHANNEL_ID
 
 bot.MYUUID_THUMBNAIL = MYUUID_THUMBNAIL
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-last_message_update = datetime.now(timezone.utc)
+# (guild_id, server) -> (message_id, fingerprint) of the last online users embed that was sent
+online_embed_fingerprints = {}
+
+# (guild_id, server) -> future of the send that creates its online users message, while it hasn't gone out
+online_embed_creates = {}
+
+# guild_id -> rows the guild's leaderboard message was last updated with
+leaderboard_rows_sent = {}
+
+# (guild_id, period) -> rows its leaderboard message was last updated with
+period_rows_sent = {}
+
+async def start_services():
+    """Start everything that doesn't need Discord and load the state of the last run."""
+    if loop_watchdog:
+        loop_watchdog.start()
+    await http_client.start()
+    edit_scheduler.start()
+    await load_guilds()
+    # Independent of each other, the loads run on the read pool while the sessions are written
+    await asyncio.gather(
+        restore_snapshot(),
+        links.load(db),
+        usernames.load(db),
+        retention.load(),
+        *(board.rebuild(db) for board in leaderboards.values())
+    )
+
+async def load_guilds():
+    """Load the guild settings, the guild in config.yml is added the first time and takes over older rows."""
+    await guild_settings.load(db)
+    await guild_settings.seed(db, GuildSettings(
+        GUILD_ID,
+        online_users_channel_id=ONLINE_USERS_CHANNEL_ID,
+        leaderboard_channel_id=LEADERBOARD_CHANNEL_ID,
+        staff_logs_channel_id=LOG_CHANNEL_ID,
+        staff_role_id=STAFF_ROLE_ID,
+        crewmember_role_id=CREWMEMBER_ROLE_ID,
+        verification_channel_id=VERIFICATION_CONFIG.get('verification_channel_id'),
+        verified_role_id=VERIFICATION_CONFIG.get('verified_role_id')
+    ))
+    adopted = await db.write(adopt_legacy_rows, GUILD_ID)
+    if adopted:
+        print(f"Moved {adopted} links and embed messages to guild {GUILD_ID}")
+    for settings in guild_settings:
+        leaderboards.setdefault(settings.guild_id, LeaderboardCache(settings.guild_id, size=10))
+
+@bot.event
+async def setup_hook():
+    instrument_discord(bot.http, metrics)
+    # Paces the embed updates from the rate limit headers of every response
+    edit_scheduler.watch(bot.http)
+    await start_services()
+    await load_cogs()
+
+    if METRICS_CONFIG.get('enabled', False):
+        await metrics_server.start()
+
+    # Polling doesn't need the gateway, it runs while the bot is still connecting
+    if INGEST_WORKER:
+        ingest_subscriber.start()
+    else:
+        periodic_fetch.start()
+        retention_task.start()
+    leaderboard_task.start()
+    mark_startup('setup')
 
 @bot.event
 async def on_ready():
     try:
         print(f'Logged in as {bot.user}')
-        
-        await load_cogs()
-        
-        periodic_fetch.start()
-        leaderboard_task.start()
-        
-        await asyncio.sleep(5)
-        
-        if 'verification' in bot.config and bot.config['verification'].get('enabled', True):
-            verification_cog = bot.get_cog('VerificationCog')
-            if verification_cog:
-                await verification_cog.check_and_send_verification_message()
+        if 'ready' in startup_times:
+            # Reconnected, everything is already running
+            return
+        mark_startup('ready')
+
+        # The first updates of the tasks ran before the channels were cached
+        await asyncio.gather(display_online_users(), update_leaderboard(), update_period_leaderboards())
+        await edit_scheduler.join()
+        mark_startup('embeds')
+        print("Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_times.items()))
     except Exception as e:
         traceback.print_exc()
 
 # Tasks for fetching and displaying data
-@tasks.loop(minutes=1)
+@tasks.loop(seconds=INGEST_POLL_TICK)
 async def periodic_fetch():
     try:
-        c.execute('SELECT value FROM bot_metadata WHERE key = ?', ('last_run',))
-        result = c.fetchone()
-        if result:
-            last_run_str = result[0]
-            last_run = datetime.fromisoformat(last_run_str)
-            if last_run.tzinfo is None:
-                last_run = last_run.replace(tzinfo=timezone.utc)
-        else:
-            last_run = datetime.now(timezone.utc)
-            c.execute('INSERT INTO bot_metadata (key, value) VALUES (?, ?)', ('last_run', last_run.isoformat()))
-            conn.commit()
-        
-        current_time = datetime.now(timezone.utc)
-        elapsed_time = (current_time - last_run).total_seconds()
-        
-        await fetch_and_store_data(elapsed_time)
+        due = poller.due()
+        if not due:
+            return
+
+        start = time.perf_counter()
+        # Playtime is credited per player by the roster, so loop drift and per server cadences don't matter here
+        players, status = ingest.split(due)
+        await asyncio.gather(fetch_and_store_data(players), ingest.fetch_status(status))
         
-        await asyncio.sleep(5)
         await display_online_users()
-        
-        c.execute('UPDATE bot_metadata SET value = ? WHERE key = ?', (current_time.isoformat(), 'last_run'))
-        conn.commit()
+        metrics.record_task('periodic_fetch', time.perf_counter() - start, INGEST_POLL_TICK)
     except Exception as e:
         traceback.print_exc()
 
-@tasks.loop(minutes=2)
+@tasks.loop(seconds=LEADERBOARD_TASK_INTERVAL)
 async def leaderboard_task():
+    start = time.perf_counter()
     await update_leaderboard()
+    await update_period_leaderboards()
+    await save_snapshot()
+    metrics.record_task('leaderboard_task', time.perf_counter() - start, LEADERBOARD_TASK_INTERVAL)
+
+@tasks.loop(seconds=RETENTION_TASK_INTERVAL)
+async def retention_task():
+    if retention.due():
+        await retention.run()
 
 # Functions for fetching and storing data/embeds ect
-async def fetch_and_store_data(elapsed_seconds):
-    current_time = datetime.now(timezone.utc)
-    try:
-        fetched_uids = set()
-        
-        async with aiohttp.ClientSession() as session:
-            for server, url in ENDPOINTS.items():
-                try:
-                    try:
-                        async with session.get(url, timeout=10) as response:
-                            if response.status == 404:
-                                print(f"Server {server.upper()} not found (404). The server might be offline.")
-                                await asyncio.sleep(5)
-                                continue
-                                
-                            if not response.ok:
-                                print(f"Server {server.upper()} returned status code {response.status}. Skipping.")
-                                await asyncio.sleep(5)
-                                continue
-                                
-                            try:
-                                data = await response.json(content_type=None)
-                            except aiohttp.ContentTypeError:
-                                print(f"Server {server.upper()} returned unexpected content type: {response.content_type}")
-                                await asyncio.sleep(5)
-                                continue
-                                
-                            for player in data:
-                                uid = player.get('Uid')
-                                username = player.get('Username', {}).get('Username')
-                                if uid and username:
-                                    fetched_uids.add(uid)
-                                    c.execute('SELECT playtime, last_seen FROM players WHERE uid = ?', (uid,))
-                                    result = c.fetchone()
-                                    if result:
-                                        playtime, last_seen_str = result
-                                        playtime += int(elapsed_seconds)
-                                        c.execute('''
-                                            UPDATE players
-                                            SET username = ?, last_seen = ?, is_online = 1, server = ?, playtime = ?
-                                            WHERE uid = ?
-                                        ''', (username, current_time.isoformat(), server, playtime, uid))
-                                    else:
-                                        c.execute('''
-                                            INSERT INTO players (uid, username, last_seen, server, is_online, playtime)
-                                            VALUES (?, ?, ?, ?, 1, 0)
-                                        ''', (uid, username, current_time.isoformat(), server))
-                    except aiohttp.ClientResponseError as e:
-                        print(f"Server {server.upper()} is offline or returned an error: {e.status}")
-                        await asyncio.sleep(5)
-                        continue
-                    except aiohttp.ClientConnectionError:
-                        print(f"Server {server.upper()} connection failed. The server may be offline.")
-                        await asyncio.sleep(5)
-                        continue
-                    except asyncio.TimeoutError:
-                        print(f"Request to server {server.upper()} timed out. The server may be unresponsive.")
-                        await asyncio.sleep(5)
-                        continue
-                    
-                    await asyncio.sleep(5)
-                except Exception as e:
-                    print(f"Unexpected error when processing server {server.upper()}: {str(e)}")
-                    traceback.print_exc()
-                    await asyncio.sleep(5)
-
-        if fetched_uids:
-            placeholders = ','.join(['?'] * len(fetched_uids))
-            c.execute(f'SELECT uid FROM players WHERE uid NOT IN ({placeholders}) AND is_online = 1', tuple(fetched_uids))
-        else:
-            c.execute('SELECT uid FROM players WHERE is_online = 1')
-        offline_players = c.fetchall()
-        for (uid,) in offline_players:
-            c.execute('UPDATE players SET is_online = 0 WHERE uid = ?', (uid,))
-
-        conn.commit()
-    except Exception as e:
-        print(f"Global error in fetch_and_store_data: {str(e)}")
-        traceback.print_exc()
+async def fetch_and_store_data(endpoints):
+    """Poll the player lists of the servers that are due, write what changed and update the caches."""
+    result = await ingest.fetch_players(endpoints, links)
+    if result:
+        apply_ingest(*result)
+
+def apply_ingest(delta, totals):
+    """Update the links, usernames and leaderboards with one poll, made here or by the ingest worker."""
+    changes = [(uid, username) for uid, username, *servers in delta.joined + delta.switched + delta.renamed]
+    for uid, username in changes:
+        links.rename(uid, username)
+    usernames.update(changes)
+
+    # One poll, every guild the player is linked in
+    for uid, playtime in totals.items():
+        entry = roster.get(uid)
+        if entry is None:
+            continue
+        for guild_id, offset in links.guilds(uid).items():
+            board = leaderboards.get(guild_id)
+            if board:
+                board.update(uid, entry.username, playtime - offset)
+
+async def on_ingest_message(message):
+    """Apply a message the ingest worker published, see ingest.IngestPublisher."""
+    now = time.monotonic()
+    for name, state in message['endpoints'].items():
+        endpoint = poller.get(name)
+        if endpoint:
+            import_endpoint(endpoint, state, now)
+
+    if message['type'] == 'state':
+        # (Re)connected, the worker may have polled and written while this process wasn't listening
+        roster.restore(message['roster'])
+        await asyncio.gather(*(board.rebuild(db) for board in leaderboards.values()))
+    elif 'joined' in message:
+        delta = roster.replay(message['joined'], message['switched'], message['renamed'], message['left'],
+                              datetime.now(timezone.utc))
+        apply_ingest(delta, dict(message['totals']))
+
+    start = time.perf_counter()
+    await display_online_users()
+    metrics.record_task('ingest_message', time.perf_counter() - start, INGEST_POLL_TICK)
 
 async def display_online_users():
+    """Update the online users embeds of every guild, the status is polled once for all of them."""
     try:
-        global last_message_update
-        channel = bot.get_channel(ONLINE_USERS_CHANNEL_ID)
-        if not channel:
-            return
-
-        online_users = {}
-        server_embeds = {}
-        server_message_ids = {}
-        
-        for server in ENDPOINTS.keys():
-            c.execute('''
-                SELECT p.username
-                FROM players p
-                JOIN discord_users d ON p.uid = d.uuid
-                WHERE p.server = ? AND p.is_online = 1
-            ''', (server,))
-            users = [row[0] for row in c.fetchall()]
-            online_users[server] = users
-            
-            c.execute('SELECT message_id FROM online_users_embed WHERE server = ?', (server,))
-            result = c.fetchone()
-            if result:
-                server_message_ids[server] = result[0]
-
         server_key_map = {
             'eu1': 'EU1',
             'eu2': 'EU2',
@@ -285,164 +343,229 @@ async def display_online_users():
             'sea1': 'SEA'
         }
 
-        connector = aiohttp.TCPConnector(ssl=False)
         server_status = {}
         
-        # Get server status
-        async with aiohttp.ClientSession(connector=connector) as session:
+        # Server status comes from the last poll of the status endpoints
+        server_status_data = poller.get('status').current()
+        if server_status_data:
             try:
-                async with session.get(server_status_endpoint, timeout=10) as response:
-                    if response.ok:
-                        try:
-                            server_status_data = await response.json(content_type=None)
-                            server_status = {entry['Id'].lower(): entry for entry in server_status_data}
-                        except aiohttp.ContentTypeError:
-                            print(f"Server status endpoint returned unexpected content type")
-                    else:
-                        print(f"Server status endpoint returned status code {response.status}")
-            except Exception as e:
-                print(f"Error fetching server status: {str(e)}")
-                
-            for server, users in online_users.items():
-                status_id = server_key_map.get(server, server).lower()
-                status = server_status.get(status_id, {})
-
-                players_online = status.get('Players', 'N/A')
-                queued_players = status.get('QueuedPlayers', 'N/A')
-                time_till_restart = 'N/A'
-                
-                status_endpoint = config.get('status_endpoints', {}).get(f'server_name {server.upper()}')
-                if status_endpoint:
-                    try:
-                        async with session.get(status_endpoint, timeout=10) as response:
-                            if response.ok:
-                                try:
-                                    status_data = await response.json(content_type=None)
-                                    time_string = status_data.get('vars', {}).get('Time')
-                                    if time_string:
-                                        seconds_remaining = convert_time(time_string)
-                                        time_till_restart = seconds_remaining_to_human_readable(seconds_remaining)
-                                except Exception:
-                                    pass
-                    except Exception as e:
-                        print(f"Server {server.upper()} status error: {type(e).__name__}")
-                
-                embed = discord.Embed(
-                    title=f"🌐 Online Players - {server.upper()}",
-                    color=0x00BFFF,
-                    timestamp=datetime.now(timezone.utc)
-                )
+                server_status = {entry['Id'].lower(): entry for entry in server_status_data}
+            except (KeyError, TypeError, AttributeError):
+                print("Server status endpoint returned unexpected data")
 
-                embed.add_field(name="Players Online", value=f"`{players_online}`", inline=True)
-                embed.add_field(name="Queue Length", value=f"`{queued_players}`", inline=True)
-                embed.add_field(name="Time till restart", value=f"`{time_till_restart}`", inline=True)
-
-                if users:
-                    user_list = '\n'.join(users)
-                    embed.add_field(name="Online Users", value=user_list, inline=False)
-                else:
-                    embed.add_field(name="Online Users", value="No online players.", inline=False)
+        # server -> (players online, queue length, time till restart), the same in every guild
+        status_fields = {}
+        for server in ENDPOINTS.keys():
+            status_id = server_key_map.get(server, server).lower()
+            status = server_status.get(status_id, {})
 
-                embed.set_footer(text="CNR Crew Bot by penk", icon_url=FOOTER_THUMBNAIL)
-                
-                server_embeds[server] = embed
-        
-        for server, embed in server_embeds.items():
-            try:
-                now = datetime.now(timezone.utc)
-                time_since_last_update = (now - last_message_update).total_seconds()
-                
-                if time_since_last_update < 2:
-                    await asyncio.sleep(3 - time_since_last_update)
-                
+            players_online = status.get('Players', 'N/A')
+            queued_players = status.get('QueuedPlayers', 'N/A')
+            time_till_restart = 'N/A'
+            
+            status_endpoint = poller.get(f'status:{server}')
+            status_data = status_endpoint.current() if status_endpoint else None
+            if status_data:
+                try:
+                    time_string = status_data.get('vars', {}).get('Time')
+                    if time_string:
+                        seconds_remaining = convert_time(time_string)
+                        time_till_restart = seconds_remaining_to_human_readable(seconds_remaining)
+                except Exception:
+                    pass
+            status_fields[server] = (players_online, queued_players, time_till_restart)
+
+        # guild_id -> server -> usernames of the guild's linked players online there, one pass over the roster
+        online_users = {}
+        for uid, entry in roster.online():
+            for guild_id in links.guilds(uid):
+                online_users.setdefault(guild_id, {}).setdefault(entry.server, []).append(entry.username)
+
+        for settings in guild_settings:
+            channel = bot.get_channel(settings.online_users_channel_id) if settings.online_users_channel_id else None
+            if not channel:
+                continue
+
+            rows = await db.fetchall('SELECT server, message_id FROM online_users_embed WHERE guild_id = ?', (settings.guild_id,))
+            server_message_ids = dict(rows)
+            guild_users = online_users.get(settings.guild_id, {})
+
+            for server in ENDPOINTS.keys():
+                embed = build_online_users_embed(server, sorted(guild_users.get(server, [])), *status_fields[server])
+                key = (settings.guild_id, server)
                 message_id = server_message_ids.get(server)
-                if message_id:
-                    try:
-                        message = await channel.fetch_message(message_id)
-                        await message.edit(embed=embed)
-                        last_message_update = datetime.now(timezone.utc)
-                    except discord.NotFound:
-                        await asyncio.sleep(1)
-                        new_message = await channel.send(embed=embed)
-                        c.execute('UPDATE online_users_embed SET message_id = ? WHERE server = ?', 
-                                  (new_message.id, server))
-                        conn.commit()
-                        last_message_update = datetime.now(timezone.utc)
-                else:
-                    new_message = await channel.send(embed=embed)
-                    c.execute('INSERT INTO online_users_embed (server, message_id) VALUES (?, ?)',
-                              (server, new_message.id))
-                    conn.commit()
-                    last_message_update = datetime.now(timezone.utc)
-                
-                await asyncio.sleep(3)
-                
-            except Exception as e:
-                print(f"Error updating Discord embed for server {server}: {e}")
+                fingerprint = embed_fingerprint(embed)
+                if message_id and online_embed_fingerprints.get(key) == (message_id, fingerprint):
+                    # Nothing changed since the last edit, don't touch Discord at all
+                    continue
+                creating = online_embed_creates.get(key)
+                if not message_id and creating is not None and not creating.done():
+                    # The message is still being sent, a second send would post it twice. Edited once it exists.
+                    continue
+
+                online_embed_fingerprints[key] = (message_id, fingerprint)
+                future = edit_scheduler.submit(
+                    ('online_users', settings.guild_id, server), channel.id,
+                    functools.partial(send_online_users_embed, channel, settings.guild_id, server, message_id, embed, fingerprint)
+                )
+                if not message_id:
+                    online_embed_creates[key] = future
     except Exception as e:
         print(f"Global error in display_online_users: {str(e)}")
         traceback.print_exc()
 
-async def update_leaderboard():
+def build_online_users_embed(server, users, players_online, queued_players, time_till_restart):
+    embed = discord.Embed(
+        title=f"🌐 Online Players - {server.upper()}",
+        color=0x00BFFF,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    embed.add_field(name="Players Online", value=f"`{players_online}`", inline=True)
+    embed.add_field(name="Queue Length", value=f"`{queued_players}`", inline=True)
+    embed.add_field(name="Time till restart", value=f"`{time_till_restart}`", inline=True)
+
+    if users:
+        user_list = '\n'.join(users)
+        embed.add_field(name="Online Users", value=user_list, inline=False)
+    else:
+        embed.add_field(name="Online Users", value="No online players.", inline=False)
+
+    embed.set_footer(text="CNR Crew Bot by penk", icon_url=FOOTER_THUMBNAIL)
+    return embed
+
+async def send_online_users_embed(channel, guild_id, server, message_id, embed, fingerprint):
+    """Edit (or create) the online users message of a server in a guild, runs through the edit scheduler."""
+    key = (guild_id, server)
     try:
-        global last_message_update
-        channel = bot.get_channel(LEADERBOARD_CHANNEL_ID)
-        if not channel:
-            return
+        if message_id:
+            try:
+                await channel.get_partial_message(message_id).edit(embed=embed)
+                return message_id
+            except discord.NotFound:
+                pass
+
+        new_message = await channel.send(embed=embed)
+        await db.execute('''
+            INSERT INTO online_users_embed (guild_id, server, message_id) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, server) DO UPDATE SET message_id = excluded.message_id
+        ''', (guild_id, server, new_message.id))
+        online_embed_fingerprints[key] = (new_message.id, fingerprint)
+        return new_message.id
+    except (discord.RateLimited, discord.HTTPException) as e:
+        if isinstance(e, discord.RateLimited) or e.status == 429:
+            online_embed_fingerprints.pop(key, None)
+            raise
+        print(f"Error updating Discord embed for server {server} in guild {guild_id}: {e}")
+    except Exception as e:
+        print(f"Error updating Discord embed for server {server} in guild {guild_id}: {e}")
+    # Make sure the next cycle tries again
+    online_embed_fingerprints.pop(key, None)
 
-        # Query data
-        c.execute('''
-            SELECT p.username, p.playtime
-            FROM players p
-            JOIN discord_users d ON p.uid = d.uuid
-            ORDER BY p.playtime DESC
-            LIMIT 10
-        ''')
-        top_players = c.fetchall()
-
-        # Create embed
-        embed = discord.Embed(
-            title="🏆 Top 10 Players by Playtime",
-            color=0xFFD700,
-            timestamp=datetime.now(timezone.utc)
-        )
-
-        if top_players:
-            leaderboard = ""
-            for rank, (username, playtime) in enumerate(top_players, start=1):
-                playtime_formatted = convert_seconds_to_hms(playtime)
-                leaderboard += f"**{rank}. {username}** - {playtime_formatted}\n"
-            embed.add_field(name="Leaderboard", value=leaderboard, inline=False)
-        else:
-            embed.add_field(name="Leaderboard", value="No players to display.", inline=False)
-
-        embed.set_footer(text="CNR Crew Bot by penk", icon_url=FOOTER_THUMBNAIL)
+async def update_leaderboard():
+    """Update the leaderboard message of every guild whose top players changed."""
+    try:
+        for settings in guild_settings:
+            channel = bot.get_channel(settings.leaderboard_channel_id) if settings.leaderboard_channel_id else None
+            board = leaderboards.get(settings.guild_id)
+            if not channel or not board:
+                continue
+
+            top_players = board.rows()
+            if top_players == leaderboard_rows_sent.get(settings.guild_id):
+                # Same ranks and playtimes as the message already shows
+                continue
+
+            embed = build_leaderboard_embed("🏆 Top 10 Players by Playtime", top_players, FOOTER_THUMBNAIL)
+
+            leaderboard_rows_sent[settings.guild_id] = top_players
+            edit_scheduler.submit(
+                ('leaderboard', settings.guild_id), channel.id,
+                functools.partial(send_leaderboard_embed, channel, settings.guild_id, embed)
+            )
+    except Exception as e:
+        traceback.print_exc()
 
+async def send_leaderboard_embed(channel, guild_id, embed):
+    """Edit (or create) the leaderboard message of a guild, runs through the edit scheduler."""
+    try:
+        return await _send_leaderboard_embed(channel, guild_id, embed)
+    except Exception:
+        # Make sure the next cycle tries again
+        leaderboard_rows_sent.pop(guild_id, None)
+        raise
+
+async def _send_leaderboard_embed(channel, guild_id, embed):
+    result = await db.fetchone('SELECT message_id FROM leaderboard_embed WHERE guild_id = ?', (guild_id,))
+    if result and result[0]:
+        try:
+            await channel.get_partial_message(result[0]).edit(embed=embed)
+            return result[0]
+        except discord.NotFound:
+            pass
+
+    new_message = await channel.send(embed=embed)
+    await db.execute('''
+        INSERT INTO leaderboard_embed (guild_id, message_id) VALUES (?, ?)
+        ON CONFLICT(guild_id) DO UPDATE SET message_id = excluded.message_id
+    ''', (guild_id, new_message.id))
+    return new_message.id
+
+async def update_period_leaderboards():
+    """Keep the extra leaderboard embeds configured in leaderboard.periods up to date in every guild."""
+    try:
         now = datetime.now(timezone.utc)
-        time_since_last_update = (now - last_message_update).total_seconds()
-        if time_since_last_update < 2:
-            await asyncio.sleep(2 - time_since_last_update)
+        for settings in guild_settings:
+            channel = bot.get_channel(settings.leaderboard_channel_id) if settings.leaderboard_channel_id else None
+            if not channel:
+                continue
+
+            for period in LEADERBOARD_PERIODS:
+                rows = await fetch_period_leaderboard(db, settings.guild_id, period, now, reset_at=settings.reset_at)
+                key = (settings.guild_id, period)
+                if period_rows_sent.get(key) == rows:
+                    continue
+
+                title = PERIODS[period][0]
+                embed = build_leaderboard_embed(f"🏆 Top 10 Players - {title}", rows, FOOTER_THUMBNAIL)
+                period_rows_sent[key] = rows
+                edit_scheduler.submit(
+                    ('leaderboard', settings.guild_id, period), channel.id,
+                    functools.partial(send_period_leaderboard_embed, channel, settings.guild_id, period, embed)
+                )
 
-        c.execute('SELECT message_id FROM leaderboard_embed WHERE id = 1')
-        result = c.fetchone()
+        await db.write(prune_rollups, now)
+    except Exception as e:
+        traceback.print_exc()
+
+async def send_period_leaderboard_embed(channel, guild_id, period, embed):
+    """Edit (or create) the leaderboard message of a period in a guild, runs through the edit scheduler."""
+    try:
+        result = await db.fetchone(
+            'SELECT message_id FROM period_leaderboard_embed WHERE guild_id = ? AND period = ?', (guild_id, period))
         if result:
-            message_id = result[0]
             try:
-                message = await channel.fetch_message(message_id)
-                await message.edit(embed=embed)
-                last_message_update = datetime.now(timezone.utc)
+                await channel.get_partial_message(result[0]).edit(embed=embed)
+                return result[0]
             except discord.NotFound:
-                new_message = await channel.send(embed=embed)
-                c.execute('UPDATE leaderboard_embed SET message_id = ? WHERE id = 1', (new_message.id,))
-                conn.commit()
-                last_message_update = datetime.now(timezone.utc)
-        else:
-            new_message = await channel.send(embed=embed)
-            c.execute('INSERT INTO leaderboard_embed (id, message_id) VALUES (1, ?)', (new_message.id,))
-            conn.commit()
-            last_message_update = datetime.now(timezone.utc)
-    except Exception as e:
-        traceback.print_exc()
+                pass
+
+        new_message = await channel.send(embed=embed)
+        await db.execute('''
+            INSERT INTO period_leaderboard_embed (guild_id, period, message_id) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, period) DO UPDATE SET message_id = excluded.message_id
+        ''', (guild_id, period, new_message.id))
+        return new_message.id
+    except Exception:
+        # Make sure the next cycle tries again
+        period_rows_sent.pop((guild_id, period), None)
+        raise
+
+def embed_fingerprint(embed):
+    """Hash of everything shown in an embed except its timestamp."""
+    data = embed.to_dict()
+    data.pop('timestamp', None)
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
 
 def convert_time(input_str):
     weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
@@ -474,23 +597,82 @@ def seconds_remaining_to_human_readable(real_seconds):
     minutes = minutes % 60
     return f"{int(hours)}h, {int(minutes)}m"
 
-def mark_all_players_offline():
+async def save_snapshot():
+    """Save the roster and what the embeds show, so a restart can carry on where this run stopped."""
+    try:
+        state = {
+            'saved_at': time.time(),
+            'online_embeds': [[guild_id, server, message_id, fingerprint]
+                              for (guild_id, server), (message_id, fingerprint) in online_embed_fingerprints.items()],
+            'leaderboards': [[guild_id, rows] for guild_id, rows in leaderboard_rows_sent.items()],
+            'period_leaderboards': [[guild_id, period, rows] for (guild_id, period), rows in period_rows_sent.items()],
+        }
+        if not INGEST_WORKER:
+            # The worker saves its own roster, see ingest.run_worker
+            state.update(ingest.snapshot())
+        await db.write(save_state, SNAPSHOT_KEY, state)
+    except Exception as e:
+        traceback.print_exc()
+
+async def restore_snapshot():
+    """Load the state save_snapshot saved if it is recent enough, otherwise start with an empty roster."""
+    saved = state = None
+    try:
+        saved = await db.read(load_state, SNAPSHOT_KEY)
+        if ingest.is_fresh(saved):
+            state = (
+                {(guild_id, server): (message_id, fingerprint)
+                 for guild_id, server, message_id, fingerprint in saved['online_embeds']},
+                {guild_id: [tuple(row) for row in rows] for guild_id, rows in saved['leaderboards']},
+                {(guild_id, period): [tuple(row) for row in rows] for guild_id, period, rows in saved['period_leaderboards']}
+            )
+            if not INGEST_WORKER and 'roster' not in saved:
+                # Saved in worker mode, the roster is in the worker's snapshot
+                state = None
+    except Exception as e:
+        # e.g. a snapshot saved by an older version, start cold
+        traceback.print_exc()
+
+    if not INGEST_WORKER:
+        # The roster and the open sessions belong to whoever runs the ingest
+        restored = await ingest.restore(saved if state else None)
+        if restored:
+            print(f"Restored {restored} online players from the snapshot of {int(time.time() - saved['saved_at'])}s ago")
+    if not state:
+        return
+
+    online_embeds, leaderboard_rows, period_rows = state
+    online_embed_fingerprints.update(online_embeds)
+    leaderboard_rows_sent.update(leaderboard_rows)
+    period_rows_sent.update(period_rows)
+
+async def mark_all_players_offline():
     """Marks all players as offline in the database."""
     try:
-        c.execute('UPDATE players SET is_online = 0 WHERE is_online = 1')
-        conn.commit()
+        await db.execute('UPDATE players SET is_online = 0 WHERE is_online = 1')
     except Exception as e:
         traceback.print_exc()
 
 async def shutdown():
     """Performs cleanup tasks before shutting down the bot."""
-    mark_all_players_offline()
+    await save_snapshot()
+    if INGEST_WORKER:
+        await ingest_subscriber.close()
+    else:
+        await mark_all_players_offline()
+    await http_client.close()
+    await edit_scheduler.close()
+    await metrics_server.close()
+    if loop_watchdog:
+        await loop_watchdog.close()
     await bot.close()
-    conn.close()
+    db.close()
 
 async def load_cogs():
     """Load all command cogs from the commands directory."""
-    for filename in os.listdir('./commands'):
+    commands_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands')
+    # Imports and setup() run synchronously, loading them concurrently wouldn't be any faster
+    for filename in sorted(os.listdir(commands_dir)):
         if filename.endswith('.py') and filename != '__init__.py':
             try:
                 await bot.load_extension(f'commands.{filename[:-3]}')
@@ -499,8 +681,9 @@ async def load_cogs():
                 traceback.print_exc()
 
 async def is_crewmember(interaction: discord.Interaction) -> bool:
-    """Check if the user has the CrewMember role."""
-    if any(role.id == CREWMEMBER_ROLE_ID for role in interaction.user.roles):
+    """Check if the user has the CrewMember role of the guild the command is used in."""
+    settings = guild_settings.get(interaction.guild_id)
+    if settings and any(role.id == settings.crewmember_role_id for role in interaction.user.roles):
         return True
     raise app_commands.CheckFailure("You do not have the required role to use this command.")
 
@@ -516,11 +699,12 @@ def handle_exit(signum, frame):
     """Handles exit signals by scheduling the shutdown coroutine."""
     asyncio.create_task(shutdown())
 
-signal.signal(signal.SIGINT, handle_exit)
-signal.signal(signal.SIGTERM, handle_exit)
+if __name__ == '__main__':
+    signal.signal(signal.SIGINT, handle_exit)
+    signal.signal(signal.SIGTERM, handle_exit)
 
-try:
-    bot.run(BOTTOKEN)
-except Exception as e:
-    print(f"Failed to start bot: {e}")
-    traceback.print_exc()
+    try:
+        bot.run(BOTTOKEN)
+    except Exception as e:
+        print(f"Failed to start bot: {e}")
+        traceback.print_exc()
@@ -0,0 +1,229 @@
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds, from a fast SQLite statement up to a slow CNR api response
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds the event loop is late, an interaction has 3 seconds to be answered
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 3.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+class Gauge:
+    """A value read when the metrics are scraped, fn returns a number or {labels tuple: number}."""
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            value = self.fn()
+        except Exception:
+            return lines
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, number in values:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {number}')
+        return lines
+
+class Histogram:
+    """Observations counted into fixed buckets, one bisect and a few additions per observation."""
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Metrics:
+    """Everything the bot measures, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a few additions under a lock, so it stays on
+    in production. Whether anything can scrape it is up to MetricsServer.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.metrics = []
+        self.fetch_seconds = self.add(Histogram(
+            'cnr_fetch_seconds', 'Time to poll a CNR endpoint.', ('endpoint', 'result')))
+        self.db_seconds = self.add(Histogram(
+            'cnr_db_job_seconds', 'Time spent running a database job.', ('kind', 'job')))
+        self.db_commit_seconds = self.add(Histogram(
+            'cnr_db_commit_seconds', 'Time to commit a batch of database writes.'))
+        self.discord_seconds = self.add(Histogram(
+            'cnr_discord_request_seconds', 'Discord REST request time, including discord.py retries.', ('route', 'status')))
+        self.discord_rate_limits = self.add(Counter(
+            'cnr_discord_rate_limits_total', '429 responses from Discord.', ('route', 'scope')))
+        self.task_seconds = self.add(Histogram(
+            'cnr_task_seconds', 'Duration of one run of a background task.', ('task',)))
+        self.task_overruns = self.add(Counter(
+            'cnr_task_overruns_total', 'Runs of a background task that took longer than its interval.', ('task',)))
+        self.loop_lag_seconds = self.add(Histogram(
+            'cnr_loop_lag_seconds', 'How late the event loop heartbeat woke up, only recorded with profiling enabled.',
+            buckets=LAG_BUCKETS))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, fn, labelnames=()):
+        return self.add(Gauge(name, help, fn, labelnames))
+
+    def record_task(self, task, seconds, interval):
+        self.task_seconds.observe(seconds, task)
+        if seconds > interval:
+            self.task_overruns.inc(task)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('# HELP cnr_uptime_seconds Seconds since the bot started.')
+        lines.append('# TYPE cnr_uptime_seconds gauge')
+        lines.append(f'cnr_uptime_seconds {time.time() - self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+_DISCORD_API = re.compile(r'^.*?/api(/v\d+)?')
+# Snowflakes and tokens in a Discord URL, so rate limits are counted per route and not per message
+_DISCORD_ID = re.compile(r'/\d{15,}|/[A-Za-z0-9_-]{60,}')
+
+def discord_route(url):
+    """Path of a Discord API URL with the IDs replaced, e.g. /channels/{id}/messages/{id}."""
+    path = _DISCORD_API.sub('', url.split('?', 1)[0])
+    return _DISCORD_ID.sub('/{id}', path)
+
+class RateLimitLogHandler(logging.Handler):
+    """Counts the 429s discord.py logs, it retries them itself so they never reach the caller."""
+    def __init__(self, metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        try:
+            if 'responded with 429' in str(record.msg) and len(record.args or ()) >= 2:
+                method, url = record.args[0], str(record.args[1])
+                self.metrics.discord_rate_limits.inc(f'{method} {discord_route(url)}', 'route')
+            elif 'global rate limit' in str(record.msg).lower():
+                self.metrics.discord_rate_limits.inc('', 'global')
+        except Exception:
+            pass
+
+def instrument_discord(http, metrics):
+    """Time every Discord REST request made through the bot's HTTPClient."""
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, 'status', type(e).__name__))
+            raise
+        finally:
+            metrics.discord_seconds.observe(time.perf_counter() - start, f'{route.method} {route.path}', status)
+
+    http.request = timed_request
+    handler = RateLimitLogHandler(metrics)
+    logging.getLogger('discord.http').addHandler(handler)
+    return handler
+
+class MetricsServer:
+    """Serves /metrics over HTTP, meant to be bound to localhost for a Prometheus scraper."""
+    def __init__(self, metrics, host='127.0.0.1', port=9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        # aiohttp's server side is only imported when metrics are enabled
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Metrics available on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8')
@@ -0,0 +1,107 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]'
+
+class PlayerRecord:
+    """The fields of a /cnr/players entry the bot uses."""
+    __slots__ = ('uid', 'username')
+
+    def __init__(self, uid, username):
+        self.uid = uid
+        self.username = username
+
+def player_record(player):
+    """PlayerRecord of a decoded /cnr/players entry, None if it has no uid or username."""
+    if not isinstance(player, dict):
+        return None
+    uid = player.get('Uid')
+    username = player.get('Username')
+    username = username.get('Username') if isinstance(username, dict) else None
+    if uid and username:
+        return PlayerRecord(uid, username)
+    return None
+
+class JsonArrayParser:
+    """Incrementally decodes a top-level JSON array, one element at a time.
+
+    Bytes are fed as they arrive and only the elements that are complete are
+    decoded, so neither the whole body nor all decoded elements have to be
+    held at once. Raises ValueError on malformed input.
+    """
+    def __init__(self):
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        # start -> first -> (value -> separator)* -> done
+        self.state = 'start'
+
+    def feed(self, data, final=False):
+        """Add bytes, returns the elements completed by them."""
+        buffer = self.buffer[self.pos:] + self._utf8.decode(data, final)
+        pos = 0
+        items = []
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            char = buffer[pos]
+            if self.state == 'start':
+                if char != '[':
+                    raise ValueError("expected a JSON array")
+                pos += 1
+                self.state = 'first'
+            elif self.state == 'separator' or (self.state == 'first' and char == ']'):
+                if char == ']':
+                    self.state = 'done'
+                elif char == ',':
+                    self.state = 'value'
+                else:
+                    raise ValueError(f"expected ',' or ']' at {pos}")
+                pos += 1
+            elif self.state in ('first', 'value'):
+                try:
+                    item, end = _decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    # The element isn't complete yet
+                    break
+                if not final and not isinstance(item, (dict, list, str)) and (end == len(buffer) or buffer[end] not in _DELIMITERS):
+                    # A number might continue in the next chunk, e.g. "1.5" of "1.5e3"
+                    break
+                items.append(item)
+                pos = end
+                self.state = 'separator'
+            else:
+                raise ValueError("unexpected data after the JSON array")
+
+        self.buffer = buffer
+        self.pos = pos
+        return items
+
+    def close(self):
+        """Signal the end of the input, returns any last elements."""
+        items = self.feed(b'', final=True)
+        if self.state != 'done':
+            raise ValueError("truncated JSON array")
+        return items
+
+async def stream_players(response, chunk_size=16384):
+    """Decode a /cnr/players response while it downloads, returns a list of PlayerRecord."""
+    parser = JsonArrayParser()
+    players = []
+    async for chunk in response.content.iter_chunked(chunk_size):
+        for player in parser.feed(chunk):
+            record = player_record(player)
+            if record is not None:
+                players.append(record)
+    for player in parser.close():
+        record = player_record(player)
+        if record is not None:
+            players.append(record)
+    return players
@@ -0,0 +1,167 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+class Endpoint:
+    """Poll state of one endpoint.
+
+    healthy:   polled every `interval` seconds, `busy_interval` while the server is busy
+    backoff:   the last poll failed, retried after an exponentially growing, jittered delay
+    open:      failed failure_threshold times in a row, left alone for open_for seconds
+    half_open: open_for has passed, one probe decides whether it's healthy or open again
+    """
+    __slots__ = (
+        'name', 'url', 'session', 'state', 'failures', 'busy', 'next_poll', 'last_status',
+        'last_error', 'last_success', 'etag', 'last_modified', 'data', 'polls', 'not_modified'
+    )
+
+    def __init__(self, name, url, session):
+        self.name = name
+        self.url = url
+        # 'api' or 'status', which HttpClient session the endpoint is fetched with
+        self.session = session
+        self.state = 'healthy'
+        self.failures = 0
+        self.busy = False
+        self.next_poll = 0.0
+        self.last_status = None
+        self.last_error = None
+        self.last_success = None
+        # Validators of the last full response, sent back so an unchanged payload isn't downloaded again
+        self.etag = None
+        self.last_modified = None
+        self.data = None
+        self.polls = 0
+        self.not_modified = 0
+
+    def current(self):
+        """Payload of the last poll, None if it failed."""
+        return self.data if self.failures == 0 else None
+
+class PollScheduler:
+    """Decides when each endpoint is polled, and polls it.
+
+    Every endpoint has its own state machine (see Endpoint), so a server that
+    is down is backed off and eventually left alone, while the others keep
+    their cadence. Times are time.monotonic(). Poll latency is recorded in
+    metrics (a metrics.Metrics) if given.
+    """
+    def __init__(self, config=None, metrics=None):
+        config = config or {}
+        self.metrics = metrics
+        self.interval = float(config.get('poll_interval', 60))
+        self.busy_interval = float(config.get('busy_interval', 30))
+        self.max_backoff = float(config.get('max_backoff', 900))
+        self.failure_threshold = int(config.get('failure_threshold', 5))
+        self.open_for = float(config.get('circuit_open', 600))
+        self.endpoints = {}
+
+    def add(self, name, url, session='api'):
+        endpoint = self.endpoints[name] = Endpoint(name, url, session)
+        return endpoint
+
+    def get(self, name):
+        return self.endpoints.get(name)
+
+    def due(self, now=None):
+        """Endpoints that should be polled now."""
+        now = time.monotonic() if now is None else now
+        return [endpoint for endpoint in self.endpoints.values() if endpoint.next_poll <= now]
+
+    async def fetch(self, endpoint, session, timeout=None, busy=None, decode=None):
+        """Poll an endpoint, returns its decoded JSON or None on failure.
+
+        A 304 answer to the conditional request returns the payload of the last
+        full response. busy is called with the payload and decides whether the
+        endpoint is polled at the busy cadence. decode is an optional coroutine
+        function that turns the response into the payload instead of json().
+        """
+        start = time.perf_counter()
+        data = await self._fetch(endpoint, session, timeout, busy, decode)
+        if self.metrics:
+            if data is None:
+                result = 'error'
+            else:
+                result = 'not_modified' if endpoint.last_status == 304 else 'ok'
+            self.metrics.fetch_seconds.observe(time.perf_counter() - start, endpoint.name, result)
+        return data
+
+    async def _fetch(self, endpoint, session, timeout, busy, decode):
+        if endpoint.state == 'open':
+            endpoint.state = 'half_open'
+        endpoint.polls += 1
+
+        headers = {}
+        if endpoint.etag:
+            headers['If-None-Match'] = endpoint.etag
+        if endpoint.last_modified:
+            headers['If-Modified-Since'] = endpoint.last_modified
+
+        try:
+            async with session.get(endpoint.url, timeout=timeout, headers=headers) as response:
+                endpoint.last_status = response.status
+                if response.status == 304 and endpoint.data is not None:
+                    endpoint.not_modified += 1
+                    self._succeeded(endpoint, busy)
+                    return endpoint.data
+
+                if response.status == 404:
+                    self._failed(endpoint, "not found (404), the server might be offline")
+                    return None
+                if not response.ok:
+                    self._failed(endpoint, f"returned status code {response.status}")
+                    return None
+
+                if decode is not None:
+                    data = await decode(response)
+                else:
+                    data = await response.json(content_type=None)
+                endpoint.etag = response.headers.get('ETag')
+                endpoint.last_modified = response.headers.get('Last-Modified')
+        except asyncio.TimeoutError:
+            self._failed(endpoint, "timed out")
+            return None
+        except aiohttp.ClientConnectionError:
+            self._failed(endpoint, "connection failed")
+            return None
+        except (aiohttp.ClientError, ValueError) as e:
+            self._failed(endpoint, f"returned an invalid response: {type(e).__name__}")
+            return None
+
+        endpoint.data = data
+        self._succeeded(endpoint, busy)
+        return data
+
+    def _succeeded(self, endpoint, busy):
+        now = time.monotonic()
+        if endpoint.state != 'healthy':
+            print(f"Endpoint {endpoint.name} is healthy again after {endpoint.failures} failures")
+        endpoint.state = 'healthy'
+        endpoint.failures = 0
+        endpoint.last_error = None
+        endpoint.last_success = now
+        if busy is not None:
+            try:
+                endpoint.busy = bool(busy(endpoint.data))
+            except Exception:
+                endpoint.busy = False
+        endpoint.next_poll = now + (self.busy_interval if endpoint.busy else self.interval)
+
+    def _failed(self, endpoint, error):
+        now = time.monotonic()
+        endpoint.failures += 1
+        endpoint.last_error = error
+        if endpoint.state == 'half_open' or endpoint.failures >= self.failure_threshold:
+            if endpoint.state != 'open':
+                print(f"Endpoint {endpoint.name} {error}, not polling it for {int(self.open_for)}s ({endpoint.failures} failures in a row)")
+            endpoint.state = 'open'
+            endpoint.next_poll = now + self.open_for
+            return
+
+        endpoint.state = 'backoff'
+        delay = min(self.max_backoff, self.interval * 2 ** (endpoint.failures - 1))
+        # Equal jitter, endpoints that failed together don't retry together
+        endpoint.next_poll = now + delay / 2 + random.uniform(0, delay / 2)
+        print(f"Endpoint {endpoint.name} {error}, retrying in {int(endpoint.next_poll - now)}s")
@@ -0,0 +1,75 @@
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from database import analyze, archive_players, incremental_vacuum, load_state, save_state
+
+# bot_metadata key of when the last pass ran, so restarts don't reset the schedule
+STATE_KEY = 'retention'
+
+class Retention:
+    """Keeps the players table and the database file from growing with every player ever seen.
+
+    Every interval seconds, players that aren't linked in any guild and weren't
+    seen for archive_after seconds are moved to players_archive, batch rows per
+    write job so the ingest keeps writing in between. store_roster_delta and
+    link_player move them back when they are seen again or linked. The pages
+    that frees are then given back to the file system with incremental vacuum,
+    and the query planner statistics are refreshed with ANALYZE.
+    """
+    def __init__(self, db, config=None, metrics=None):
+        config = config or {}
+        self.db = db
+        self.metrics = metrics
+        self.enabled = config.get('enabled', True)
+        self.archive_after = float(config.get('archive_after_days', 30)) * 86400
+        self.interval = float(config.get('interval_hours', 6)) * 3600
+        self.batch = int(config.get('batch_size', 1000))
+        # Free pages given back per write job
+        self.vacuum_pages = int(config.get('vacuum_pages', 2000))
+        # Unix time of the next pass, None until load()
+        self.next_run = None
+        self.last_result = None
+
+    async def load(self):
+        """Read when the last pass ran, a pass that is overdue runs at the next due() check."""
+        saved = await self.db.read(load_state, STATE_KEY)
+        ran_at = saved['ran_at'] if saved else 0
+        self.last_result = saved
+        self.next_run = ran_at + self.interval
+
+    def due(self):
+        return self.enabled and self.next_run is not None and time.time() >= self.next_run
+
+    async def run(self):
+        """Archive, vacuum and analyze once, returns (players archived, pages freed)."""
+        start = time.perf_counter()
+        self.next_run = time.time() + self.interval
+        try:
+            now = datetime.now(timezone.utc)
+            cutoff = (now - timedelta(seconds=self.archive_after)).isoformat()
+            archived = 0
+            after = 0
+            while after is not None:
+                moved, after = await self.db.write(archive_players, cutoff, now.isoformat(), after, self.batch)
+                archived += moved
+
+            freed = 0
+            while True:
+                pages, remaining = await self.db.write(incremental_vacuum, self.vacuum_pages)
+                freed += pages
+                if not pages or not remaining:
+                    break
+
+            await self.db.write(analyze)
+            self.last_result = {'ran_at': time.time(), 'archived': archived, 'freed_pages': freed}
+            await self.db.write(save_state, STATE_KEY, self.last_result)
+            if archived or freed:
+                print(f"Retention: archived {archived} inactive players, freed {freed} database pages")
+            return archived, freed
+        except Exception as e:
+            traceback.print_exc()
+            return 0, 0
+        finally:
+            if self.metrics:
+                self.metrics.record_task('retention', time.perf_counter() - start, self.interval)
@@ -0,0 +1,181 @@
+from datetime import datetime, timezone
+
+class RosterEntry:
+    """A player that is currently online."""
+    __slots__ = ('username', 'server', 'session_start', 'last_seen', 'session_seconds')
+
+    def __init__(self, username, server, session_start, last_seen):
+        self.username = username
+        self.server = server
+        self.session_start = session_start
+        self.last_seen = last_seen
+        # Playtime credited to the current session so far
+        self.session_seconds = 0
+
+class RosterDelta:
+    """What changed between two polls.
+
+    joined:   (uid, username, server) of players that just came online
+    switched: (uid, username, old_server, new_server) of players that moved server
+    renamed:  (uid, username, server) of players that changed their username
+    stayed:   (uid, seconds) of players that were online before and still are
+              (including switched/renamed) with the playtime they earned since they were last seen
+    left:     (uid, server) of players that went offline
+    opened:   (uid, server, start) of sessions that started
+    closed:   (uid, server, end, seconds) of sessions that ended
+    """
+    __slots__ = ('joined', 'switched', 'renamed', 'stayed', 'left', 'opened', 'closed')
+
+    def __init__(self):
+        self.joined = []
+        self.switched = []
+        self.renamed = []
+        self.stayed = []
+        self.left = []
+        self.opened = []
+        self.closed = []
+
+    def __bool__(self):
+        return bool(self.joined or self.switched or self.renamed or self.left)
+
+class Roster:
+    """In-memory view of who is online, keyed by uid.
+
+    Each poll is diffed against the previous one so only the changes have to be
+    written to the database and the embeds never have to query it. Playtime is
+    credited per player from the time they were last seen, never more than
+    max_gap seconds at once, so missed polls or a restart can't inflate it.
+    """
+    def __init__(self, stale_after=300, max_gap=180):
+        # Players of a server that couldn't be polled are kept this many seconds before they count as offline
+        self.stale_after = stale_after
+        self.max_gap = max_gap
+        self.players = {}
+
+    def apply(self, fetched, polled_servers, now):
+        """Update the roster with one poll and return the RosterDelta, diff() then commit()."""
+        delta = self.diff(fetched, polled_servers, now)
+        self.commit(delta, now)
+        return delta
+
+    def diff(self, fetched, polled_servers, now):
+        """Return the RosterDelta of one poll without changing the roster.
+
+        fetched maps uid -> (username, server) for every player seen, polled_servers
+        is the set of servers that answered. Players on a server that failed to
+        answer are kept until they haven't been seen for stale_after seconds.
+        """
+        delta = RosterDelta()
+        # Most players were last seen by the same poll, their credit is only worked out once
+        credits = {}
+
+        for uid, (username, server) in fetched.items():
+            entry = self.players.get(uid)
+            if entry is None:
+                delta.joined.append((uid, username, server))
+                delta.opened.append((uid, server, now))
+                continue
+
+            seconds = credits.get(entry.last_seen)
+            if seconds is None:
+                seconds = credits[entry.last_seen] = self.credit(entry, now)
+            delta.stayed.append((uid, seconds))
+
+            if entry.server != server:
+                delta.switched.append((uid, username, entry.server, server))
+                delta.closed.append((uid, entry.server, now, entry.session_seconds + seconds))
+                delta.opened.append((uid, server, now))
+            elif entry.username != username:
+                delta.renamed.append((uid, username, server))
+
+        for uid, entry in self.players.items():
+            if uid in fetched:
+                continue
+            if entry.server in polled_servers or (now - entry.last_seen).total_seconds() > self.stale_after:
+                delta.left.append((uid, entry.server))
+                delta.closed.append((uid, entry.server, entry.last_seen, entry.session_seconds))
+
+        return delta
+
+    def commit(self, delta, now):
+        """Apply a RosterDelta made by diff() at now, once it has been written."""
+        for uid, username, server in delta.joined:
+            self.players[uid] = RosterEntry(username, server, now, now)
+        for uid, seconds in delta.stayed:
+            entry = self.players[uid]
+            entry.session_seconds += seconds
+            entry.last_seen = now
+        for uid, username, old_server, server in delta.switched:
+            entry = self.players[uid]
+            entry.username = username
+            entry.server = server
+            entry.session_start = now
+            entry.session_seconds = 0
+        for uid, username, server in delta.renamed:
+            self.players[uid].username = username
+        for uid, server in delta.left:
+            del self.players[uid]
+
+    def replay(self, joined, switched, renamed, left, now):
+        """Apply the changes another process's roster published and return them as a RosterDelta.
+
+        Keeps a copy of the ingest worker's roster for the embeds. Session times
+        are only approximate in the copy, it never credits playtime.
+        """
+        delta = RosterDelta()
+        for uid, username, server in joined:
+            self.players[uid] = RosterEntry(username, server, now, now)
+            delta.joined.append((uid, username, server))
+        for uid, username, old_server, server in switched:
+            self.players[uid] = RosterEntry(username, server, now, now)
+            delta.switched.append((uid, username, old_server, server))
+        for uid, username, server in renamed:
+            entry = self.players.get(uid)
+            if entry is None:
+                entry = self.players[uid] = RosterEntry(username, server, now, now)
+            entry.username = username
+            delta.renamed.append((uid, username, server))
+        for uid, server in left:
+            self.players.pop(uid, None)
+            delta.left.append((uid, server))
+        return delta
+
+    def credit(self, entry, now):
+        """Seconds of playtime a player earned since they were last seen, capped at max_gap."""
+        gap = (now - entry.last_seen).total_seconds()
+        return int(round(min(max(gap, 0), self.max_gap)))
+
+    def get(self, uid):
+        return self.players.get(uid)
+
+    def is_online(self, uid):
+        return uid in self.players
+
+    def online(self, server=None):
+        """(uid, RosterEntry) pairs of everyone online, optionally only on one server."""
+        return [(uid, entry) for uid, entry in self.players.items() if server is None or entry.server == server]
+
+    def clear(self):
+        self.players.clear()
+
+    def snapshot(self):
+        """Every entry as a JSON serialisable row, times as unix timestamps."""
+        return [
+            (uid, entry.username, entry.server, entry.session_start.timestamp(), entry.last_seen.timestamp(), entry.session_seconds)
+            for uid, entry in self.players.items()
+        ]
+
+    def restore(self, rows, uids=None):
+        """Load rows made by snapshot(), only the players in uids if given. Returns the number restored."""
+        self.players.clear()
+        for uid, username, server, session_start, last_seen, session_seconds in rows:
+            if uids is not None and uid not in uids:
+                continue
+            entry = RosterEntry(
+                username, server,
+                datetime.fromtimestamp(session_start, timezone.utc),
+                datetime.fromtimestamp(last_seen, timezone.utc)
+            )
+            entry.session_seconds = session_seconds
+            self.players[uid] = entry
+        return len(self.players)
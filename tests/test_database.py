@@ -0,0 +1,70 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import Database, link_player, migrate
+
+PLAYERS = 20
+LINKS_PER_PROCESS = 2000
+
+def _count_then_link(conn, guild_id, discord_id, uuid):
+    """A job that reads before it writes, like archive_players, so its transaction starts as a reader."""
+    conn.execute('SELECT COUNT(*) FROM discord_users WHERE guild_id = ?', (guild_id,)).fetchone()
+    return link_player(conn, guild_id, discord_id, uuid)
+
+async def _link_players(path, guild_id, start):
+    db = Database(path)
+    db.start()
+    # Both processes write at the same time instead of one after the other
+    start.wait()
+    errors = []
+    try:
+        for i in range(LINKS_PER_PROCESS):
+            try:
+                await db.write(_count_then_link, guild_id, f'discord-{i % PLAYERS}', f'uid-{i % PLAYERS}')
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+    finally:
+        db.close()
+    return errors
+
+def _worker(path, guild_id, start, results):
+    results.put((guild_id, asyncio.run(_link_players(path, guild_id, start))))
+
+class TwoProcessWriteTest(unittest.TestCase):
+    """The bot and the ingest worker each have a Database writing to the same file."""
+
+    def test_read_then_write_jobs_from_two_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.db')
+            migrate(path)
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.executemany('INSERT INTO players (uid, username) VALUES (?, ?)',
+                                 [(f'uid-{i}', f'Player{i}') for i in range(PLAYERS)])
+            conn.close()
+
+            ctx = multiprocessing.get_context('spawn')
+            start = ctx.Barrier(2)
+            results = ctx.Queue()
+            processes = [ctx.Process(target=_worker, args=(path, guild_id, start, results)) for guild_id in (1, 2)]
+            for process in processes:
+                process.start()
+            errors = dict(results.get(timeout=60) for _ in processes)
+            for process in processes:
+                process.join(timeout=60)
+
+            self.assertEqual(errors, {1: [], 2: []})
+            conn = sqlite3.connect(path)
+            links = conn.execute('SELECT guild_id, COUNT(*) FROM discord_users GROUP BY guild_id').fetchall()
+            conn.close()
+            self.assertEqual(links, [(1, PLAYERS), (2, PLAYERS)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import Database, link_player, migrate, reset_guild_playtime, rollup_buckets
+from leaderboard import LeaderboardCache, fetch_leaderboard_page, fetch_leaderboard_rank, fetch_period_leaderboard
+
+GUILD = 1
+
+class DatabaseTestCase(unittest.TestCase):
+    """A migrated database file with a running Database, players are added with add_players."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(self.path)
+        self.conn = sqlite3.connect(self.path)
+        self.db = Database(self.path)
+        self.db.start()
+
+    def tearDown(self):
+        self.db.close()
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def add_players(self, *players):
+        """Insert (uid, username, playtime) rows and link each one in GUILD."""
+        with self.conn:
+            self.conn.executemany('INSERT INTO players (uid, username, playtime) VALUES (?, ?, ?)', players)
+
+        async def link():
+            for uid, username, playtime in players:
+                await self.db.write(link_player, GUILD, f'discord-{uid}', uid)
+        self.run_async(link())
+
+class LeaderboardPageTest(DatabaseTestCase):
+    """Keyset paging walks the guild's leaderboard both ways without skipping or repeating ties."""
+
+    def setUp(self):
+        super().setUp()
+        # c, d and e are tied, ties are ordered by uid descending
+        self.add_players(('a', 'Alice', 500), ('b', 'Bob', 400), ('c', 'Carol', 300), ('d', 'Dave', 300),
+                         ('e', 'Eve', 300), ('f', 'Frank', 100), ('g', 'Grace', 0))
+        self.order = ['a', 'b', 'e', 'd', 'c', 'f', 'g']
+
+    def page(self, **kwargs):
+        return self.run_async(fetch_leaderboard_page(self.db, GUILD, limit=3, **kwargs))
+
+    def test_forward_and_back(self):
+        pages = [self.page()]
+        while len(pages[-1]) == 3:
+            last = pages[-1][-1]
+            pages.append(self.page(after=(last[2], last[0])))
+        self.assertEqual([[row[0] for row in page] for page in pages], [['a', 'b', 'e'], ['d', 'c', 'f'], ['g']])
+
+        first = pages[2][0]
+        self.assertEqual(self.page(before=(first[2], first[0])), pages[1])
+        first = pages[1][0]
+        self.assertEqual(self.page(before=(first[2], first[0])), pages[0])
+
+    def test_other_guilds_are_not_listed(self):
+        self.run_async(self.db.write(link_player, GUILD + 1, 'discord-x', 'a'))
+        rows = self.run_async(fetch_leaderboard_page(self.db, GUILD + 1))
+        self.assertEqual(rows, [('a', 'Alice', 500)])
+
+    def test_rank_matches_the_page_order(self):
+        for rank, uid in enumerate(self.order, start=1):
+            found = self.run_async(fetch_leaderboard_rank(self.db, GUILD, uid))
+            self.assertEqual((found[0], found[1][0]), (rank, uid))
+
+    def test_rank_of_an_unlinked_player(self):
+        self.assertIsNone(self.run_async(fetch_leaderboard_rank(self.db, GUILD + 1, 'a')))
+
+    def test_cache_matches_the_first_page(self):
+        cache = LeaderboardCache(GUILD, size=3)
+        self.run_async(cache.rebuild(self.db))
+        self.assertEqual(cache.rows(), [('Alice', 500), ('Bob', 400), ('Eve', 300)])
+        self.assertEqual(cache.threshold(), 300)
+        self.assertFalse(cache.update('f', 'Frank', 200))
+        self.assertTrue(cache.update('f', 'Frank', 450))
+        self.assertEqual(cache.rows(), [('Alice', 500), ('Frank', 450), ('Bob', 400)])
+
+class PeriodResetTest(DatabaseTestCase):
+    """A reset in the middle of a bucket keeps what is earned in the rest of it."""
+
+    def setUp(self):
+        super().setUp()
+        self.add_players(('a', 'Alice', 0), ('b', 'Bob', 0))
+        self.reset = datetime(2026, 10, 17, 0, 30, tzinfo=timezone.utc)
+        self.hour, self.day = rollup_buckets(self.reset)
+        self.add_seconds([('a', 1200), ('b', 600)])
+        with self.conn:
+            self.conn.execute('INSERT INTO playtime_hourly VALUES (?, ?, ?)', ('a', self.hour - 1, 3600))
+            self.conn.execute('INSERT INTO playtime_daily VALUES (?, ?, ?)', ('a', self.day - 1, 3600))
+        self.run_async(self.db.write(reset_guild_playtime, GUILD, self.reset.timestamp()))
+
+    def add_seconds(self, earned):
+        with self.conn:
+            for uid, seconds in earned:
+                self.conn.execute('''
+                    INSERT INTO playtime_hourly (uid, hour, seconds) VALUES (?, ?, ?)
+                    ON CONFLICT(uid, hour) DO UPDATE SET seconds = seconds + excluded.seconds
+                ''', (uid, self.hour, seconds))
+                self.conn.execute('''
+                    INSERT INTO playtime_daily (uid, day, seconds) VALUES (?, ?, ?)
+                    ON CONFLICT(uid, day) DO UPDATE SET seconds = seconds + excluded.seconds
+                ''', (uid, self.day, seconds))
+
+    def leaderboard(self, period, reset_at):
+        now = datetime(2026, 10, 17, 0, 50, tzinfo=timezone.utc)
+        return self.run_async(fetch_period_leaderboard(self.db, GUILD, period, now, reset_at=reset_at))
+
+    def test_only_playtime_after_the_reset_counts(self):
+        self.add_seconds([('b', 900)])
+        for period in ('day', 'week', 'month'):
+            self.assertEqual(self.leaderboard(period, self.reset.timestamp()), [('Bob', 900)])
+
+    def test_without_a_reset_every_bucket_counts(self):
+        self.add_seconds([('b', 900)])
+        self.assertEqual(self.leaderboard('day', None), [('Alice', 4800), ('Bob', 1500)])
+
+    def test_reset_before_the_period_has_no_effect(self):
+        long_ago = datetime(2026, 9, 1, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(self.leaderboard('week', long_ago), [('Alice', 4800), ('Bob', 600)])
+
+if __name__ == '__main__':
+    unittest.main()
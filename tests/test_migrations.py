@@ -0,0 +1,119 @@
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import MIGRATIONS, adopt_legacy_rows, migrate
+
+GUILD = 1234
+
+def _create_baseline(path):
+    """A players.db as setup_database and the verification cog left it before migrations existed."""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executescript('''
+            CREATE TABLE players (
+                uid TEXT PRIMARY KEY,
+                username TEXT,
+                playtime INTEGER DEFAULT 0,
+                last_seen TEXT,
+                server TEXT,
+                is_online INTEGER DEFAULT 0
+            );
+            CREATE TABLE discord_users (
+                discord_id TEXT PRIMARY KEY,
+                uuid TEXT UNIQUE
+            );
+            CREATE TABLE bot_metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE online_users_embed (
+                server TEXT PRIMARY KEY,
+                message_id INTEGER
+            );
+            CREATE TABLE leaderboard_embed (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                message_id INTEGER
+            );
+            CREATE TABLE verification_message (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                message_id INTEGER,
+                channel_id INTEGER
+            );
+        ''')
+        conn.executemany('INSERT INTO players VALUES (?, ?, ?, ?, ?, ?)', [
+            ('uid-a', 'Alice', 7200, '2026-10-01T12:00:00+00:00', 'US West', 0),
+            ('uid-b', 'Bob', 300, '2026-10-02T12:00:00+00:00', 'EU', 1),
+            ('uid-c', 'Carol', 60, '2026-10-03T12:00:00+00:00', 'EU', 0),
+        ])
+        conn.executemany('INSERT INTO discord_users VALUES (?, ?)', [('111', 'uid-a'), ('222', 'uid-b'), ('333', None)])
+        conn.execute("INSERT INTO bot_metadata VALUES ('last_reset', '2026-09-01')")
+        conn.executemany('INSERT INTO online_users_embed VALUES (?, ?)', [('US West', 10), ('EU', 11)])
+        conn.execute('INSERT INTO leaderboard_embed VALUES (1, 20)')
+        conn.execute('INSERT INTO verification_message VALUES (1, 30, 40)')
+    conn.close()
+
+class MigrationChainTest(unittest.TestCase):
+    """Every migration from 1 to the latest runs on a database from before migrations existed."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'players.db')
+        _create_baseline(self.path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(self.path)
+        self.conn = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def test_reaches_latest_version(self):
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(self.conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        tables = {name for name, in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table in ('sessions', 'playtime_hourly', 'playtime_daily', 'period_leaderboard_embed',
+                      'verification_sessions', 'guild_settings', 'players_archive', 'period_reset_offsets'):
+            self.assertIn(table, tables)
+        self.assertFalse([name for name in tables if name.endswith('_old')])
+
+    def test_players_carry_over(self):
+        rows = self.conn.execute('SELECT uid, username, playtime, linked FROM players ORDER BY uid').fetchall()
+        self.assertEqual(rows, [('uid-a', 'Alice', 7200, 1), ('uid-b', 'Bob', 300, 1), ('uid-c', 'Carol', 60, 0)])
+        # The trigram index was built from the existing usernames
+        found = self.conn.execute("SELECT rowid FROM players_fts WHERE players_fts MATCH 'aro'").fetchall()
+        self.assertEqual(len(found), 1)
+
+    def test_links_and_embeds_move_to_guild_zero(self):
+        links = self.conn.execute(
+            'SELECT guild_id, discord_id, uuid, playtime_offset, playtime FROM discord_users ORDER BY discord_id'
+        ).fetchall()
+        # The link without a player was dropped, the others count the player's whole playtime
+        self.assertEqual(links, [(0, '111', 'uid-a', 0, 7200), (0, '222', 'uid-b', 0, 300)])
+        self.assertEqual(self.conn.execute('SELECT * FROM online_users_embed ORDER BY server').fetchall(),
+                         [(0, 'EU', 11), (0, 'US West', 10)])
+        self.assertEqual(self.conn.execute('SELECT * FROM leaderboard_embed').fetchall(), [(0, 20)])
+        self.assertEqual(self.conn.execute('SELECT * FROM verification_message').fetchall(), [(0, 30, 40)])
+        self.assertEqual(self.conn.execute('SELECT * FROM bot_metadata').fetchall(), [('last_reset', '2026-09-01')])
+
+    def test_legacy_rows_are_adopted(self):
+        with self.conn:
+            adopted = adopt_legacy_rows(self.conn, GUILD)
+        self.assertEqual(adopted, 6)
+        self.assertEqual(self.conn.execute('SELECT DISTINCT guild_id FROM discord_users').fetchall(), [(GUILD,)])
+        self.assertEqual(self.conn.execute('SELECT guild_id FROM verification_message').fetchall(), [(GUILD,)])
+
+    def test_migrating_again_does_nothing(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            migrate(self.path)
+        self.assertEqual(output.getvalue(), '')
+
+if __name__ == '__main__':
+    unittest.main()
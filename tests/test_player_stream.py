@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from player_stream import JsonArrayParser, player_record
+
+PLAYERS = [
+    {'Uid': 'a1', 'Username': {'Username': 'Alice'}, 'Note': 'a "quoted" ] , [ name'},
+    {'Uid': 'b2', 'Username': {'Username': 'Bj\u00f6rn \U0001f697'}, 'Path': 'C:\\cnr\\', 'Tags': ['x', {'y': None}]},
+    {'Uid': 'c3', 'Username': {'Username': 'Carol'}, 'Score': 1.5e3, 'Level': 12, 'Active': True},
+    'a string element, with \\u escapes: \u00e9\n',
+    -7,
+    2.25,
+]
+
+def parse(chunks):
+    parser = JsonArrayParser()
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(chunk))
+    items.extend(parser.close())
+    return items
+
+class JsonArrayParserTest(unittest.TestCase):
+    def test_whole_body(self):
+        body = json.dumps(PLAYERS).encode()
+        self.assertEqual(parse([body]), PLAYERS)
+
+    def test_every_split_point(self):
+        # Splits land inside strings, escapes, multi-byte characters and numbers
+        for ensure_ascii in (True, False):
+            body = json.dumps(PLAYERS, ensure_ascii=ensure_ascii, indent=1).encode()
+            for split in range(len(body) + 1):
+                self.assertEqual(parse([body[:split], body[split:]]), PLAYERS, (ensure_ascii, split))
+
+    def test_one_byte_at_a_time(self):
+        body = json.dumps(PLAYERS, ensure_ascii=False).encode()
+        self.assertEqual(parse([body[i:i + 1] for i in range(len(body))]), PLAYERS)
+
+    def test_elements_come_out_as_soon_as_they_are_complete(self):
+        parser = JsonArrayParser()
+        self.assertEqual(parser.feed(b'[{"Uid": "a1"}, {"Uid": "b'), [{'Uid': 'a1'}])
+        self.assertEqual(parser.feed(b'2"}, 12'), [{'Uid': 'b2'}])
+        # 12 might still become 123
+        self.assertEqual(parser.feed(b'3'), [])
+        self.assertEqual(parser.feed(b']'), [123])
+        self.assertEqual(parser.close(), [])
+
+    def test_empty_array(self):
+        self.assertEqual(parse([b' [ ', b' ] ']), [])
+
+    def test_malformed(self):
+        for chunks in ([b'{"Uid": "a1"}'], [b'[1 2]'], [b'[1,'], [b'["unterminated'], [b'[1] 2'], [b'[1,,2]']):
+            with self.assertRaises(ValueError, msg=chunks):
+                parse(chunks)
+
+class PlayerRecordTest(unittest.TestCase):
+    def test_records(self):
+        records = [player_record(player) for player in PLAYERS]
+        self.assertEqual([(record.uid, record.username) for record in records[:3]],
+                         [('a1', 'Alice'), ('b2', 'Bj\u00f6rn \U0001f697'), ('c3', 'Carol')])
+        self.assertEqual(records[3:], [None, None, None])
+        self.assertIsNone(player_record({'Uid': 'd4', 'Username': 'Dave'}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from roster import Roster
+
+START = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+SERVERS = {'US', 'EU'}
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+class RosterTest(unittest.TestCase):
+    def setUp(self):
+        self.roster = Roster(stale_after=300, max_gap=180)
+        self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, START)
+
+    def test_join_opens_a_session(self):
+        delta = self.roster.diff({'a': ('Alice', 'US'), 'b': ('Bob', 'EU'), 'c': ('Carol', 'EU')}, SERVERS, at(60))
+        self.assertEqual(delta.joined, [('c', 'Carol', 'EU')])
+        self.assertEqual(delta.opened, [('c', 'EU', at(60))])
+        self.assertEqual(delta.stayed, [('a', 60), ('b', 60)])
+        self.assertTrue(delta)
+        # diff alone doesn't change the roster
+        self.assertFalse(self.roster.is_online('c'))
+
+        self.roster.commit(delta, at(60))
+        self.assertEqual(self.roster.get('c').username, 'Carol')
+        self.assertEqual(self.roster.get('a').session_seconds, 60)
+        self.assertEqual(self.roster.get('a').last_seen, at(60))
+
+    def test_nothing_changed(self):
+        delta = self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(60))
+        self.assertFalse(delta)
+        self.assertEqual(delta.stayed, [('a', 60), ('b', 60)])
+
+    def test_switch_closes_and_opens_a_session(self):
+        self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(60))
+        delta = self.roster.apply({'a': ('Alice', 'EU'), 'b': ('Bob', 'EU')}, SERVERS, at(120))
+        self.assertEqual(delta.switched, [('a', 'Alice', 'US', 'EU')])
+        self.assertEqual(delta.closed, [('a', 'US', at(120), 120)])
+        self.assertEqual(delta.opened, [('a', 'EU', at(120))])
+        self.assertEqual(delta.renamed, [])
+
+        entry = self.roster.get('a')
+        self.assertEqual((entry.server, entry.session_start, entry.session_seconds), ('EU', at(120), 0))
+        self.assertEqual(self.roster.online('EU'), [('a', entry), ('b', self.roster.get('b'))])
+
+    def test_rename(self):
+        delta = self.roster.apply({'a': ('Alicia', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(60))
+        self.assertEqual(delta.renamed, [('a', 'Alicia', 'US')])
+        self.assertEqual(delta.opened, [])
+        self.assertEqual(delta.closed, [])
+        self.assertEqual(self.roster.get('a').username, 'Alicia')
+
+    def test_leave_closes_the_session_at_last_seen(self):
+        self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(60))
+        delta = self.roster.apply({'a': ('Alice', 'US')}, SERVERS, at(120))
+        self.assertEqual(delta.left, [('b', 'EU')])
+        self.assertEqual(delta.closed, [('b', 'EU', at(60), 60)])
+        self.assertFalse(self.roster.is_online('b'))
+
+    def test_unpolled_server_is_kept_until_stale(self):
+        # EU didn't answer, Bob is still online
+        delta = self.roster.apply({'a': ('Alice', 'US')}, {'US'}, at(60))
+        self.assertEqual(delta.left, [])
+        self.assertTrue(self.roster.is_online('b'))
+
+        delta = self.roster.apply({'a': ('Alice', 'US')}, {'US'}, at(300))
+        self.assertEqual(delta.left, [])
+
+        delta = self.roster.apply({'a': ('Alice', 'US')}, {'US'}, at(301))
+        self.assertEqual(delta.left, [('b', 'EU')])
+        self.assertEqual(delta.closed, [('b', 'EU', START, 0)])
+
+    def test_credit_is_capped_at_max_gap(self):
+        # Missed polls or a restart only ever credit max_gap seconds
+        delta = self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(3600))
+        self.assertEqual(delta.stayed, [('a', 180), ('b', 180)])
+        self.assertEqual(self.roster.get('a').session_seconds, 180)
+
+    def test_clock_going_back_credits_nothing(self):
+        delta = self.roster.diff({'a': ('Alice', 'US')}, {'US'}, at(-30))
+        self.assertEqual(delta.stayed, [('a', 0)])
+
+    def test_snapshot_restore(self):
+        self.roster.apply({'a': ('Alice', 'US'), 'b': ('Bob', 'EU')}, SERVERS, at(60))
+        copy = Roster()
+        self.assertEqual(copy.restore(self.roster.snapshot(), uids={'a'}), 1)
+        entry = copy.get('a')
+        self.assertEqual((entry.username, entry.server, entry.last_seen, entry.session_seconds), ('Alice', 'US', at(60), 60))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import close_open_sessions, migrate, resume_sessions, store_roster_delta
+from roster import Roster
+
+START = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+class SessionTest(unittest.TestCase):
+    """Sessions are opened and closed by store_roster_delta as the roster changes."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'test.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(path)
+        self.conn = sqlite3.connect(path)
+        self.roster = Roster(stale_after=300, max_gap=180)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def poll(self, seconds, fetched, tracked_uids=()):
+        now = at(seconds)
+        delta = self.roster.diff(fetched, {'US', 'EU'}, now)
+        with self.conn:
+            totals = store_roster_delta(self.conn, delta, now.isoformat(), tracked_uids)
+        self.roster.commit(delta, now)
+        return totals
+
+    def sessions(self):
+        return self.conn.execute('SELECT uid, server, start, end, seconds FROM sessions ORDER BY id').fetchall()
+
+    def test_join_and_leave(self):
+        self.poll(0, {'a': ('Alice', 'US')})
+        self.assertEqual(self.sessions(), [('a', 'US', at(0).isoformat(), None, 0)])
+
+        self.poll(60, {'a': ('Alice', 'US')})
+        self.poll(120, {'a': ('Alice', 'US')})
+        self.poll(180, {})
+        self.assertEqual(self.sessions(), [('a', 'US', at(0).isoformat(), at(120).isoformat(), 120)])
+        row = self.conn.execute('SELECT playtime, is_online, last_seen FROM players WHERE uid = ?', ('a',)).fetchone()
+        self.assertEqual(row, (120, 0, at(120).isoformat()))
+
+    def test_switch_closes_before_it_opens(self):
+        self.poll(0, {'a': ('Alice', 'US')})
+        self.poll(60, {'a': ('Alice', 'EU')})
+        self.assertEqual(self.sessions(), [
+            ('a', 'US', at(0).isoformat(), at(60).isoformat(), 60),
+            ('a', 'EU', at(60).isoformat(), None, 0),
+        ])
+        self.assertEqual(self.conn.execute('SELECT server FROM players').fetchone(), ('EU',))
+
+    def test_totals_only_for_tracked_players(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO discord_users (guild_id, discord_id, uuid) VALUES (1, '111', 'a')")
+        self.poll(0, {'a': ('Alice', 'US'), 'b': ('Bob', 'US')})
+        totals = self.poll(60, {'a': ('Alice', 'US'), 'b': ('Bob', 'US')}, tracked_uids=['a'])
+        self.assertEqual(totals, {'a': 60})
+        self.assertEqual(self.conn.execute('SELECT playtime FROM discord_users').fetchone(), (60,))
+        self.assertEqual(self.conn.execute('SELECT uid, seconds FROM playtime_hourly').fetchall(), [('a', 60)])
+        self.assertEqual(self.conn.execute("SELECT playtime FROM players WHERE uid = 'b'").fetchone(), (60,))
+
+    def test_close_open_sessions_after_a_crash(self):
+        self.poll(0, {'a': ('Alice', 'US'), 'b': ('Bob', 'EU')})
+        self.poll(60, {'a': ('Alice', 'US'), 'b': ('Bob', 'EU')})
+        self.poll(90, {'a': ('Alice', 'US')})
+        # The bot dies here, Alice's session is still open
+        with self.conn:
+            closed = close_open_sessions(self.conn)
+        self.assertEqual(closed, 1)
+        self.assertEqual(self.sessions(), [
+            ('a', 'US', at(0).isoformat(), at(90).isoformat(), 90),
+            ('b', 'EU', at(0).isoformat(), at(60).isoformat(), 60),
+        ])
+        with self.conn:
+            self.assertEqual(close_open_sessions(self.conn), 0)
+
+    def test_resume_keeps_the_restored_sessions(self):
+        self.poll(0, {'a': ('Alice', 'US'), 'b': ('Bob', 'EU')})
+        self.poll(60, {'a': ('Alice', 'US'), 'b': ('Bob', 'EU')})
+        with self.conn:
+            kept = resume_sessions(self.conn, {'a'})
+        self.assertEqual(kept, {'a'})
+        self.assertEqual(self.sessions(), [
+            ('a', 'US', at(0).isoformat(), None, 0),
+            ('b', 'EU', at(0).isoformat(), at(60).isoformat(), 60),
+        ])
+        online = self.conn.execute('SELECT uid FROM players WHERE is_online = 1').fetchall()
+        self.assertEqual(online, [('a',)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from database import Database, migrate
+from verification_sessions import TimerWheel, VerificationSessions
+
+class TimerWheelTest(unittest.TestCase):
+    def test_expires_once_the_deadline_passed(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.schedule('a', 10.5)
+        wheel.schedule('b', 12.0)
+        self.assertEqual(wheel.advance(10.0), [])
+        self.assertEqual(wheel.advance(11.0), ['a'])
+        # At most one tick late
+        self.assertEqual(wheel.advance(12.9), [])
+        self.assertEqual(wheel.advance(13.0), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel_and_reschedule(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.schedule('a', 5.0)
+        wheel.schedule('b', 5.0)
+        wheel.cancel('a')
+        wheel.schedule('b', 7.0)
+        self.assertEqual(wheel.advance(6.0), [])
+        self.assertEqual(wheel.advance(8.0), ['b'])
+
+    def test_deadline_more_than_one_turn_away(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(0.0)
+        wheel.schedule('far', 20.0)
+        for now in range(1, 21):
+            self.assertEqual(wheel.advance(float(now)), [], now)
+        self.assertEqual(wheel.advance(21.0), ['far'])
+
+    def test_deadline_in_the_past_fires_next_tick(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(10.0)
+        wheel.schedule('late', 3.0)
+        self.assertEqual(wheel.advance(11.0), ['late'])
+
+    def test_long_stall_expires_everything_due(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(0.0)
+        for i in range(20):
+            wheel.schedule(i, float(i + 1))
+        self.assertEqual(sorted(wheel.advance(100.0)), list(range(20)))
+
+class VerificationSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(self.path)
+        self.db = Database(self.path)
+        self.db.start()
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_failed_session_starts_the_cooldown(self):
+        async def run():
+            sessions = VerificationSessions(self.db, timeout=300, cooldown=30)
+            self.assertIsNone(sessions.reserve(1, 0))
+            self.assertEqual(sessions.reserve(1, 0), 'active')
+            await sessions.start(1, 99, 'ABCD', 0)
+            sessions.release(1)
+            self.assertEqual(sessions.reserve(1, 10), 'active')
+
+            await sessions.end(1, 10, failed=True)
+            self.assertEqual(sessions.reserve(1, 39), 'cooldown')
+            self.assertIsNone(sessions.reserve(1, 40))
+        asyncio.run(run())
+
+    def test_passed_session_has_no_cooldown(self):
+        async def run():
+            sessions = VerificationSessions(self.db, timeout=300, cooldown=30)
+            sessions.reserve(1, 0)
+            await sessions.start(1, 99, 'ABCD', 0)
+            sessions.release(1)
+            await sessions.end(1, 10)
+            self.assertIsNone(sessions.reserve(1, 10))
+        asyncio.run(run())
+
+    def test_expired_sessions_end_with_a_cooldown(self):
+        async def run():
+            sessions = VerificationSessions(self.db, timeout=300, cooldown=30)
+            await sessions.start(1, 99, 'ABCD', 0)
+            await sessions.start(2, 99, 'EFGH', 100)
+            self.assertEqual(await sessions.expire(299), [])
+            expired = await sessions.expire(301)
+            self.assertEqual([session.user_id for session in expired], [1])
+            self.assertEqual(sessions.reserve(1, 301), 'cooldown')
+            self.assertEqual(len(sessions), 1)
+            return await self.db.fetchall('SELECT user_id FROM verification_sessions')
+        self.assertEqual(asyncio.run(run()), [(2,)])
+
+    def test_pending_sessions_survive_a_restart(self):
+        async def run():
+            sessions = VerificationSessions(self.db, timeout=300)
+            await sessions.start(1, 99, 'ABCD', 0)
+            await sessions.start(2, 99, 'EFGH', 200)
+            restarted = VerificationSessions(self.db, timeout=300)
+            self.assertEqual(await restarted.load(400), 1)
+            self.assertEqual(restarted.get(2).answer, 'EFGH')
+            self.assertEqual([session.user_id for session in await restarted.expire(501)], [2])
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
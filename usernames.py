@@ -0,0 +1,67 @@
+from bisect import bisect_left
+
+class UsernameIndex:
+    """Sorted in-memory index of every known username for /link autocomplete.
+
+    Prefix lookups are a binary search into a list sorted by lowercased name,
+    so they stay well inside Discord's autocomplete window however many players
+    are known. The ingest keeps it current with joins and renames.
+    """
+    def __init__(self):
+        # uid -> username
+        self.names = {}
+        # (lowercased username, username, uid), sorted
+        self.keys = []
+
+    async def load(self, db):
+        """Load every known username, e.g. on startup."""
+        rows = await db.fetchall('SELECT uid, username FROM players WHERE username IS NOT NULL')
+        self.names = dict(rows)
+        self.keys = sorted((username.lower(), username, uid) for uid, username in rows)
+
+    def update(self, changes):
+        """Record the current usernames of players from (uid, username) pairs, e.g. one poll's joins and renames.
+
+        The whole batch is merged into the index with one pass and one sort of
+        the mostly sorted list, instead of shifting the list once per change.
+        """
+        removed = set()
+        added = []
+        # Only the last name of a player counts if they show up twice
+        for uid, username in dict(changes).items():
+            old = self.names.get(uid)
+            if old == username:
+                continue
+            if old is not None:
+                removed.add((old.lower(), old, uid))
+            self.names[uid] = username
+            added.append((username.lower(), username, uid))
+        if not added:
+            return
+        if removed:
+            self.keys = [key for key in self.keys if key not in removed]
+        self.keys.extend(added)
+        self.keys.sort()
+
+    def complete(self, prefix, limit=25):
+        """Up to limit usernames starting with prefix, ignoring case, in alphabetical order."""
+        prefix = prefix.lower()
+        found = []
+        for i in range(bisect_left(self.keys, (prefix,)), len(self.keys)):
+            lowered, username, uid = self.keys[i]
+            if not lowered.startswith(prefix) or len(found) >= limit:
+                break
+            if username not in found:
+                found.append(username)
+        return found
+
+async def search_usernames(db, text, limit=25):
+    """Usernames containing text anywhere, ignoring case, from the trigram index.
+
+    The trigram tokenizer needs at least 3 characters to use the index.
+    """
+    if len(text) < 3:
+        return []
+    query = '"' + text.replace('"', '""') + '"'
+    rows = await db.fetchall('SELECT username FROM players_fts WHERE players_fts MATCH ? LIMIT ?', (query, limit))
+    return [row[0] for row in rows]
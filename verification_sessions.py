@@ -0,0 +1,146 @@
+class TimerWheel:
+    """Hashed timing wheel for deadlines, one slot per tick.
+
+    Scheduling and cancelling are O(1) and advancing only looks at the slots
+    the clock moved past, so checking for expired sessions doesn't scan all of
+    them. Deadlines further away than one turn of the wheel stay in their slot
+    until the turn they are due. A deadline fires at most one tick late.
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # key -> slot index
+        self.where = {}
+        # Last tick whose slot has been processed
+        self.current = None
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = int(deadline // self.tick)
+        if self.current is not None and tick <= self.current:
+            tick = self.current + 1
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline has passed."""
+        # Only whole ticks that are over are processed, everything in them is due
+        last = int(now // self.tick) - 1
+        first = last - len(self.slots) + 1 if self.current is None else self.current + 1
+        # After a long stall every slot is looked at once
+        first = max(first, last - len(self.slots) + 1)
+
+        expired = []
+        for tick in range(first, last + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self.where[key]
+                    expired.append(key)
+        if self.current is None or last > self.current:
+            self.current = last
+        return expired
+
+    def __len__(self):
+        return len(self.where)
+
+class VerificationSession:
+    """A captcha that was sent to a member and is waiting for their answer."""
+    __slots__ = ('user_id', 'guild_id', 'answer', 'expires_at')
+
+    def __init__(self, user_id, guild_id, answer, expires_at):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.answer = answer
+        self.expires_at = expires_at
+
+class VerificationSessions:
+    """Registry of pending verifications, keyed by user id.
+
+    Replaces one wait_for listener per member: a single DM handler looks the
+    author up here. Each member has at most one session, and after a failed or
+    expired one they have to wait `cooldown` seconds before starting another.
+    Sessions are written to the database so pending captchas survive a restart.
+    Times are unix timestamps.
+    """
+    def __init__(self, db, timeout=300, cooldown=30):
+        self.db = db
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.sessions = {}
+        # user id -> time they may start a new session
+        self.cooldowns = {}
+        # Users whose captcha is being sent, so a double click can't start a second session
+        self.starting = set()
+        self.wheel = TimerWheel()
+
+    async def load(self, now):
+        """Restore the sessions that were pending when the bot stopped."""
+        await self.db.execute('DELETE FROM verification_sessions WHERE expires_at <= ?', (now,))
+        rows = await self.db.fetchall('SELECT user_id, guild_id, answer, expires_at FROM verification_sessions')
+        for user_id, guild_id, answer, expires_at in rows:
+            self.sessions[user_id] = VerificationSession(user_id, guild_id, answer, expires_at)
+            self.wheel.schedule(user_id, expires_at)
+        return len(rows)
+
+    def get(self, user_id):
+        return self.sessions.get(user_id)
+
+    def reserve(self, user_id, now):
+        """Claim the right to start a session, returns None or why the user can't ('active' or 'cooldown')."""
+        if user_id in self.sessions or user_id in self.starting:
+            return 'active'
+        until = self.cooldowns.get(user_id)
+        if until is not None:
+            if until > now:
+                return 'cooldown'
+            del self.cooldowns[user_id]
+        self.starting.add(user_id)
+        return None
+
+    def release(self, user_id):
+        """Drop a reservation, whether or not a session was started with it."""
+        self.starting.discard(user_id)
+
+    async def start(self, user_id, guild_id, answer, now):
+        session = VerificationSession(user_id, guild_id, answer, now + self.timeout)
+        self.sessions[user_id] = session
+        self.wheel.schedule(user_id, session.expires_at)
+        await self.db.execute('''
+            INSERT OR REPLACE INTO verification_sessions (user_id, guild_id, answer, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, guild_id, answer, session.expires_at))
+        return session
+
+    async def end(self, user_id, now, failed=False):
+        """Remove a session, returns it (or None if there was none). A failed session starts the cooldown."""
+        session = self.sessions.pop(user_id, None)
+        self.wheel.cancel(user_id)
+        if session is None:
+            return None
+        if failed:
+            self.cooldowns[user_id] = now + self.cooldown
+        await self.db.execute('DELETE FROM verification_sessions WHERE user_id = ?', (user_id,))
+        return session
+
+    async def expire(self, now):
+        """End every session past its deadline, returns them."""
+        expired = []
+        for user_id in self.wheel.advance(now):
+            session = await self.end(user_id, now, failed=True)
+            if session is not None:
+                expired.append(session)
+        # Cooldowns are only checked when the user clicks again, forget the old ones
+        if len(self.cooldowns) > 1000:
+            self.cooldowns = {user_id: until for user_id, until in self.cooldowns.items() if until > now}
+        return expired
+
+    def __len__(self):
+        return len(self.sessions)